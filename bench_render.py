@@ -0,0 +1,205 @@
+"""Rendering benchmark for the SelamSnap compositing pipeline.
+
+Times every stage of a render (resize_to_height, simple_background_removal,
+template compositing and the PNG save) on synthetic cut-outs at several
+resolutions, using the real assets in templates/.
+
+Usage:
+    python bench_render.py                     # run and compare to the baseline
+    python bench_render.py --save-baseline     # run and store a new baseline
+    python bench_render.py --resolutions 0.5,2 --iterations 10
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Template paths are relative to the bot's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+BASELINE_FILE = 'bench_baseline.json'
+DEFAULT_RESOLUTIONS = [0.5, 2, 6, 12]  # megapixels
+
+
+def make_synthetic_cutout(megapixels, seed=0):
+    """Create a portrait RGBA cut-out (person-shaped alpha) of about N megapixels"""
+    height = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    width = int(height * 3 / 4)
+
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(40, 220, width, dtype=np.float32)
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = gradient
+    pixels[..., 1] = gradient[::-1]
+    pixels[..., 2] = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    pixels[..., 3] = 0
+    cutout = Image.fromarray(pixels, 'RGBA')
+
+    # Head and shoulders silhouette
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse([width * 0.3, height * 0.05, width * 0.7, height * 0.35], fill=255)
+    draw.rounded_rectangle([width * 0.05, height * 0.33, width * 0.95, height], radius=width // 4, fill=255)
+    cutout.putalpha(mask)
+
+    return cutout
+
+
+def encode_photo(cutout):
+    """Encode a cut-out as the JPEG a user would upload"""
+    img_byte_arr = BytesIO()
+    cutout.convert('RGB').save(img_byte_arr, format='JPEG', quality=90)
+    return img_byte_arr.getvalue()
+
+
+def percentile(samples, pct):
+    return float(np.percentile(samples, pct)) * 1000
+
+
+def time_stage(func, iterations):
+    """Run func the given number of times and return (samples, last result)"""
+    samples = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def summarize(samples):
+    return {
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+    }
+
+
+def run_case(template_key, megapixels, iterations):
+    """Benchmark all stages for one template at one input resolution"""
+    # The inputs are built first so they don't count as the pipeline's memory
+    cutout = make_synthetic_cutout(megapixels)
+    photo_bytes = encode_photo(cutout)
+    frame = main.template_engine.get_frame(template_key)
+
+    # RSS is sampled while the case runs; its peak over the RSS at the start
+    # is this case's own working set (ru_maxrss only ever grows across cases)
+    gc.collect()
+    memory_watch = main.JobMemoryWatch(budget_bytes=float('inf'), interval=0.005)
+    memory = memory_watch.start('bench')
+
+    stages = {}
+
+    samples, _ = time_stage(lambda: main.resize_to_height(cutout, int(frame.size[1] * 0.40)), iterations)
+    stages['resize_to_height'] = summarize(samples)
+
+    samples, _ = time_stage(lambda: main.simple_background_removal(photo_bytes), iterations)
+    stages['simple_background_removal'] = summarize(samples)
+
+    samples, result_image = time_stage(lambda: main.apply_template(template_key, cutout), iterations)
+    stages['compose'] = summarize(samples)
+
+    def save_png():
+        img_byte_arr = BytesIO()
+        result_image.save(img_byte_arr, format='PNG', optimize=True, quality=95)
+        return img_byte_arr.getbuffer().nbytes
+
+    samples, output_size = time_stage(save_png, iterations)
+    stages['png_save'] = summarize(samples)
+
+    memory_watch.finish(memory)
+
+    return {
+        'template': template_key,
+        'megapixels': megapixels,
+        'input_size': list(cutout.size),
+        'stages': stages,
+        'output_bytes': output_size,
+        'peak_rss_increase_mb': memory.peak_increase / (1024 * 1024),
+    }
+
+
+def case_key(case):
+    return f"{case['template']}@{case['megapixels']}MP"
+
+
+def print_report(cases, baseline, threshold):
+    """Print a table of stage latencies and flag regressions against the baseline"""
+    regressions = []
+
+    print(f"{'case':<22}{'stage':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'baseline':>10}")
+    print("-" * 90)
+    for case in cases:
+        key = case_key(case)
+        base_stages = baseline.get(key, {}).get('stages', {})
+        for stage, stats in case['stages'].items():
+            base_p50 = base_stages.get(stage, {}).get('p50_ms')
+            marker = ''
+            if base_p50:
+                change = (stats['p50_ms'] - base_p50) / base_p50
+                marker = f"{change:+.0%}"
+                if change > threshold:
+                    marker += ' ⚠️'
+                    regressions.append((key, stage, base_p50, stats['p50_ms']))
+            print(f"{key:<22}{stage:<28}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+                  f"{stats['p99_ms']:>10.1f}{marker:>10}")
+        print(f"{'':<22}{'output PNG':<28}{case['output_bytes'] / 1024:>9.0f}K"
+              f"{'peak RSS':>12}{case['peak_rss_increase_mb']:>+8.0f}MB")
+
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', default=','.join(str(r) for r in DEFAULT_RESOLUTIONS),
+                        help='comma separated input sizes in megapixels')
+    parser.add_argument('--templates', default=','.join(main.TEMPLATES),
+                        help='comma separated template keys')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help='p50 slowdown (fraction) reported as a regression')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    main.create_sample_files()
+    main.template_engine.warm_up()
+
+    resolutions = [float(r) for r in args.resolutions.split(',')]
+    templates = args.templates.split(',')
+
+    cases = []
+    for megapixels in resolutions:
+        for template_key in templates:
+            cases.append(run_case(template_key, megapixels, args.iterations))
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    regressions = print_report(cases, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({case_key(case): case for case in cases}, f, indent=2)
+        print(f"\n✅ Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"\n⚠️ {len(regressions)} stage(s) slower than baseline by more than {args.threshold:.0%}:")
+        for key, stage, before, after in regressions:
+            print(f"   {key} {stage}: {before:.1f} ms -> {after:.1f} ms")
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
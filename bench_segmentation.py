@@ -0,0 +1,199 @@
+"""Segmentation benchmark: FP32 against int8 quantized rembg models.
+
+Runs each model variant in its own fresh process on the same fixed image
+set and reports load time, per image latency, peak RSS and mask quality.
+Quality is the IoU and mean alpha difference against the first variant
+(the FP32 reference), and against the true mask where one is known.
+
+Images come from --images (a directory of JPEG/PNG files, read in name
+order) or, by default, a fixed set of synthetic portraits with known masks.
+The int8 variants are read from the warm bundle, so build it first.
+
+Usage:
+    python build_warm_bundle.py --models u2net
+    python bench_segmentation.py
+    python bench_segmentation.py --models u2netp,u2netp-int8 --images photos/
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+# Warm bundle paths are relative to the bot's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODELS = ['u2net', 'u2net-int8']
+SYNTHETIC_IMAGES = 8
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def make_portrait(seed, width=600, height=800):
+    """A synthetic head and shoulders photo over a busy background, and its true mask"""
+    rng = np.random.default_rng(seed)
+
+    def color():
+        return tuple(int(c) for c in rng.integers(0, 256, 3))
+
+    # Two tone gradient with a few shapes on it
+    ramp = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    top, bottom = rng.integers(60, 230, (2, 3))
+    pixels = np.broadcast_to(top * (1 - ramp) + bottom * ramp, (height, width, 3))
+    background = Image.fromarray(pixels.astype(np.uint8), 'RGB')
+    draw = ImageDraw.Draw(background)
+    for _ in range(4):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        draw.rectangle([x, y, x + rng.integers(40, 200), y + rng.integers(40, 200)], fill=color())
+
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    center = width * rng.uniform(0.4, 0.6)
+    draw.ellipse([center - width * 0.17, height * 0.1, center + width * 0.17, height * 0.42], fill=255)
+    draw.rectangle([center - width * 0.07, height * 0.38, center + width * 0.07, height * 0.5], fill=255)
+    draw.rounded_rectangle([center - width * 0.4, height * 0.47, center + width * 0.4, height + 50],
+                           radius=width // 5, fill=255)
+
+    # Skin above the collar, clothes below
+    person = Image.new('RGB', (width, height), color())
+    person.paste(tuple(int(c) for c in rng.integers(90, 220, 3)), (0, 0, width, int(height * 0.47)))
+
+    photo = Image.composite(person, background, mask.filter(ImageFilter.GaussianBlur(1)))
+    noisy = np.asarray(photo, dtype=np.float32) + rng.normal(0, 6, (height, width, 3))
+    return Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8), 'RGB'), mask
+
+
+def load_images(directory):
+    """[(name, RGB image, true mask or None)] from a directory, or the synthetic set"""
+    if not directory:
+        return [(f"synthetic-{seed}", *make_portrait(seed)) for seed in range(SYNTHETIC_IMAGES)]
+
+    images = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            with Image.open(os.path.join(directory, file_name)) as img:
+                images.append((file_name, img.convert('RGB'), None))
+    return images
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_variant(model_name, images, iterations):
+    """Load one model and segment every image (runs in its own process)"""
+    import bg_backends
+
+    model_path = bg_backends.bundled_model_path(model_name)
+    backend = bg_backends.RembgBackend(model_name)
+    if backend.quantized and not model_path:
+        raise Exception(f"{model_name} is not in the warm bundle - run build_warm_bundle.py")
+
+    start = time.perf_counter()
+    session = backend.get_session()
+    load_seconds = time.perf_counter() - start
+    if session is None:
+        raise Exception(f"rembg {model_name} could not be loaded")
+
+    samples = []
+    masks = []
+    for _, img, _ in images:
+        mask = session.predict(img)[0]  # first run per image is not timed
+        for _ in range(iterations):
+            start = time.perf_counter()
+            session.predict(img)
+            samples.append(time.perf_counter() - start)
+        masks.append(np.asarray(mask))
+
+    return {
+        'model': model_name,
+        'model_mb': os.path.getsize(model_path) / (1024 * 1024) if model_path else None,
+        'load_seconds': load_seconds,
+        'samples': samples,
+        'peak_rss_mb': peak_rss_mb(),
+        'masks': masks,
+    }
+
+
+def iou(mask, reference):
+    """Intersection over union of two masks cut at half opacity"""
+    a, b = mask > 127, reference > 127
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def alpha_difference(mask, reference):
+    """Mean absolute alpha difference, 0-255"""
+    return float(np.abs(mask.astype(np.int16) - reference.astype(np.int16)).mean())
+
+
+def print_report(results, images):
+    reference = results[0]
+    truths = [np.asarray(truth) for _, _, truth in images]
+    has_truth = all(truth is not None for _, _, truth in images)
+
+    print(f"{'model':<18}{'size MB':>9}{'load s':>8}{'p50 ms':>9}{'p95 ms':>9}{'RSS MB':>9}"
+          f"{'IoU ref':>9}{'|d| ref':>9}" + (f"{'IoU true':>10}" if has_truth else ''))
+    print("-" * (80 if has_truth else 70))
+    for result in results:
+        masks = result['masks']
+        size = f"{result['model_mb']:.1f}" if result['model_mb'] else '-'
+        line = (f"{result['model']:<18}{size:>9}{result['load_seconds']:>8.2f}"
+                f"{np.percentile(result['samples'], 50) * 1000:>9.1f}"
+                f"{np.percentile(result['samples'], 95) * 1000:>9.1f}{result['peak_rss_mb']:>9.0f}"
+                f"{np.mean([iou(m, r) for m, r in zip(masks, reference['masks'])]):>9.3f}"
+                f"{np.mean([alpha_difference(m, r) for m, r in zip(masks, reference['masks'])]):>9.2f}")
+        if has_truth:
+            line += f"{np.mean([iou(m, t) for m, t in zip(masks, truths)]):>10.3f}"
+        print(line)
+
+    # Images where a variant drifts furthest from the reference
+    for result in results[1:]:
+        scores = [iou(m, r) for m, r in zip(result['masks'], reference['masks'])]
+        worst = int(np.argmin(scores))
+        print(f"\n{result['model']}: lowest IoU against {reference['model']} is "
+              f"{scores[worst]:.3f} on {images[worst][0]}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS),
+                        help='comma separated rembg models, the first one is the reference')
+    parser.add_argument('--images', help='directory of photos (default: synthetic portraits)')
+    parser.add_argument('--iterations', type=int, default=3, help='timed runs per image')
+    args = parser.parse_args()
+
+    # Time the model itself, one image at a time (inherited by the model processes)
+    os.environ['BG_BATCH_SIZE'] = '1'
+
+    images = load_images(args.images)
+    if not images:
+        print(f"⚠️ No images in {args.images}")
+        return 1
+    print(f"🧪 {len(images)} images, {args.iterations} timed runs each\n")
+
+    # A fresh process per model, so RSS and load time aren't shared
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for model_name in args.models.split(','):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                results.append(executor.submit(run_variant, model_name, images, args.iterations).result())
+            except Exception as e:
+                print(f"⚠️ {model_name}: {e}")
+
+    if not results:
+        return 1
+    print_report(results, images)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,776 @@
+"""Background removal backends shared by the SelamSnap bots.
+
+Every bot picks its backends from the environment:
+
+    BG_BACKENDS=removebg,rembg:u2netp,threshold   # candidates, in preference order
+    BG_ROUTING=ordered                            # ordered, fastest or cheapest
+
+Backends are registered by name (``rembg`` and ``threshold`` here, ``removebg``
+by main.py, which owns the API keys and credit tracking). An option after
+the colon is passed to the backend's factory, e.g. the rembg model name.
+``rembg:u2net-int8`` selects the int8 quantized model that
+build_warm_bundle.py writes next to the FP32 one.
+
+BackgroundRouter tries the candidates in policy order and times every call
+the same way, keeping a moving average of each backend's latency. A backend
+that fails several times in a row is skipped for a while; paid backends
+(cost > 0) can be excluded per call, e.g. when the credit scheduler holds
+the credit back.
+"""
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from io import BytesIO
+
+# numpy and Pillow are imported where they are used, so importing this
+# module doesn't slow down a bot's start
+
+logger = logging.getLogger(__name__)
+
+# Optimized ONNX models written by build_warm_bundle.py
+WARM_BUNDLE_DIR = os.getenv('WARM_BUNDLE_DIR', 'warm_bundle')
+
+ROUTING_POLICIES = ('ordered', 'fastest', 'cheapest')
+
+FAILURES_BEFORE_BACKOFF = 3  # consecutive failures before a backend is skipped
+FAILURE_BACKOFF = 60  # seconds a failing backend is skipped
+LATENCY_SMOOTHING = 0.2  # weight of the newest sample in the latency average
+
+# Concurrent rembg segmentations are run as one ONNX batch
+SEGMENTATION_BATCH_SIZE = int(os.getenv('BG_BATCH_SIZE', '8'))  # 1 disables batching
+SEGMENTATION_BATCH_WINDOW = float(os.getenv('BG_BATCH_WINDOW_MS', '25')) / 1000  # longest wait for a batch to fill
+# U2-Net family models share their pre-processing, so their inputs can be stacked
+U2NET_MODELS = ('u2net', 'u2netp', 'u2net_human_seg', 'u2net_custom', 'silueta')
+# Model name suffix of the int8 quantized variants in the warm bundle
+QUANTIZED_SUFFIX = '-int8'
+
+# Local matting works on a copy reduced to about this size (longest side)
+MATTE_WORK_SIZE = 400
+MATTE_BORDER = 0.04  # border strip sampled for background colors, fraction of the side
+MATTE_BACKGROUND_COLORS = 4  # k-means clusters over the border strip
+MATTE_MAX_SAMPLES = 2000  # border pixels used for clustering
+MATTE_MIN_DISTANCE = 12.0  # Lab distance always treated as background
+MATTE_RAMP = 10.0  # Lab distance over which alpha goes from 0 to 255
+MATTE_FEATHER = 1.5  # Gaussian radius of the alpha edge, in work pixels
+
+# rembg's alpha matting only runs where the segmentation mask is unsure
+MATTING_FOREGROUND_THRESHOLD = 240
+MATTING_BACKGROUND_THRESHOLD = 10
+MATTING_ERODE_SIZE = 10  # pixels of the trimap's unknown band, like rembg's alpha_matting_erode_size
+MATTING_MODEL_SIZE = 320  # resolution the mask really has (U2-Net output)
+MATTING_MIN_BAND = int(os.getenv('BG_MATTING_MIN_BAND', '24'))  # wide uncertain mask pixels, at model size, worth matting
+MATTING_CONTEXT = 0.03  # photo around the band given to the matting solver, fraction of the longest side
+GUIDED_WORK_SIZE = 640  # the guided filter's coefficients are computed at about this size
+GUIDED_RADIUS = 4  # in work pixels
+GUIDED_EPS = 1e-4  # edge sensitivity; smaller follows weaker photo edges
+
+
+def load_image(image_source):
+    """Open an upload's path or bytes"""
+    from PIL import Image
+    if isinstance(image_source, (bytes, bytearray)):
+        image_source = BytesIO(image_source)
+    return Image.open(image_source)
+
+
+def bundled_model_path(model_name):
+    """Path of the warm bundle's optimized model, if built for this onnxruntime
+
+    Bundles from before the models were saved at the basic (portable)
+    optimization level may hold graphs fused for the build machine's CPU,
+    so they are ignored.
+    """
+    try:
+        manifest_path = os.path.join(WARM_BUNDLE_DIR, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            entry = json.load(f).get('models', {}).get(model_name)
+        if not entry:
+            return None
+
+        import onnxruntime
+        path = os.path.join(WARM_BUNDLE_DIR, entry['file'])
+        if (entry.get('onnxruntime') == onnxruntime.__version__ and entry.get('optimization') == 'basic'
+                and os.path.exists(path)):
+            return path
+    except Exception as e:
+        logger.error(f"Error reading warm bundle: {e}")
+    return None
+
+
+# ============================================================================
+# BACKENDS
+# ============================================================================
+
+class BackgroundBackend:
+    """A way to cut the person out of a photo
+
+    remove() takes an upload's path or bytes and returns an RGBA image.
+    cost is what one image costs (remove.bg credits), expected_latency the
+    guess in seconds used until the backend has been measured.
+    """
+    name = 'backend'
+    cost = 0
+    expected_latency = 1.0
+
+    def available(self):
+        """Whether the backend can take a request right now"""
+        return True
+
+    def warm_up(self):
+        """Load models or sessions ahead of the first request"""
+
+    def remove(self, image_source):
+        raise NotImplementedError
+
+
+class FunctionBackend(BackgroundBackend):
+    """Backend around a plain function, for backends that live in a bot module"""
+    def __init__(self, name, func, cost=0, expected_latency=1.0, available=None):
+        self.name = name
+        self.func = func
+        self.cost = cost
+        self.expected_latency = expected_latency
+        self.is_available = available
+
+    def available(self):
+        return self.is_available() if self.is_available else True
+
+    def remove(self, image_source):
+        return self.func(image_source)
+
+
+class SegmentationBatcher:
+    """Run concurrent U2-Net segmentations as one batched ONNX inference
+
+    Stands in for a rembg session: rembg.remove() calls predict() from the
+    worker threads, which pre-process their image and queue the tensor. One
+    thread collects queued tensors while other callers are still
+    pre-processing (for at most max_wait seconds, max_batch images), runs
+    the model once on the stack and hands every caller its own mask.
+    """
+    MEAN = (0.485, 0.456, 0.406)
+    STD = (0.229, 0.224, 0.225)
+    SIZE = (320, 320)
+
+    def __init__(self, session, max_batch=SEGMENTATION_BATCH_SIZE, max_wait=SEGMENTATION_BATCH_WINDOW):
+        self.session = session
+        self.input_name = session.inner_session.get_inputs()[0].name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.preparing = 0  # callers still pre-processing their image
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        threading.Thread(target=self.run, name='segmentation-batcher', daemon=True).start()
+
+    def predict(self, img, *args, **kwargs):
+        """Segment one image; same result as the U2-Net sessions' predict()"""
+        import numpy as np
+        from PIL import Image
+
+        with self.lock:
+            self.preparing += 1
+        try:
+            tensor = self.session.normalize(img, self.MEAN, self.STD, self.SIZE)[self.input_name]
+            future = Future()
+            self.requests.put((tensor, future))
+        finally:
+            with self.lock:
+                self.preparing -= 1
+        pred = future.result()
+
+        low, high = pred.min(), pred.max()
+        pred = (pred - low) / max(high - low, 1e-6)
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype('uint8'), mode='L')
+        return [mask.resize(img.size, Image.Resampling.LANCZOS)]
+
+    def collect(self):
+        """Wait for a request, then gather more while other callers are about to queue theirs"""
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            with self.lock:
+                waiting_for_more = self.preparing > 0
+            if remaining <= 0 or not waiting_for_more:
+                break
+            try:
+                batch.append(self.requests.get(timeout=min(remaining, 0.005)))
+            except queue.Empty:
+                pass
+        return batch
+
+    def run(self):
+        import numpy as np
+
+        while True:
+            batch = self.collect()
+            try:
+                stacked = np.concatenate([tensor for tensor, _ in batch])
+                outputs = self.session.inner_session.run(None, {self.input_name: stacked})[0][:, 0]
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.images += len(batch)
+            for (_, future), pred in zip(batch, outputs):
+                future.set_result(pred)
+
+
+def segmentation_batcher(session, max_batch=SEGMENTATION_BATCH_SIZE):
+    """SegmentationBatcher for a rembg session, or None if its predict() should be called directly"""
+    if not hasattr(session, 'inner_session') or not hasattr(session, 'normalize'):
+        logger.warning(f"⚠️ {type(session).__name__} has no inner_session/normalize - segmentation is not batched")
+        return None
+
+    # Models exported with a fixed batch size can't take more than that
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int):
+        max_batch = min(max_batch, batch_dim)
+    if max_batch <= 1:
+        logger.warning(f"⚠️ Model batch size is fixed at {batch_dim} - segmentation is not batched")
+        return None
+
+    return SegmentationBatcher(session, max_batch)
+
+
+class RembgBackend(BackgroundBackend):
+    """Local U2-Net segmentation through rembg
+
+    rembg (onnxruntime, scipy, numba and the model) takes a long time to
+    load, so the session is created by warm_up() or on first use. A model
+    name ending in -int8 loads the quantized copy from the warm bundle and
+    falls back to the FP32 model if the bundle doesn't have it. With
+    alpha_matting the mask goes through adaptive_matting_cutout().
+    """
+    cost = 0
+    expected_latency = 3.0
+
+    def __init__(self, model_name='u2net', opener=load_image, alpha_matting=True):
+        self.name = f"rembg:{model_name}"
+        self.model_name = model_name
+        self.quantized = model_name.endswith(QUANTIZED_SUFFIX)
+        self.base_model = model_name[:-len(QUANTIZED_SUFFIX)] if self.quantized else model_name
+        self.opener = opener
+        self.alpha_matting = alpha_matting
+        self.session = None
+        self.batcher = None
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        """Import rembg and create its session once (None if rembg can't load)"""
+        with self.lock:
+            if self.session is None and not self.failed:
+                try:
+                    from rembg import new_session
+                    model_path = bundled_model_path(self.model_name)
+                    if not model_path and self.quantized:
+                        logger.warning(f"⚠️ {self.model_name} is not in the warm bundle - using FP32 {self.base_model}")
+                        model_path = bundled_model_path(self.base_model)
+                    if model_path:
+                        # Same pre/post-processing as the stock model, graph already optimized
+                        self.session = new_session('u2net_custom', model_path=model_path)
+                    else:
+                        self.session = new_session(self.base_model)
+                    if self.base_model in U2NET_MODELS and SEGMENTATION_BATCH_SIZE > 1:
+                        self.batcher = segmentation_batcher(self.session)
+                    logger.info(f"✅ rembg {self.model_name} session ready")
+                except Exception as e:
+                    logger.error(f"Error loading rembg {self.model_name}: {e}")
+                    self.failed = True
+        return self.session
+
+    def available(self):
+        return not self.failed
+
+    def warm_up(self):
+        self.get_session()
+
+    def remove(self, image_source):
+        session = self.get_session()
+        if session is None:
+            raise Exception(f"rembg {self.model_name} is not available")
+
+        img = self.opener(image_source).convert('RGB')
+        mask = (self.batcher or session).predict(img)[0]
+        if self.alpha_matting:
+            return adaptive_matting_cutout(img, mask)
+
+        cutout = img.convert('RGBA')
+        cutout.putalpha(mask)
+        return cutout
+
+
+def box_filter(values, radius):
+    """Mean over a (2 * radius + 1) square around every pixel, edges repeated"""
+    import numpy as np
+
+    size = 2 * radius + 1
+    padded = np.pad(values, radius + 1, mode='edge')
+    sums = np.cumsum(padded, axis=0)
+    sums = sums[size:] - sums[:-size]
+    sums = np.cumsum(sums, axis=1)
+    sums = sums[:, size:] - sums[:, :-size]
+    return sums[:values.shape[0], :values.shape[1]] / (size * size)
+
+
+def guided_filter(img, mask):
+    """Snap a soft mask's edges to the photo's edges (fast guided filter, color guide)
+
+    The filter's linear coefficients are computed on a copy reduced to about
+    GUIDED_WORK_SIZE and upsampled, and only the box around the mask's edges
+    is filtered at full size, so the cost barely depends on the photo's
+    size. Returns alpha as a float32 array, 0-1.
+    """
+    import numpy as np
+    from PIL import Image
+
+    alpha = np.asarray(mask, dtype=np.float32) / 255.0
+    factor = max(1, max(img.size) // GUIDED_WORK_SIZE)
+    small_mask = np.asarray(mask.reduce(factor) if factor > 1 else mask)
+    edge = morphology((small_mask > 0) & (small_mask < 255), 2 * GUIDED_RADIUS, grow=True)
+    if not edge.any():
+        return alpha
+
+    rows = np.flatnonzero(edge.any(axis=1))
+    columns = np.flatnonzero(edge.any(axis=0))
+    left, top = columns[0] * factor, rows[0] * factor
+    right, bottom = min(img.width, (columns[-1] + 1) * factor), min(img.height, (rows[-1] + 1) * factor)
+    box = (left, top, right, bottom)
+    crop = img.crop(box)
+    mask_crop = mask.crop(box)
+    guide = np.asarray(crop.reduce(factor) if factor > 1 else crop, dtype=np.float32) / 255.0
+    target = np.asarray(mask_crop.reduce(factor) if factor > 1 else mask_crop, dtype=np.float32) / 255.0
+    r = GUIDED_RADIUS
+    mean = [box_filter(guide[..., c], r) for c in range(3)]
+    mean_target = box_filter(target, r)
+    covariance = [box_filter(guide[..., c] * target, r) - mean[c] * mean_target for c in range(3)]
+    # Per pixel 3x3 color covariance, regularized and inverted by cofactors
+    sigma = {}
+    for i in range(3):
+        for j in range(i, 3):
+            sigma[i, j] = sigma[j, i] = (box_filter(guide[..., i] * guide[..., j], r) - mean[i] * mean[j]
+                                         + (GUIDED_EPS if i == j else 0.0))
+    inverse = {}
+    for i in range(3):
+        for j in range(3):
+            (r0, r1), (c0, c1) = [k for k in range(3) if k != j], [k for k in range(3) if k != i]
+            inverse[i, j] = (-1) ** (i + j) * (sigma[r0, c0] * sigma[r1, c1] - sigma[r0, c1] * sigma[r1, c0])
+    determinant = sum(sigma[0, k] * inverse[k, 0] for k in range(3))
+    slopes = [sum(inverse[c, k] * covariance[k] for k in range(3)) / determinant for c in range(3)]
+    offset = mean_target - sum(slopes[c] * mean[c] for c in range(3))
+
+    def full_size(coefficients):
+        smoothed = box_filter(coefficients, r).astype(np.float32)
+        return np.asarray(Image.fromarray(smoothed, 'F').resize(crop.size, Image.Resampling.BILINEAR))
+
+    pixels = np.asarray(crop, dtype=np.float32) / 255.0
+    refined = full_size(offset).copy()
+    for c in range(3):
+        refined += full_size(slopes[c]) * pixels[..., c]
+
+    # Only the mask's soft pixels are refined; solid ones would pick up halos
+    alpha = alpha.copy()
+    region = alpha[top:bottom, left:right]
+    soft = (region > 0) & (region < 1)
+    region[soft] = np.clip(refined[soft], 0.0, 1.0)
+    return alpha
+
+
+def uncertain_band(mask):
+    """Box (left, top, right, bottom) around the wide uncertain parts of the mask, or None
+
+    Measured at the model's resolution: a clean edge is unsure for a pixel
+    or two, hair and other fuzzy outlines for many more. Bands no wider
+    than four pixels are ignored, and so is the rest when it adds up to
+    less than MATTING_MIN_BAND pixels.
+    """
+    import numpy as np
+
+    factor = max(1, max(mask.size) // MATTING_MODEL_SIZE)
+    small = np.asarray(mask.reduce(factor) if factor > 1 else mask)
+    uncertain = (small > MATTING_BACKGROUND_THRESHOLD) & (small < MATTING_FOREGROUND_THRESHOLD)
+    band = morphology(uncertain, 2, grow=False)
+    if band.sum() < MATTING_MIN_BAND:
+        return None
+
+    rows = np.flatnonzero(band.any(axis=1))
+    columns = np.flatnonzero(band.any(axis=0))
+    return (columns[0] * factor, rows[0] * factor, (columns[-1] + 1) * factor, (rows[-1] + 1) * factor)
+
+
+def closed_form_matting(rgb, mask):
+    """rembg's alpha matting on a crop: (foreground, alpha) float arrays, or None without a usable trimap"""
+    import numpy as np
+    from pymatting import estimate_alpha_cf, estimate_foreground_ml
+
+    is_foreground = morphology(mask > MATTING_FOREGROUND_THRESHOLD, MATTING_ERODE_SIZE // 2, grow=False)
+    is_background = ~morphology(mask >= MATTING_BACKGROUND_THRESHOLD, MATTING_ERODE_SIZE // 2, grow=True)
+    if not is_foreground.any() or not is_background.any():
+        return None
+
+    trimap = np.full(mask.shape, 0.5)
+    trimap[is_foreground] = 1.0
+    trimap[is_background] = 0.0
+    image = rgb / 255.0
+    try:
+        alpha = estimate_alpha_cf(image, trimap)
+    except ValueError:
+        return None
+    return estimate_foreground_ml(image, alpha), alpha
+
+
+def adaptive_matting_cutout(img, mask):
+    """Cut the person out of an RGB photo with its segmentation mask, matting only where it is unsure
+
+    rembg's alpha matting solves PyMatting's closed form matte over the
+    whole photo. Here it runs on the box around the wide uncertain band
+    (hair, fuzzy clothing) only; every other edge, and every edge when
+    that band is tiny, is refined with the much cheaper guided filter.
+    """
+    import numpy as np
+    from PIL import Image
+
+    alpha = guided_filter(img, mask)
+    rgb = np.array(img)
+
+    box = uncertain_band(mask)
+    if box is not None:
+        # The solver needs some sure foreground and background around the band
+        context = MATTING_ERODE_SIZE + int(max(img.size) * MATTING_CONTEXT)
+        left, top = max(0, box[0] - context), max(0, box[1] - context)
+        right, bottom = min(img.width, box[2] + context), min(img.height, box[3] + context)
+        result = closed_form_matting(rgb[top:bottom, left:right], np.asarray(mask)[top:bottom, left:right])
+        if result is not None:
+            foreground, crop_alpha = result
+            rgb[top:bottom, left:right] = np.clip(foreground * 255.0 + 0.5, 0, 255).astype(np.uint8)
+            alpha[top:bottom, left:right] = crop_alpha
+        logger.debug(f"Matted {right - left}x{bottom - top} of {img.width}x{img.height}")
+
+    return Image.fromarray(np.dstack([rgb, (alpha * 255.0 + 0.5).astype(np.uint8)]), 'RGBA')
+
+
+def srgb_to_lab(rgb):
+    """Convert an (..., 3) uint8 sRGB array to CIE Lab (D65) as float32"""
+    import numpy as np
+
+    c = rgb.astype(np.float32) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([
+        [0.4124 / 0.95047, 0.2126, 0.0193 / 1.08883],
+        [0.3576 / 0.95047, 0.7152, 0.1192 / 1.08883],
+        [0.1805 / 0.95047, 0.0722, 0.9505 / 1.08883],
+    ], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    return np.stack([
+        116.0 * f[..., 1] - 16.0,
+        500.0 * (f[..., 0] - f[..., 1]),
+        200.0 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+
+def border_samples(lab):
+    """Lab pixels along the top and the upper sides, where portraits show background
+
+    The bottom edge is left out: the person's body usually runs off it.
+    """
+    import numpy as np
+
+    h, w = lab.shape[:2]
+    strip = max(2, int(round(max(h, w) * MATTE_BORDER)))
+    side_height = h * 2 // 3
+    samples = np.concatenate([
+        lab[:strip].reshape(-1, 3),
+        lab[strip:side_height, :strip].reshape(-1, 3),
+        lab[strip:side_height, -strip:].reshape(-1, 3),
+    ])
+    step = max(1, len(samples) // MATTE_MAX_SAMPLES)
+    return samples[::step]
+
+
+def background_colors(samples, iterations=8):
+    """Cluster the border samples into a few background colors (k-means)"""
+    import numpy as np
+
+    k = min(MATTE_BACKGROUND_COLORS, len(samples))
+    # Deterministic start: spread over the samples sorted by lightness
+    order = np.argsort(samples[:, 0])
+    centers = samples[order[np.linspace(0, len(samples) - 1, k).astype(int)]].copy()
+    for _ in range(iterations):
+        labels = ((samples[:, None, :] - centers[None]) ** 2).sum(-1).argmin(1)
+        for i in range(k):
+            members = samples[labels == i]
+            if len(members):
+                centers[i] = members.mean(0)
+
+    # Distance of each border sample to its color tells how noisy that background is
+    distances = np.sqrt(((samples[:, None, :] - centers[None]) ** 2).sum(-1))
+    labels = distances.argmin(1)
+    spread = np.array([
+        np.percentile(distances[labels == i, i], 95) if np.any(labels == i) else 0.0
+        for i in range(k)
+    ], dtype=np.float32)
+    return centers, spread
+
+
+def morphology(mask, radius, grow):
+    """Binary dilation (grow) or erosion with a square of the given radius, separably"""
+    import numpy as np
+
+    op = np.logical_or if grow else np.logical_and
+    h, w = mask.shape
+    padded = np.pad(mask, radius, constant_values=not grow)
+    rows = padded[:, radius:radius + w].copy()
+    for offset in range(2 * radius + 1):
+        op(rows, padded[:, offset:offset + w], out=rows)
+    result = rows[radius:radius + h].copy()
+    for offset in range(2 * radius + 1):
+        op(result, rows[offset:offset + h], out=result)
+    return result
+
+
+def matte_alpha(rgb):
+    """Alpha matte (float32, 0-1) of the person in a small uint8 RGB array"""
+    import numpy as np
+
+    lab = srgb_to_lab(rgb)
+    centers, spread = background_colors(border_samples(lab))
+
+    # Distance to the nearest background color, less that color's own noise
+    thresholds = np.maximum(spread * 1.5, MATTE_MIN_DISTANCE)
+    squared_norms = (lab * lab).sum(-1)
+    excess = None
+    for center, threshold in zip(centers, thresholds):
+        squared = squared_norms - 2.0 * (lab @ center) + float(center @ center)
+        distance = np.sqrt(np.maximum(squared, 0.0)) - threshold
+        excess = distance if excess is None else np.minimum(excess, distance)
+    soft = np.clip(excess / MATTE_RAMP + 0.5, 0.0, 1.0)
+
+    # Background is what a straight line from the top or a side reaches through
+    # background colored pixels; anything enclosed by the person is kept
+    solid = soft >= 0.5
+    solid = morphology(morphology(solid, 1, grow=False), 1, grow=True)  # drop specks
+    blocked_above = np.maximum.accumulate(solid, axis=0)
+    blocked_left = np.maximum.accumulate(solid, axis=1)
+    blocked_right = np.maximum.accumulate(solid[:, ::-1], axis=1)[:, ::-1]
+    person = blocked_above & blocked_left & blocked_right
+    person = morphology(morphology(person, 2, grow=True), 2, grow=False)  # close small gaps
+
+    # Soft edges only along the person's outline
+    edge = morphology(person, 1, grow=True) & ~morphology(person, 1, grow=False)
+    return np.where(edge, soft, person.astype(np.float32)).astype(np.float32)
+
+
+def threshold_cutout(img):
+    """Local background removal on an already opened image
+
+    The background colors are estimated from the image border and every
+    pixel's Lab distance to them is thresholded into a matte. That matte is
+    cleaned up morphologically and feathered. It is computed on a copy
+    reduced to about MATTE_WORK_SIZE pixels and upsampled, so the cost
+    barely depends on the photo's size. Images that already have
+    transparency keep their own alpha.
+    """
+    import numpy as np
+    from PIL import Image, ImageFilter
+
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        alpha = img.getchannel('A')
+        if alpha.getextrema()[0] < 250:
+            bbox = alpha.getbbox()
+            return img.crop(bbox) if bbox else img
+
+    rgb = img.convert('RGB')
+    factor = max(1, max(rgb.size) // MATTE_WORK_SIZE)
+    work = rgb.reduce(factor) if factor > 1 else rgb
+
+    alpha = matte_alpha(np.asarray(work))
+    matte = Image.fromarray((alpha * 255.0 + 0.5).astype(np.uint8), 'L')
+    matte = matte.filter(ImageFilter.GaussianBlur(MATTE_FEATHER))
+
+    # Crop to the person, like the Remove.bg result, and only upsample that part of the matte
+    small_bbox = matte.point(lambda value: 255 if value > 8 else 0).getbbox()
+    if not small_bbox:
+        return Image.new('RGBA', rgb.size, (0, 0, 0, 0))
+    scale_x, scale_y = rgb.width / matte.width, rgb.height / matte.height
+    bbox = (
+        int(small_bbox[0] * scale_x), int(small_bbox[1] * scale_y),
+        min(rgb.width, int(small_bbox[2] * scale_x + 0.5)), min(rgb.height, int(small_bbox[3] * scale_y + 0.5)),
+    )
+    region = (bbox[0] / scale_x, bbox[1] / scale_y, bbox[2] / scale_x, bbox[3] / scale_y)
+
+    result = rgb.crop(bbox).convert('RGBA')
+    result.putalpha(matte.resize(result.size, Image.Resampling.BILINEAR, box=region))
+    return result
+
+
+class ThresholdBackend(BackgroundBackend):
+    """CPU-only fallback that needs no model and never fails for lack of credits"""
+    name = 'threshold'
+    cost = 0
+    expected_latency = 0.1
+
+    def __init__(self, opener=load_image):
+        self.opener = opener
+
+    def remove(self, image_source):
+        return threshold_cutout(self.opener(image_source))
+
+
+# ============================================================================
+# REGISTRY
+# ============================================================================
+
+# name -> factory(option, opener) returning a backend
+BACKEND_FACTORIES = {}
+
+
+def register_backend(name, factory):
+    """Make a backend selectable in BG_BACKENDS"""
+    BACKEND_FACTORIES[name] = factory
+
+
+register_backend('rembg', lambda option, opener: RembgBackend(option or 'u2net', opener))
+register_backend('threshold', lambda option, opener: ThresholdBackend(opener))
+
+
+def create_backends(specs, opener=load_image):
+    """Build backends from a comma separated spec like 'removebg,rembg:u2netp,threshold'"""
+    backends = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        name, _, option = spec.partition(':')
+        factory = BACKEND_FACTORIES.get(name)
+        if not factory:
+            logger.error(f"Unknown background backend '{name}' - skipped")
+            continue
+        backends.append(factory(option or None, opener))
+    return backends
+
+
+# ============================================================================
+# ROUTING
+# ============================================================================
+
+class BackendStats:
+    """Measured latency and health of one backend"""
+    def __init__(self, expected_latency):
+        self.latency = expected_latency
+        self.calls = 0
+        self.failures = 0  # consecutive
+        self.skip_until = 0.0
+
+
+class BackgroundRouter:
+    """Send each photo to the best available backend, falling over to the next
+
+    observer, if given, is called as observer(backend_name, seconds, ok)
+    after every attempt.
+    """
+    def __init__(self, backends, policy='ordered', observer=None):
+        if policy not in ROUTING_POLICIES:
+            logger.error(f"Unknown routing policy '{policy}' - using 'ordered'")
+            policy = 'ordered'
+        self.backends = list(backends)
+        self.policy = policy
+        self.observer = observer
+        self.stats = {backend.name: BackendStats(backend.expected_latency) for backend in self.backends}
+        self.lock = threading.Lock()
+
+    def candidates(self, allow_paid=True):
+        """Usable backends in the order the policy prefers them"""
+        now = time.time()
+        with self.lock:
+            usable = [
+                backend for backend in self.backends
+                if (allow_paid or backend.cost == 0) and self.stats[backend.name].skip_until <= now
+            ]
+            latency = {backend.name: self.stats[backend.name].latency for backend in usable}
+
+        usable = [backend for backend in usable if backend.available()]
+        if self.policy == 'fastest':
+            usable.sort(key=lambda backend: (latency[backend.name], backend.cost))
+        elif self.policy == 'cheapest':
+            usable.sort(key=lambda backend: (backend.cost, latency[backend.name]))
+        return usable
+
+    def record(self, backend, seconds, ok):
+        """Update a backend's latency average and health"""
+        with self.lock:
+            stats = self.stats[backend.name]
+            stats.calls += 1
+            if ok:
+                stats.latency += LATENCY_SMOOTHING * (seconds - stats.latency)
+                stats.failures = 0
+            else:
+                stats.failures += 1
+                if stats.failures >= FAILURES_BEFORE_BACKOFF:
+                    stats.skip_until = time.time() + FAILURE_BACKOFF
+                    logger.warning(f"Background backend {backend.name} failing - skipped for {FAILURE_BACKOFF}s")
+        if self.observer:
+            self.observer(backend.name, seconds, ok)
+
+    def remove(self, image_source, allow_paid=True):
+        """Cut the person out with the first backend that succeeds: returns (image, backend name)"""
+        errors = []
+        for backend in self.candidates(allow_paid):
+            start = time.perf_counter()
+            try:
+                image = backend.remove(image_source)
+            except Exception as e:
+                self.record(backend, time.perf_counter() - start, False)
+                logger.error(f"Background backend {backend.name} failed: {e}")
+                errors.append(f"{backend.name}: {e}")
+                continue
+            self.record(backend, time.perf_counter() - start, True)
+            return image, backend.name
+
+        raise Exception("No background backend succeeded" + (f" ({'; '.join(errors)})" if errors else ""))
+
+    def warm_up(self):
+        """Load every backend's models"""
+        for backend in self.backends:
+            try:
+                backend.warm_up()
+            except Exception as e:
+                logger.error(f"Error warming up {backend.name}: {e}")
+
+    def start_warm_up(self):
+        """Warm up in a background thread so commands are answered right away"""
+        threading.Thread(target=self.warm_up, name='backend-warm-up', daemon=True).start()
+
+    def describe(self):
+        """Backend names with their measured latency, for logs and /usage"""
+        with self.lock:
+            return [
+                f"{backend.name} ~{self.stats[backend.name].latency:.2f}s"
+                + (f" ({backend.cost} credit)" if backend.cost else "")
+                for backend in self.backends
+            ]
+
+
+def router_from_env(default_backends, opener=load_image, observer=None):
+    """Router over the backends named in BG_BACKENDS, routed by BG_ROUTING"""
+    backends = create_backends(os.getenv('BG_BACKENDS', default_backends), opener)
+    if not backends:
+        logger.error("No usable backend in BG_BACKENDS - using threshold")
+        backends = [ThresholdBackend(opener)]
+    return BackgroundRouter(backends, os.getenv('BG_ROUTING', 'ordered'), observer)
@@ -1,6 +1,7 @@
 import os
 import logging
 import asyncio
+import threading
 from flask import Flask, request, jsonify
 from keep_alive import KeepAlive
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -11,8 +12,9 @@ import json
 from datetime import datetime, timedelta
 from PIL import Image, ImageDraw, ImageFilter, ImageOps, ImageFont
 from io import BytesIO
-from rembg import remove, new_session
-import numpy as np
+import bg_backends
+import inflight
+import uploads
 
 # Enable logging
 logging.basicConfig(
@@ -107,8 +109,20 @@ def get_uptime():
 # Store user data temporarily
 user_data = {}
 
-# Initialize rembg session
-session = new_session()
+# Taps on a render that is already running start nothing (see inflight.py)
+in_flight = inflight.InFlightJobs(user_data)
+
+# Background removal backends come from BG_BACKENDS (see bg_backends.py).
+# rembg takes a long time to load, so its session is created by the
+# background warm-up or on first use
+background_router = bg_backends.router_from_env('rembg:u2net,threshold')
+
+# Updates handled at once, so concurrent background removals can be batched
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '8'))
+
+async def post_init(application):
+    """Start loading the background removal models once the bot is initialized"""
+    background_router.start_warm_up()
 
 # Admin user IDs (add your admin IDs here)
 ADMIN_IDS = os.getenv('ADMIN_IDS') # Replace with your Telegram ID
@@ -411,26 +425,15 @@ def ensure_directories():
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
-def extract_human_from_image(image_bytes):
-    """Remove background and extract human using rembg"""
+def extract_human_from_image(image_source):
+    """Remove background and extract human with the configured backends"""
     try:
-        input_image = Image.open(BytesIO(image_bytes)).convert("RGBA")
-        input_array = np.array(input_image)
-        
-        output_array = remove(
-            input_array,
-            session=session,
-            alpha_matting=True,
-            alpha_matting_foreground_threshold=240,
-            alpha_matting_background_threshold=10,
-            alpha_matting_erode_size=10
-        )
-        
-        return Image.fromarray(output_array)
+        human_image, _ = background_router.remove(image_source)
+        return human_image
         
     except Exception as e:
         logger.error(f"Error extracting human: {e}")
-        return Image.open(BytesIO(image_bytes)).convert("RGBA")
+        return bg_backends.load_image(image_source).convert("RGBA")
 
 def resize_image_proportionally(image, scale_factor=0.75):
     """Resize image proportionally by scale factor"""
@@ -1009,7 +1012,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Send your photo now:",
             parse_mode='HTML'  # NO MARKDOWN
         )
-        user_data[user_id] = {'state': 'awaiting_photo'}
+        uploads.set_user_photo(user_data, user_id, {'state': 'awaiting_photo'})
     
     elif query.data == 'show_developer':
         await query.edit_message_text(
@@ -1371,12 +1374,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if photo_file:
         try:
-            photo_bytes = await photo_file.download_as_bytearray()
+            uploads.prune_uploads()
+            photo_path = await uploads.download_upload(photo_file, user_id)
             
-            user_data[user_id] = {
-                'photo_bytes': bytes(photo_bytes),
+            uploads.set_user_photo(user_data, user_id, {
+                'photo_path': photo_path,
+                'photo_hash': await asyncio.to_thread(uploads.file_digest, photo_path),
                 'state': 'selecting_template'
-            }
+            })
             
             # Show all THREE templates
             keyboard = [
@@ -1416,7 +1421,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
     
     user_info = user_data.get(user_id, {})
     
-    if not user_info or 'photo_bytes' not in user_info:
+    if not user_info or 'photo_path' not in user_info:
         await query.edit_message_text(
             "❌ No photo found. Please start again with /upload"
         )
@@ -1438,7 +1443,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
     )
     
     try:
-        photo_bytes = user_info['photo_bytes']
+        photo_path = user_info['photo_path']
         
         await processing_msg.edit_text(
             f"🔄 Processing: {template_name}\n\n"
@@ -1448,7 +1453,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
         )
         
         # Extract human
-        human_image = extract_human_from_image(photo_bytes)
+        human_image = await asyncio.to_thread(extract_human_from_image, photo_path)
         
         # Apply appropriate template
         if template_key == 'template1':
@@ -1503,7 +1508,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
         
         # Clear user data
         if user_id in user_data:
-            user_data[user_id] = {}
+            uploads.set_user_photo(user_data, user_id, {})
         
         # Show options for next step
         keyboard = [
@@ -1612,6 +1617,8 @@ def run_bot():
                 return
             # Ensure directories
             ensure_directories()
+            # Photos uploaded before a restart are never rendered
+            uploads.prune_uploads(max_age=0)
             
             # Create sample files if needed
             create_sample_files()
@@ -1654,7 +1661,7 @@ def run_bot():
             print("🤖 Starting SelamSnap Bot on Render...")
             
             # Create application
-            application = Application.builder().token(TOKEN).build()
+            application = Application.builder().token(TOKEN).post_init(post_init).concurrent_updates(CONCURRENT_UPDATES).build()
             
             application.add_error_handler(error_handler)
     
@@ -1668,7 +1675,7 @@ def run_bot():
             application.add_handler(CommandHandler("showcomments", show_comments_command))
             application.add_handler(CommandHandler("help", help_command))
             
-            application.add_handler(CallbackQueryHandler(button_handler))
+            application.add_handler(CallbackQueryHandler(in_flight.deduplicate(button_handler)))
             
             application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -0,0 +1,229 @@
+"""Build the warm bundle the bots load at startup.
+
+Writes into warm_bundle/ (or $WARM_BUNDLE_DIR):
+
+* the flattened frame of every template, for full size renders and quick
+  previews, in frames/. main.py memory-maps these read-only, so restarts
+  skip flattening and every render process shares one copy.
+* every template layer those frames are built from, decoded to a raw RGBA
+  .npy file, used instead of decoding the PNGs or regenerating the
+  procedural backgrounds when a frame has to be rebuilt.
+* rembg's ONNX models with onnxruntime's basic graph optimizations
+  (constant folding, redundant node removal) applied and saved, so the
+  rembg bots (bot.py, bot_render.py, koyeb_bot.py) load an already
+  simplified graph. The hardware specific fusions are left to onnxruntime
+  on the host that runs the bot. Skipped when onnxruntime is not installed.
+* an int8 copy of each model, calibrated on a few portraits, which the
+  bots load when a backend names it, e.g. BG_BACKENDS=rembg:u2net-int8.
+  About a quarter of the FP32 model's size; compare the two with
+  bench_segmentation.py before switching a deployment over.
+
+Re-run it after changing template assets, the background generators or the
+onnxruntime version; stale entries are ignored at runtime.
+
+Usage:
+    python build_warm_bundle.py
+    python build_warm_bundle.py --models u2netp
+    python build_warm_bundle.py --calibration-images photos/
+    python build_warm_bundle.py --skip-quantize
+    python build_warm_bundle.py --skip-models
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import hashlib
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+# Template paths are relative to the bot's directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import bg_backends
+
+DEFAULT_MODELS = ['u2net', 'u2netp']
+
+
+class RecordingTemplateEngine(main.TemplateEngine):
+    """Template engine that keeps every layer image it resolves"""
+    def __init__(self, templates):
+        super().__init__(templates)
+        self.layer_images = {}  # layer_bundle_key -> RGBA image
+
+    def load_layer_image(self, layer, canvas_size):
+        image = super().load_layer_image(layer, canvas_size)
+        key = main.layer_bundle_key(layer, canvas_size)
+        if key and image is not None:
+            self.layer_images[key] = image
+        return image
+
+
+def build_layers(bundle_dir):
+    """Store every template frame, decode their layers to .npy files and return the manifest entries"""
+    engine = RecordingTemplateEngine(main.TEMPLATES)
+    store = main.FrameStore(os.path.join(bundle_dir, 'frames'))
+    for template_key in main.TEMPLATES:
+        fingerprint = main.template_fingerprint(template_key)
+        for output_width in (None, main.PREVIEW_RENDER_WIDTH):
+            store.save(template_key, output_width, engine.build_frame(template_key, output_width, fingerprint))
+
+    layers_dir = os.path.join(bundle_dir, 'layers')
+    os.makedirs(layers_dir, exist_ok=True)
+
+    entries = {}
+    for key, image in engine.layer_images.items():
+        file_name = os.path.join('layers', hashlib.md5(key.encode('utf-8')).hexdigest() + '.npy')
+        np.save(os.path.join(bundle_dir, file_name), np.asarray(image.convert('RGBA')))
+        entries[key] = {'file': file_name, 'size': list(image.size)}
+        print(f"✅ {key} ({image.width}x{image.height})")
+
+    return entries
+
+
+def find_model(model_name):
+    """Path of rembg's ONNX model, downloading it through rembg if needed"""
+    model_home = os.path.expanduser(os.getenv('U2NET_HOME', os.path.join('~', '.u2net')))
+    path = os.path.join(model_home, f"{model_name}.onnx")
+    if not os.path.exists(path):
+        try:
+            from rembg import new_session
+            new_session(model_name)
+        except Exception as e:
+            print(f"⚠️ Could not fetch {model_name} through rembg: {e}")
+    return path if os.path.exists(path) else None
+
+
+def calibration_images(directory):
+    """Photos the int8 models are calibrated on: a directory of photos, or the benchmark's portraits"""
+    import bench_segmentation
+    return [img for _, img, _ in bench_segmentation.load_images(directory)]
+
+
+def quantize_model(source, target, images):
+    """Write an int8 copy of an ONNX model, calibrated on the given photos
+
+    Static quantization in QDQ format: activation ranges are measured on
+    the photos, so onnxruntime runs its integer convolution kernels instead
+    of quantizing every activation at run time.
+    """
+    from rembg import new_session
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # Same pre-processing as at run time
+    session = new_session('u2net_custom', model_path=source)
+    batcher = bg_backends.SegmentationBatcher
+    inputs = [session.normalize(img, batcher.MEAN, batcher.STD, batcher.SIZE) for img in images]
+
+    class CalibrationInputs(CalibrationDataReader):
+        def __init__(self):
+            self.remaining = iter(inputs)
+
+        def get_next(self):
+            return next(self.remaining, None)
+
+    prepared = target + '.prepared'
+    root_logger = logging.getLogger()
+    level = root_logger.level
+    root_logger.setLevel(logging.WARNING)  # quantization logs every tensor at INFO
+    try:
+        quant_pre_process(source, prepared, skip_symbolic_shape=True)
+        quantize_static(prepared, target, CalibrationInputs(), quant_format=QuantFormat.QDQ,
+                        per_channel=True, weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+    finally:
+        root_logger.setLevel(level)
+        if os.path.exists(prepared):
+            os.remove(prepared)
+
+
+def build_models(bundle_dir, model_names, calibration=None):
+    """Save graph-optimized copies of rembg's ONNX models, and int8 ones calibrated on the given photos"""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("⚠️ onnxruntime not installed - skipping models")
+        return {}
+
+    models_dir = os.path.join(bundle_dir, 'models')
+    os.makedirs(models_dir, exist_ok=True)
+
+    entries = {}
+    for model_name in model_names:
+        source = find_model(model_name)
+        if not source:
+            print(f"⚠️ {model_name}.onnx not found - skipping")
+            continue
+
+        file_name = os.path.join('models', f"{model_name}.optimized.onnx")
+        options = ort.SessionOptions()
+        # Only the basic level is safe to save: extended and higher may fuse nodes for the
+        # CPU and execution provider of the machine building the bundle (the Docker build
+        # host), which the bot's host might not support. rembg's session applies those
+        # fusions again at load time, on the right machine.
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        options.optimized_model_filepath = os.path.join(bundle_dir, file_name)
+        ort.InferenceSession(source, options, providers=['CPUExecutionProvider'])
+
+        entries[model_name] = {'file': file_name, 'onnxruntime': ort.__version__, 'optimization': 'basic'}
+        print(f"✅ {model_name} -> {file_name}")
+
+        if not calibration:
+            continue
+        quantized_name = model_name + bg_backends.QUANTIZED_SUFFIX
+        file_name = os.path.join('models', f"{model_name}.int8.onnx")
+        try:
+            quantize_model(source, os.path.join(bundle_dir, file_name), calibration)
+        except Exception as e:
+            print(f"⚠️ Could not quantize {model_name}: {e}")
+            continue
+        # quant_pre_process optimizes at the basic level too
+        entries[quantized_name] = {'file': file_name, 'onnxruntime': ort.__version__, 'optimization': 'basic',
+                                   'quantized': 'int8'}
+        print(f"✅ {quantized_name} -> {file_name}")
+
+    return entries
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=main.WARM_BUNDLE_DIR)
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS),
+                        help='comma separated rembg model names')
+    parser.add_argument('--calibration-images',
+                        help='directory of photos to calibrate the int8 models on (default: synthetic portraits)')
+    parser.add_argument('--skip-quantize', action='store_true',
+                        help='only write the FP32 models')
+    parser.add_argument('--skip-models', action='store_true')
+    args = parser.parse_args()
+
+    # Build from the sources, not from a previous bundle
+    shutil.rmtree(args.output, ignore_errors=True)
+    os.makedirs(args.output)
+    main.warm_bundle = main.WarmBundle(args.output)
+
+    print("🖼 Flattening frames and decoding template layers...")
+    manifest = {
+        'created': datetime.now().isoformat(),
+        'layers': build_layers(args.output),
+        'models': {},
+    }
+
+    if not args.skip_models:
+        print("\n🧠 Optimizing ONNX models...")
+        calibration = None if args.skip_quantize else calibration_images(args.calibration_images)
+        manifest['models'] = build_models(args.output, args.models.split(','), calibration)
+
+    # The manifest goes last - the bundle is only used once it exists
+    with open(os.path.join(args.output, main.WARM_BUNDLE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"\n✅ Warm bundle written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
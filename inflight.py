@@ -0,0 +1,75 @@
+"""Duplicate tap de-duplication shared by the SelamSnap bots.
+
+Impatient users tap a template button several times. Each bot wraps its
+callback handler with InFlightJobs.deduplicate: the first tap claims the
+job, keyed by (kind, user, photo hash, template), and taps on the same job
+while it runs are answered with a short notice instead of starting a
+second background removal and render. Remove.bg credits and CPU are spent
+once per distinct job.
+
+    in_flight = inflight.InFlightJobs(user_data)
+    CallbackQueryHandler(in_flight.deduplicate(button_handler))
+
+The bots handle every update on one event loop, so claiming needs no lock.
+"""
+import time
+import logging
+import functools
+
+logger = logging.getLogger(__name__)
+
+# Buttons that start a job: select_<template> (preview or render) and render_<template>
+JOB_KINDS = ('select', 'render')
+
+DUPLICATE_TAP_TEXT = "⏳ Already working on it - your image is on the way!"
+
+
+class InFlightJobs:
+    """Jobs started by a button tap that are running right now"""
+    def __init__(self, user_data, on_duplicate=None):
+        self.user_data = user_data  # the bot's user_id -> state dict, holding 'photo_hash'
+        self.on_duplicate = on_duplicate  # called with the job kind, e.g. to count dropped taps
+        self.jobs = {}  # key -> time the job started
+
+    def claim(self, key):
+        """Start a job unless the same one is running; True if the caller runs it"""
+        if key in self.jobs:
+            return False
+        self.jobs[key] = time.time()
+        return True
+
+    def release(self, key):
+        self.jobs.pop(key, None)
+
+    def job_key(self, update):
+        """Job a button tap would start, or None for buttons that start none"""
+        query = update.callback_query
+        kind, _, template_key = (query.data or '').partition('_')
+        if kind not in JOB_KINDS:
+            return None
+        user_id = query.from_user.id
+        photo_hash = (self.user_data.get(user_id) or {}).get('photo_hash')
+        return (kind, user_id, photo_hash, template_key)
+
+    def deduplicate(self, handler):
+        """Callback handler decorator: a tap on a job that is already running starts nothing"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            key = self.job_key(update)
+            if key is None:
+                return await handler(update, context)
+
+            if not self.claim(key):
+                logger.info(f"Duplicate tap on {update.callback_query.data} from {key[1]} ignored")
+                if self.on_duplicate:
+                    self.on_duplicate(key[0])
+                try:
+                    await update.callback_query.answer(DUPLICATE_TAP_TEXT)
+                except Exception as e:
+                    logger.error(f"Error answering duplicate tap: {e}")
+                return
+            try:
+                return await handler(update, context)
+            finally:
+                self.release(key)
+        return wrapper
@@ -7,7 +7,6 @@ from datetime import datetime, timedelta
 from io import BytesIO
 from typing import Dict
 
-import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 #from rembg import remove, new_session
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -20,6 +19,10 @@ from telegram.ext import (
     ContextTypes,
 )
 
+import bg_backends
+import inflight
+import uploads
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -45,44 +48,27 @@ import os
 os.environ['U2NET_HOME'] = '/root/.u2net'
 os.environ['U2NETP_HOME'] = '/root/.u2net'
 
-# Try to import rembg
-REMBG_AVAILABLE = False
-session = None
-
-try:
-    # Check if model file exists
-    model_path = '/root/.u2net/u2netp.onnx'
-    if os.path.exists(model_path):
-        print(f"✅ Model found: {model_path}")
-        size = os.path.getsize(model_path) / (1024 * 1024)
-        print(f"📊 Model size: {size:.1f}MB")
-    else:
-        print("❌ Model not found!")
+# Check if model file exists
+model_path = '/root/.u2net/u2netp.onnx'
+if os.path.exists(model_path):
+    print(f"✅ Model found: {model_path}")
+    size = os.path.getsize(model_path) / (1024 * 1024)
+    print(f"📊 Model size: {size:.1f}MB")
+else:
+    print("❌ Model not found!")
 
-    # Import rembg
-    from rembg import new_session
-    from rembg.session_factory import new_session_with_handlers
-    
-    REMBG_AVAILABLE = True
-    print("✅ rembg loaded successfully")
-    
-    # Force using u2netp ONLY
-    try:
-        # This should use our pre-downloaded model
-        session = new_session("u2netp")
-        print("✅ Using u2netp model (pre-downloaded)")
-    except Exception as e:
-        print(f"⚠️ Could not load u2netp: {e}")
-        print("⚠️ Disabling rembg to prevent memory issues")
-        REMBG_AVAILABLE = False
-        session = None
-        
-except ImportError as e:
-    print(f"❌ rembg import error: {e}")
-    REMBG_AVAILABLE = False
-except Exception as e:
-    print(f"❌ Error: {e}")
-    REMBG_AVAILABLE = False
+# Background removal backends come from BG_BACKENDS (see bg_backends.py).
+# The small u2netp model keeps memory low; it is loaded by the background
+# warm-up (or on first use), so the bot answers commands right after start
+background_router = bg_backends.router_from_env('rembg:u2netp,threshold')
+
+# Updates handled at once, so concurrent background removals can be batched
+# (kept low: every one holds an image in memory)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '4'))
+
+async def post_init(application):
+    """Start loading the background removal models once the bot is initialized"""
+    background_router.start_warm_up()
 
 # Developer info
 DEVELOPER_INFO = {
@@ -136,8 +122,8 @@ TEMPLATES: Dict = {
 # Store user data temporarily
 user_data: Dict = {}
 
-# Initialize rembg session
-session = new_session()
+# Taps on a render that is already running start nothing (see inflight.py)
+in_flight = inflight.InFlightJobs(user_data)
 
 # ============================================================================
 # DATABASE
@@ -382,26 +368,15 @@ def ensure_directories():
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
-def extract_human_from_image(image_bytes):
-    """Remove background and extract human using rembg"""
+def extract_human_from_image(image_source):
+    """Remove background and extract human with the configured backends"""
     try:
-        input_image = Image.open(BytesIO(image_bytes)).convert("RGBA")
-        input_array = np.array(input_image)
-        
-        output_array = remove(
-            input_array,
-            session=session,
-            alpha_matting=True,
-            alpha_matting_foreground_threshold=240,
-            alpha_matting_background_threshold=10,
-            alpha_matting_erode_size=10
-        )
-        
-        return Image.fromarray(output_array)
+        human_image, _ = background_router.remove(image_source)
+        return human_image
         
     except Exception as e:
         logger.error(f"Error extracting human: {e}")
-        return Image.open(BytesIO(image_bytes)).convert("RGBA")
+        return bg_backends.load_image(image_source).convert("RGBA")
 
 def resize_image_proportionally(image, scale_factor=0.75):
     """Resize image proportionally by scale factor"""
@@ -1057,7 +1032,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Send your photo now:",
             parse_mode='HTML'
         )
-        user_data[user_id] = {'state': 'awaiting_photo'}
+        uploads.set_user_photo(user_data, user_id, {'state': 'awaiting_photo'})
     
     elif query.data == 'show_developer':
         await query.edit_message_text(
@@ -1283,12 +1258,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if photo_file:
         try:
-            photo_bytes = await photo_file.download_as_bytearray()
+            uploads.prune_uploads()
+            photo_path = await uploads.download_upload(photo_file, user_id)
             
-            user_data[user_id] = {
-                'photo_bytes': bytes(photo_bytes),
+            uploads.set_user_photo(user_data, user_id, {
+                'photo_path': photo_path,
+                'photo_hash': await asyncio.to_thread(uploads.file_digest, photo_path),
                 'state': 'selecting_template'
-            }
+            })
             
             # Show all THREE templates
             keyboard = [
@@ -1328,7 +1305,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
     
     user_info = user_data.get(user_id, {})
     
-    if not user_info or 'photo_bytes' not in user_info:
+    if not user_info or 'photo_path' not in user_info:
         await query.edit_message_text(
             "❌ No photo found. Please start again with /upload"
         )
@@ -1350,7 +1327,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
     )
     
     try:
-        photo_bytes = user_info['photo_bytes']
+        photo_path = user_info['photo_path']
         
         await processing_msg.edit_text(
             f"🔄 Processing: {template_name}\n\n"
@@ -1360,7 +1337,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
         )
         
         # Extract human
-        human_image = extract_human_from_image(photo_bytes)
+        human_image = await asyncio.to_thread(extract_human_from_image, photo_path)
         
         # Apply appropriate template
         if template_key == 'template1':
@@ -1415,7 +1392,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
         
         # Clear user data
         if user_id in user_data:
-            user_data[user_id] = {}
+            uploads.set_user_photo(user_data, user_id, {})
         
         # Show options for next step
         keyboard = [
@@ -1534,6 +1511,8 @@ def main():
     
     # Ensure directories and create sample files
     ensure_directories()
+    # Photos uploaded before a restart are never rendered
+    uploads.prune_uploads(max_age=0)
     create_sample_files()
     
     # Check required files
@@ -1575,7 +1554,7 @@ def main():
             print("=" * 60)
             
             # Create application
-            application = Application.builder().token(BOT_TOKEN).build()
+            application = Application.builder().token(BOT_TOKEN).post_init(post_init).concurrent_updates(CONCURRENT_UPDATES).build()
             
             application.add_error_handler(error_handler)
     
@@ -1589,7 +1568,7 @@ def main():
             application.add_handler(CommandHandler("showcomments", show_comments_command))
             application.add_handler(CommandHandler("help", help_command))
             
-            application.add_handler(CallbackQueryHandler(button_handler))
+            application.add_handler(CallbackQueryHandler(in_flight.deduplicate(button_handler)))
             
             application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
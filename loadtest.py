@@ -0,0 +1,431 @@
+"""End-to-end load generator for the SelamSnap bot.
+
+Runs the real main.py handlers against a local stub of the Telegram Bot API
+(getUpdates, sendPhoto, editMessageText, ...) and a stub remove.bg endpoint
+with configurable latency and error rate. N simulated users go through the
+upload -> quick preview -> full render flow, and the run reports throughput,
+p50/p99 latency per step and error rates.
+
+The bot runs in a temporary working directory, so the real database,
+usage counter and preview cache are never touched.
+
+Usage:
+    python loadtest.py --users 20 --flows 3
+    python loadtest.py --users 50 --removebg-latency 2.0 --removebg-error-rate 0.1
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import threading
+import email.parser
+import email.policy
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+BOT_TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'SelamSnap', 'username': 'selamsnap_loadtest_bot'}
+STEPS = ['upload', 'preview', 'render']
+
+
+class FlowError(Exception):
+    pass
+
+
+def parse_form(content_type, body):
+    """Parse a urlencoded or multipart Bot API request into a dict"""
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            fields[name] = part.get_payload(decode=True) if part.get_filename() else part.get_content()
+        return fields
+
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+
+class StubServer:
+    """Stub Telegram Bot API and remove.bg endpoint"""
+    def __init__(self, photo_bytes, cutout_png, removebg_latency, removebg_error_rate):
+        self.photo_bytes = photo_bytes
+        self.cutout_png = cutout_png
+        self.removebg_latency = removebg_latency
+        self.removebg_error_rate = removebg_error_rate
+
+        self.updates = queue.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.file_ids = itertools.count(1)
+        self.subscribers = {}  # chat_id -> (loop, asyncio.Queue)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def do_POST(self):
+                server.handle_post(self)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def subscribe(self, chat_id, loop, inbox):
+        self.subscribers[chat_id] = (loop, inbox)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    # ------------------------------------------------------------------
+    # Updates sent by simulated users
+    # ------------------------------------------------------------------
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def push_photo(self, user_id):
+        file_id = f'upload-{next(self.file_ids)}'
+        self.updates.put({
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self.user(user_id),
+                'photo': [{'file_id': file_id, 'file_unique_id': file_id,
+                           'width': 1200, 'height': 1600, 'file_size': len(self.photo_bytes)}],
+            }
+        })
+
+    def push_callback(self, user_id, message, data):
+        self.updates.put({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': f'cb-{next(self.file_ids)}',
+                'from': self.user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': message,
+            }
+        })
+
+    # ------------------------------------------------------------------
+    # HTTP handling
+    # ------------------------------------------------------------------
+
+    def reply(self, handler, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list, bool)) or body is None:
+            body = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle_get(self, handler):
+        if handler.path.startswith('/file/'):
+            self.count('file_download')
+            self.reply(handler, 200, self.photo_bytes, 'image/jpeg')
+        else:
+            self.reply(handler, 404, {'ok': False})
+
+    def handle_post(self, handler):
+        length = int(handler.headers.get('Content-Length', 0))
+        body = handler.rfile.read(length)
+        path = urlparse(handler.path).path
+
+        if path == '/removebg':
+            self.handle_removebg(handler)
+            return
+
+        method = path.rsplit('/', 1)[-1]
+        params = parse_form(handler.headers.get('Content-Type', ''), body)
+        self.count(method)
+        result = self.handle_api_call(method, params)
+        self.reply(handler, 200, {'ok': True, 'result': result})
+
+    def handle_removebg(self, handler):
+        self.count('removebg')
+        time.sleep(max(0.0, random.gauss(self.removebg_latency, self.removebg_latency * 0.2)))
+
+        if not handler.headers.get('X-Api-Key'):
+            self.reply(handler, 403, {'errors': [{'title': 'Missing API key'}]})
+        elif random.random() < self.removebg_error_rate:
+            self.count('removebg_error')
+            status = random.choice([429, 500])
+            self.reply(handler, status, {'errors': [{'title': 'Injected failure'}]})
+        else:
+            self.reply(handler, 200, self.cutout_png, 'image/png')
+
+    def message(self, chat_id, **fields):
+        message = {
+            'message_id': int(fields.pop('message_id', next(self.message_ids))),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def photo_sizes(self):
+        file_id = f'sent-{next(self.file_ids)}'
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 360, 'height': 640}]
+
+    def handle_api_call(self, method, params):
+        if method == 'getUpdates':
+            return self.get_updates(float(params.get('timeout', 0)))
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                    'file_size': len(self.photo_bytes), 'file_path': f"photos/{params['file_id']}.jpg"}
+
+        chat_id = params.get('chat_id')
+        if method == 'sendMessage':
+            result = self.message(chat_id, text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            result = self.message(chat_id, photo=self.photo_sizes(), caption=params.get('caption', ''))
+        elif method == 'sendMediaGroup':
+            media = json.loads(params['media'])
+            result = [self.message(chat_id, photo=self.photo_sizes(), media_group_id='album') for _ in media]
+        elif method in ('editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'):
+            result = self.message(chat_id, message_id=params.get('message_id', 0),
+                                  text=params.get('text', params.get('caption', '')))
+        else:
+            # answerCallbackQuery, deleteWebhook, ...
+            return True
+
+        if 'Fallback' in params.get('text', ''):
+            self.count('fallback_render_steps')
+
+        if chat_id is not None and int(chat_id) in self.subscribers:
+            loop, inbox = self.subscribers[int(chat_id)]
+            loop.call_soon_threadsafe(inbox.put_nowait, (method, params, result))
+
+        return result
+
+    def get_updates(self, timeout):
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=min(timeout, 1.0)))
+            while True:
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+
+async def wait_for(inbox, predicate, timeout, step):
+    """Wait for the bot call matching predicate, failing on error replies"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise FlowError(f'{step}: timeout')
+        try:
+            method, params, result = await asyncio.wait_for(inbox.get(), remaining)
+        except asyncio.TimeoutError:
+            raise FlowError(f'{step}: timeout')
+
+        text = params.get('text') or params.get('caption') or ''
+        if text.lstrip().startswith('❌'):
+            raise FlowError(f'{step}: {text.strip().splitlines()[0][:60]}')
+        if predicate(method, params):
+            return result
+
+
+async def simulate_user(server, user_id, flows, templates, timeout, results):
+    """Run upload -> preview -> full render flows for one user"""
+    inbox = asyncio.Queue()
+    server.subscribe(user_id, asyncio.get_running_loop(), inbox)
+
+    for _ in range(flows):
+        template_key = random.choice(templates)
+        flow_start = time.perf_counter()
+        step = 'upload'
+        try:
+            start = time.perf_counter()
+            server.push_photo(user_id)
+            keyboard_message = await wait_for(
+                inbox, lambda m, p: m == 'sendMessage' and 'select_' in p.get('reply_markup', ''), timeout, step
+            )
+            results['upload'].append(time.perf_counter() - start)
+
+            step = 'preview'
+            start = time.perf_counter()
+            server.push_callback(user_id, keyboard_message, f'select_{template_key}')
+            preview_message = await wait_for(
+                inbox, lambda m, p: m == 'sendPhoto' and 'render_' in p.get('reply_markup', ''), timeout, step
+            )
+            results['preview'].append(time.perf_counter() - start)
+
+            step = 'render'
+            start = time.perf_counter()
+            server.push_callback(user_id, preview_message, f'render_{template_key}')
+            await wait_for(
+                inbox, lambda m, p: m == 'sendPhoto' and 'Applied' in p.get('caption', ''), timeout, step
+            )
+            results['render'].append(time.perf_counter() - start)
+            results['flow'].append(time.perf_counter() - flow_start)
+        except FlowError as e:
+            results['errors'].append((step, str(e)))
+            # Drain anything left over from the failed flow
+            await asyncio.sleep(0.5)
+            while not inbox.empty():
+                inbox.get_nowait()
+
+
+def make_assets(main):
+    """Create the uploaded JPEG and the remove.bg cut-out returned by the stub"""
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (1600, 1200, 3), dtype=np.uint8)
+    photo = BytesIO()
+    main.Image.fromarray(pixels, 'RGB').save(photo, format='JPEG', quality=85)
+
+    cutout = BytesIO()
+    main.create_placeholder_silhouette(800, 1200).save(cutout, format='PNG')
+    return photo.getvalue(), cutout.getvalue()
+
+
+def report(results, stats, elapsed, total_flows):
+    completed = len(results['flow'])
+    errors = results['errors']
+
+    print("\n" + "=" * 60)
+    print("📊 LOAD TEST RESULTS")
+    print("=" * 60)
+    print(f"Flows: {completed}/{total_flows} completed in {elapsed:.1f}s")
+    print(f"Throughput: {completed / elapsed:.2f} renders/s")
+    print(f"Error rate: {len(errors) / total_flows:.1%}")
+
+    print(f"\n{'step':<10}{'count':>8}{'p50 s':>10}{'p99 s':>10}{'max s':>10}")
+    for step in STEPS + ['flow']:
+        samples = results[step]
+        if samples:
+            print(f"{step:<10}{len(samples):>8}{np.percentile(samples, 50):>10.2f}"
+                  f"{np.percentile(samples, 99):>10.2f}{max(samples):>10.2f}")
+        else:
+            print(f"{step:<10}{0:>8}")
+
+    if errors:
+        print("\nErrors:")
+        for message, count in Counter(message for _, message in errors).most_common(10):
+            print(f"   {count:>5}x {message}")
+
+    print("\nStub calls:")
+    for name, count in sorted(stats.items()):
+        print(f"   {name}: {count}")
+
+
+async def run(args):
+    # Keep the bot's database, usage counter and caches out of the real tree
+    bot_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='selamsnap-loadtest-')
+    os.symlink(os.path.join(bot_dir, 'templates'), os.path.join(work_dir, 'templates'))
+    os.chdir(work_dir)
+    sys.path.insert(0, bot_dir)
+    # The key pool and the rate limiter are built at import
+    os.environ['REMOVE_BG_API_KEYS'] = ','.join(f"loadtest{n}" for n in range(args.removebg_keys))
+    os.environ['RATE_LIMITS'] = args.rate_limits
+
+    import main
+    from telegram.ext import Application
+
+    photo_bytes, cutout_png = make_assets(main)
+    server = StubServer(photo_bytes, cutout_png, args.removebg_latency, args.removebg_error_rate)
+    server.start()
+
+    # Point the bot at the stubs
+    main.REMOVE_BG_API_URL = f"{server.url}/removebg"
+    main.usage_tracker.monthly_limit = 10 ** 9
+    main.template_engine.warm_up()
+    main.preview_gallery.build()
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{server.url}/bot")
+        .base_file_url(f"{server.url}/file/bot")
+        .concurrent_updates(main.CONCURRENT_UPDATES)
+        .build()
+    )
+    main.register_handlers(application)
+
+    templates = args.templates.split(',')
+    results = defaultdict(list)
+    total_flows = args.users * args.flows
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+
+        print(f"🚀 {args.users} users x {args.flows} flows, remove.bg latency {args.removebg_latency}s, "
+              f"error rate {args.removebg_error_rate:.0%}")
+        start = time.perf_counter()
+        users = []
+        for i in range(args.users):
+            users.append(asyncio.create_task(
+                simulate_user(server, 10_000 + i, args.flows, templates, args.timeout, results)
+            ))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.users)
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - start
+
+        await application.updater.stop()
+        await application.stop()
+
+    server.stop()
+    report(results, server.stats, elapsed, total_flows)
+    print(f"\nWork directory: {work_dir}")
+
+    return 1 if len(results['errors']) > total_flows * args.max_error_rate else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='simulated users')
+    parser.add_argument('--flows', type=int, default=2, help='upload -> render flows per user')
+    parser.add_argument('--templates', default='template1,template2,template3')
+    parser.add_argument('--removebg-latency', type=float, default=1.0, help='mean stub remove.bg latency (s)')
+    parser.add_argument('--removebg-error-rate', type=float, default=0.0, help='fraction of failing remove.bg calls')
+    parser.add_argument('--removebg-keys', type=int, default=1, help='remove.bg API keys in the pool')
+    parser.add_argument('--rate-limits', default='',
+                        help="per-user limits like main.py's RATE_LIMITS (default: none)")
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which users start')
+    parser.add_argument('--timeout', type=float, default=120.0, help='per-step timeout (s)')
+    parser.add_argument('--max-error-rate', type=float, default=0.05,
+                        help='exit non-zero when more flows than this fraction fail')
+    args = parser.parse_args()
+
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,16 +1,23 @@
 import os
 import asyncio
+import cProfile
+import functools
+import hashlib
+import importlib
+import json
 import logging
+import mmap
+import pstats
 import time
 import sqlite3
-import requests
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 from typing import Dict
 
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -20,6 +27,10 @@ from telegram.ext import (
     ContextTypes,
 )
 
+import bg_backends
+import inflight
+import uploads
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -31,81 +42,305 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class LazyModule:
+    """Module proxy that imports the real module on first attribute access"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def resolve(self):
+        """Import the module now (named so it doesn't shadow attributes like np.load)"""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+# NumPy, Pillow and requests are imported on first use (or by the background
+# warm-up) so the bot can answer commands right after a cold start
+np = LazyModule('numpy')
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+requests = LazyModule('requests')
+
 # Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN', '8253530670:AAFXSKii0neNFnadDP39lg8JUjlQDLqOMxY')
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
+# Updates handled at once; renders run in worker threads meanwhile
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '8'))
 
 # Remove.bg API Configuration
 REMOVE_BG_API_KEY = os.getenv('REMOVE_BG_API_KEY', '')  # Add your API key here
+# Several accounts: comma separated keys, each with its own monthly credits
+REMOVE_BG_API_KEYS = [k.strip() for k in os.getenv('REMOVE_BG_API_KEYS', REMOVE_BG_API_KEY).split(',') if k.strip()]
 REMOVE_BG_API_URL = "https://api.remove.bg/v1.0/removebg"
+REMOVE_BG_RATE_LIMIT_COOLDOWN = 60  # seconds a key rests after a 429 without Retry-After
+
+DATABASE_FILE = 'bot_database.db'
 
 # Remove.bg Usage tracking
 class RemoveBgUsageTracker:
-    def __init__(self):
-        self.usage_file = 'removebg_usage.json'
-        self.monthly_limit = 50
-        self.current_month = datetime.now().strftime('%Y-%m')
-        self.load_usage()
+    """Monthly Remove.bg credit counter in SQLite, shared by every bot process
+
+    Each API key has its own row per month. A credit is reserved
+    (compare-and-increment) before the API call and refunded if the call
+    fails, so concurrent renders in any number of worker processes can never
+    spend more than a key's monthly limit.
+    """
+    def __init__(self, key_ids, db_file=DATABASE_FILE, legacy_file='removebg_usage.json'):
+        self.monthly_limit = 50  # per API key
+        self.key_ids = list(key_ids) or ['']
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.setup_tables()
+        self.migrate_legacy_file(legacy_file)
+    
+    def setup_tables(self):
+        """Create the usage tables"""
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS removebg_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    month TEXT,
+                    used_count INTEGER DEFAULT 0,
+                    total_allowed INTEGER DEFAULT 50,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # One row per month and key; BEGIN IMMEDIATE keeps processes from migrating at the same time
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                columns = [row[1] for row in self.conn.execute('PRAGMA table_info(removebg_usage)')]
+                if 'key_id' not in columns:
+                    self.conn.execute("ALTER TABLE removebg_usage ADD COLUMN key_id TEXT DEFAULT ''")
+                self.conn.execute('DROP INDEX IF EXISTS idx_removebg_usage_month')
+                self.conn.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS idx_removebg_usage_month_key ON removebg_usage (month, key_id)'
+                )
+                # Counts from before the key pool belong to the first key
+                self.conn.execute("UPDATE OR IGNORE removebg_usage SET key_id = ? WHERE key_id = ''", (self.key_ids[0],))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            
+            # Per-day counts for the credit scheduler
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS removebg_daily_usage (
+                    day TEXT PRIMARY KEY,
+                    used_count INTEGER DEFAULT 0
+                )
+            ''')
     
-    def load_usage(self):
-        """Load usage data from file"""
+    def migrate_legacy_file(self, legacy_file):
+        """Import this month's count from the old removebg_usage.json once"""
+        if not os.path.exists(legacy_file):
+            return
         try:
-            import json
-            if os.path.exists(self.usage_file):
-                with open(self.usage_file, 'r') as f:
-                    data = json.load(f)
-                    # Check if it's a new month
-                    if data.get('month') == self.current_month:
-                        self.used_count = data.get('used', 0)
-                    else:
-                        self.used_count = 0
-            else:
-                self.used_count = 0
-        except:
-            self.used_count = 0
-    
-    def save_usage(self):
-        """Save usage data to file"""
+            with open(legacy_file, 'r') as f:
+                data = json.load(f)
+            if data.get('month') == self.current_month():
+                with self.lock:
+                    # A row that already exists wins, so a second process can't double count
+                    self.conn.execute(
+                        'INSERT OR IGNORE INTO removebg_usage (month, key_id, used_count, total_allowed) VALUES (?, ?, ?, ?)',
+                        (data['month'], self.key_ids[0], int(data.get('used', 0)), self.monthly_limit)
+                    )
+            os.replace(legacy_file, legacy_file + '.migrated')
+            logger.info(f"Migrated Remove.bg usage from {legacy_file}")
+        except FileNotFoundError:
+            pass  # Another process migrated it first
+        except Exception as e:
+            logger.error(f"Error migrating usage file: {e}")
+    
+    @staticmethod
+    def current_month():
+        return datetime.now().strftime('%Y-%m')
+    
+    @staticmethod
+    def current_day():
+        return datetime.now().strftime('%Y-%m-%d')
+    
+    def reserve(self, key_id):
+        """Take one of a key's credits if any are left; returns the reservation to refund, or None"""
+        month, day = self.current_month(), self.current_day()
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock, so the check and the increment are atomic across processes
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO removebg_usage (month, key_id, used_count, total_allowed) VALUES (?, ?, 0, ?)',
+                    (month, key_id, self.monthly_limit)
+                )
+                cursor = self.conn.execute('''
+                    UPDATE removebg_usage SET used_count = used_count + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE month = ? AND key_id = ? AND used_count < ?
+                ''', (month, key_id, self.monthly_limit))
+                if cursor.rowcount != 1:
+                    self.conn.execute('ROLLBACK')
+                    return None
+                
+                self.conn.execute('INSERT OR IGNORE INTO removebg_daily_usage (day) VALUES (?)', (day,))
+                self.conn.execute('UPDATE removebg_daily_usage SET used_count = used_count + 1 WHERE day = ?', (day,))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return (month, day, key_id)
+    
+    def refund(self, reservation):
+        """Give back a credit whose API call failed"""
+        month, day, key_id = reservation
         try:
-            import json
-            data = {
-                'month': self.current_month,
-                'used': self.used_count,
-                'limit': self.monthly_limit,
-                'last_updated': datetime.now().isoformat()
-            }
-            with open(self.usage_file, 'w') as f:
-                json.dump(data, f)
+            with self.lock:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.execute('''
+                    UPDATE removebg_usage SET used_count = used_count - 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE month = ? AND key_id = ? AND used_count > 0
+                ''', (month, key_id))
+                self.conn.execute(
+                    'UPDATE removebg_daily_usage SET used_count = used_count - 1 WHERE day = ? AND used_count > 0',
+                    (day,)
+                )
+                self.conn.execute('COMMIT')
         except Exception as e:
-            logger.error(f"Error saving usage: {e}")
+            logger.error(f"Error refunding Remove.bg credit: {e}")
+    
+    def exhaust(self, reservation):
+        """Mark a key as out of credits for the month (Remove.bg answered 402)"""
+        month, _, key_id = reservation
+        with self.lock:
+            self.conn.execute(
+                'UPDATE removebg_usage SET used_count = MAX(used_count, ?), updated_at = CURRENT_TIMESTAMP '
+                'WHERE month = ? AND key_id = ?',
+                (self.monthly_limit, month, key_id)
+            )
+    
+    def key_usage(self):
+        """Images used this month per key"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT key_id, used_count FROM removebg_usage WHERE month = ?', (self.current_month(),)
+            ).fetchall()
+        used = dict(rows)
+        return {key_id: used.get(key_id, 0) for key_id in self.key_ids}
+    
+    def used_this_month(self):
+        """Images used this month by every process, over all keys"""
+        return sum(self.key_usage().values())
+    
+    def used_today(self):
+        """Images used since the start of today"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT used_count FROM removebg_daily_usage WHERE day = ?', (self.current_day(),)
+            ).fetchone()
+        return row[0] if row else 0
+    
+    def total_limit(self):
+        """Monthly credits of all keys together"""
+        return self.monthly_limit * len(self.key_ids)
     
     def can_process(self):
         """Check if we can process more images this month"""
-        return self.used_count < self.monthly_limit
-    
-    def increment_usage(self):
-        """Increment usage counter"""
-        self.used_count += 1
-        self.save_usage()
+        return self.used_this_month() < self.total_limit()
     
     def get_usage_info(self):
         """Get usage information"""
-        remaining = self.monthly_limit - self.used_count
+        used = self.used_this_month()
+        limit = self.total_limit()
         return {
-            'used': self.used_count,
-            'limit': self.monthly_limit,
-            'remaining': remaining,
-            'percentage': (self.used_count / self.monthly_limit) * 100
+            'used': used,
+            'limit': limit,
+            'remaining': max(0, limit - used),
+            'percentage': (used / limit) * 100
         }
 
-# Initialize usage tracker
-usage_tracker = RemoveBgUsageTracker()
+def removebg_key_id(api_key):
+    """Short id a key is stored under, so the database never holds the key itself"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+class RemoveBgKeyPool:
+    """Spread Remove.bg calls over several API keys
+
+    Each call goes to the key with the fewest recent errors and, among
+    those, the most credits left. A key that answers 429 rests for its
+    Retry-After period; a key that answers 402 is marked used up.
+    """
+    def __init__(self, api_keys, tracker):
+        self.keys = {removebg_key_id(api_key): api_key for api_key in api_keys}
+        self.labels = {key_id: f"Key {n}" for n, key_id in enumerate(self.keys, 1)}
+        self.tracker = tracker
+        self.cooldowns = {}  # key_id -> time the key may be used again
+        self.failures = {}  # key_id -> errors since its last success
+        self.lock = threading.Lock()
+    
+    def acquire(self, exclude=()):
+        """Reserve a credit on the healthiest key not in exclude: returns (api_key, reservation) or (None, None)"""
+        now = time.time()
+        used = self.tracker.key_usage()
+        with self.lock:
+            ready = [key_id for key_id in self.keys if key_id not in exclude and self.cooldowns.get(key_id, 0) <= now]
+            ready.sort(key=lambda key_id: (self.failures.get(key_id, 0), used.get(key_id, 0)))
+        
+        for key_id in ready:
+            reservation = self.tracker.reserve(key_id)
+            if reservation:
+                return self.keys[key_id], reservation
+        return None, None
+    
+    def cool_down(self, reservation, seconds):
+        """Rest a rate limited key"""
+        key_id = reservation[2]
+        with self.lock:
+            self.cooldowns[key_id] = time.time() + seconds
+        logger.warning(f"Remove.bg {self.labels[key_id]} rate limited - resting {seconds}s")
+        metrics.inc('selamsnap_removebg_rate_limited_total', key=self.labels[key_id])
+    
+    def record_result(self, reservation, success):
+        """Count errors per key so failing keys are tried last"""
+        key_id = reservation[2]
+        with self.lock:
+            self.failures[key_id] = 0 if success else self.failures.get(key_id, 0) + 1
+    
+    def ready(self):
+        """Whether any key can take a call now"""
+        now = time.time()
+        with self.lock:
+            return any(self.cooldowns.get(key_id, 0) <= now for key_id in self.keys)
+    
+    def cooling_down(self):
+        """Whether any key is resting after a 429"""
+        now = time.time()
+        with self.lock:
+            return any(until > now for until in self.cooldowns.values())
+    
+    def usage_lines(self):
+        """One line per key for /usage"""
+        used = self.tracker.key_usage()
+        now = time.time()
+        lines = []
+        for key_id, label in self.labels.items():
+            line = f"• {label}: {used.get(key_id, 0)}/{self.tracker.monthly_limit} used"
+            if self.cooldowns.get(key_id, 0) > now:
+                line += " (rate limited, resting)"
+            lines.append(line)
+        return lines
+
+# Initialize usage tracker and key pool
+usage_tracker = RemoveBgUsageTracker([removebg_key_id(api_key) for api_key in REMOVE_BG_API_KEYS])
+removebg_keys = RemoveBgKeyPool(REMOVE_BG_API_KEYS, usage_tracker)
 
 print("=" * 60)
 print("🤖 SELAMSNAP BOT STARTING")
 print("=" * 60)
-print(f"Remove.bg Status: {'✅ API Key Found' if REMOVE_BG_API_KEY else '❌ No API Key'}")
-print(f"Remove.bg Usage: {usage_tracker.used_count}/{usage_tracker.monthly_limit} images this month")
+print(f"Remove.bg Status: {f'✅ {len(REMOVE_BG_API_KEYS)} API Key(s) Found' if REMOVE_BG_API_KEYS else '❌ No API Key'}")
+print(f"Remove.bg Usage: {usage_tracker.used_this_month()}/{usage_tracker.total_limit()} images this month")
 print("=" * 60)
 
 # Developer info
@@ -118,42 +353,43 @@ DEVELOPER_INFO = {
 }
 
 # Template configuration
+# Layers are drawn in z-order, see TemplateEngine for scale modes and anchors
 TEMPLATES: Dict = {
     'template1': {
         'name': 'እገኛለሁ (I Will Come)',
-        'template_image': 'templates/background.png',
         'description': 'Cloud on top, human at 30% from bottom',
-        'elements': {
-            'cloud': 'templates/cloud.png',
-            'human_size': 0.40,
-            'human_position_y': 0.25,
-            'cloud_position_y': 0.04,
-            'cloud_on_top': True
-        }
+        'layers': [
+            {'type': 'background', 'source': 'templates/background.png',
+             'fallback': 'simple_background', 'z': 0},
+            {'type': 'subject', 'scale_mode': 'height', 'scale': 0.40,
+             'anchor': 'bottom_center', 'position_y': 0.25, 'z': 1},
+            {'type': 'cloud', 'source': 'templates/cloud.png', 'scale_mode': 'width', 'scale': 0.80,
+             'anchor': 'bottom_center', 'position_y': 0.04, 'z': 2}
+        ]
     },
     'template2': {
         'name': "Let's Come Together",
-        'template_image': 'templates/template2_background.png',
         'description': 'Human at bottom with overlay on top',
-        'elements': {
-            'overlay': 'templates/overlay.png',
-            'human_size': 2.00,
-            'human_at_bottom': True,
-            'overlay_on_top': True,
-            'align_bottom': True
-        }
+        'layers': [
+            {'type': 'background', 'source': 'templates/template2_background.png',
+             'fallback': 'template2_background', 'z': 0},
+            {'type': 'subject', 'scale_mode': 'source', 'scale': 2.00,
+             'anchor': 'bottom_center', 'position_y': 0.0, 'z': 1},
+            {'type': 'overlay', 'source': 'templates/overlay.png', 'fallback': 'template2_overlay',
+             'scale_mode': 'fill', 'z': 2}
+        ]
     },
     'template3': {
         'name': '፲፭ ዓመት በ ሉቃስ ፲፭ Template (15 Years in Luke 15)',
-        'template_image': 'templates/template3_background.png',
         'description': 'Cloud on top, human at 30% from bottom - Alternative background',
-        'elements': {
-            'cloud': 'templates/cloud.png',
-            'human_size': 0.40,
-            'human_position_y': 0.25,
-            'cloud_position_y': 0.04,
-            'cloud_on_top': True
-        }
+        'layers': [
+            {'type': 'background', 'source': 'templates/template3_background.png',
+             'fallback': 'template3_background', 'z': 0},
+            {'type': 'subject', 'scale_mode': 'height', 'scale': 0.40,
+             'anchor': 'bottom_center', 'position_y': 0.25, 'z': 1},
+            {'type': 'cloud', 'source': 'templates/cloud.png', 'scale_mode': 'width', 'scale': 0.80,
+             'anchor': 'bottom_center', 'position_y': 0.04, 'z': 2}
+        ]
     }
 }
 
@@ -167,11 +403,13 @@ user_data: Dict = {}
 class Database:
     def __init__(self):
         self.conn = None
+        # Renders record statistics from worker threads while the event loop uses the same connection
+        self.lock = threading.Lock()
         self.setup_database()
     
     def setup_database(self):
         """Initialize database and create tables"""
-        self.conn = sqlite3.connect('bot_database.db', check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
         cursor = self.conn.cursor()
         
         # Users table
@@ -225,189 +463,197 @@ class Database:
             )
         ''')
         
-        # Remove.bg usage table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS removebg_usage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                month TEXT,
-                used_count INTEGER DEFAULT 0,
-                total_allowed INTEGER DEFAULT 50,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # The removebg_usage tables belong to RemoveBgUsageTracker
         
         self.conn.commit()
     
     def add_user(self, user_id, username, first_name, last_name):
         """Add new user to database"""
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT OR IGNORE INTO users 
-                (user_id, username, first_name, last_name, join_date, last_active)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, datetime.now(), datetime.now()))
-            
-            # Update statistics for today
-            today = datetime.now().date()
-            cursor.execute('''
-                INSERT OR IGNORE INTO statistics (date) VALUES (?)
-            ''', (today,))
-            
-            cursor.execute('''
-                UPDATE statistics SET users_joined = users_joined + 1 
-                WHERE date = ?
-            ''', (today,))
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error adding user: {e}")
-            return False
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users 
+                    (user_id, username, first_name, last_name, join_date, last_active)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, username, first_name, last_name, datetime.now(), datetime.now()))
+                
+                # Update statistics for today
+                today = datetime.now().date()
+                cursor.execute('''
+                    INSERT OR IGNORE INTO statistics (date) VALUES (?)
+                ''', (today,))
+                
+                cursor.execute('''
+                    UPDATE statistics SET users_joined = users_joined + 1 
+                    WHERE date = ?
+                ''', (today,))
+                
+                self.conn.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error adding user: {e}")
+                return False
     
     def update_user_activity(self, user_id):
         """Update user's last activity time"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE users SET last_active = ? WHERE user_id = ?
-        ''', (datetime.now(), user_id))
-        self.conn.commit()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE users SET last_active = ? WHERE user_id = ?
+            ''', (datetime.now(), user_id))
+            self.conn.commit()
+    
+    def get_photo_count(self, user_id):
+        """Number of photos a user has finished"""
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT photo_count FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row and row[0] else 0
     
     def increment_photo_count(self, user_id, template_key):
         """Increment user's photo count and template usage"""
-        cursor = self.conn.cursor()
-        
-        # Update user's photo count
-        cursor.execute('''
-            UPDATE users SET photo_count = photo_count + 1 WHERE user_id = ?
-        ''', (user_id,))
-        
-        # Update statistics
-        today = datetime.now().date()
-        cursor.execute('''
-            UPDATE statistics SET photos_processed = photos_processed + 1 
-            WHERE date = ?
-        ''', (today,))
-        
-        # Update template-specific statistics
-        if template_key == 'template1':
-            cursor.execute('''
-                UPDATE statistics SET template1_used = template1_used + 1 
-                WHERE date = ?
-            ''', (today,))
-        elif template_key == 'template2':
+        with self.lock:
+            cursor = self.conn.cursor()
+            
+            # Update user's photo count
             cursor.execute('''
-                UPDATE statistics SET template2_used = template2_used + 1 
-                WHERE date = ?
-            ''', (today,))
-        elif template_key == 'template3':
+                UPDATE users SET photo_count = photo_count + 1 WHERE user_id = ?
+            ''', (user_id,))
+            
+            # Update statistics
+            today = datetime.now().date()
             cursor.execute('''
-                UPDATE statistics SET template3_used = template3_used + 1 
+                UPDATE statistics SET photos_processed = photos_processed + 1 
                 WHERE date = ?
             ''', (today,))
-        
-        self.conn.commit()
+            
+            # Update template-specific statistics
+            if template_key == 'template1':
+                cursor.execute('''
+                    UPDATE statistics SET template1_used = template1_used + 1 
+                    WHERE date = ?
+                ''', (today,))
+            elif template_key == 'template2':
+                cursor.execute('''
+                    UPDATE statistics SET template2_used = template2_used + 1 
+                    WHERE date = ?
+                ''', (today,))
+            elif template_key == 'template3':
+                cursor.execute('''
+                    UPDATE statistics SET template3_used = template3_used + 1 
+                    WHERE date = ?
+                ''', (today,))
+            
+            self.conn.commit()
     
     def increment_removebg_count(self):
         """Increment Remove.bg usage count"""
-        cursor = self.conn.cursor()
-        today = datetime.now().date()
-        cursor.execute('''
-            UPDATE statistics SET removebg_used = removebg_used + 1 
-            WHERE date = ?
-        ''', (today,))
-        self.conn.commit()
+        with self.lock:
+            cursor = self.conn.cursor()
+            today = datetime.now().date()
+            cursor.execute('''
+                UPDATE statistics SET removebg_used = removebg_used + 1 
+                WHERE date = ?
+            ''', (today,))
+            self.conn.commit()
     
     def add_comment(self, user_id, username, comment, rating):
         """Add user comment"""
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO comments (user_id, username, comment, rating, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, username, comment, rating, datetime.now()))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error adding comment: {e}")
-            return False
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT INTO comments (user_id, username, comment, rating, timestamp)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, username, comment, rating, datetime.now()))
+                self.conn.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error adding comment: {e}")
+                return False
     
     def get_comments(self, limit=50):
         """Get all comments (admin only)"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT username, comment, rating, timestamp 
-            FROM comments 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (limit,))
-        return cursor.fetchall()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                SELECT username, comment, rating, timestamp 
+                FROM comments 
+                ORDER BY timestamp DESC 
+                LIMIT ?
+            ''', (limit,))
+            return cursor.fetchall()
     
     def get_statistics(self, days=30):
         """Get statistics for the last N days"""
-        cursor = self.conn.cursor()
-        
-        # Get total users
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # Get active users (last 7 days)
-        week_ago = datetime.now() - timedelta(days=7)
-        cursor.execute('''
-            SELECT COUNT(*) FROM users WHERE last_active > ?
-        ''', (week_ago,))
-        active_users = cursor.fetchone()[0]
-        
-        # Get total photos processed
-        cursor.execute('SELECT SUM(photo_count) FROM users')
-        total_photos = cursor.fetchone()[0] or 0
-        
-        # Get today's statistics
-        today = datetime.now().date()
-        cursor.execute('''
-            SELECT * FROM statistics WHERE date = ?
-        ''', (today,))
-        today_stats = cursor.fetchone()
-        
-        # Get template usage
-        cursor.execute('SELECT SUM(template1_used), SUM(template2_used), SUM(template3_used), SUM(removebg_used) FROM statistics')
-        template_usage = cursor.fetchone()
-        
-        return {
-            'total_users': total_users,
-            'active_users': active_users,
-            'total_photos': total_photos,
-            'today_stats': today_stats,
-            'template1_used': template_usage[0] or 0,
-            'template2_used': template_usage[1] or 0,
-            'template3_used': template_usage[2] or 0 if len(template_usage) > 2 else 0,
-            'removebg_used': template_usage[3] or 0 if len(template_usage) > 3 else 0
-        }
+        with self.lock:
+            cursor = self.conn.cursor()
+            
+            # Get total users
+            cursor.execute('SELECT COUNT(*) FROM users')
+            total_users = cursor.fetchone()[0]
+            
+            # Get active users (last 7 days)
+            week_ago = datetime.now() - timedelta(days=7)
+            cursor.execute('''
+                SELECT COUNT(*) FROM users WHERE last_active > ?
+            ''', (week_ago,))
+            active_users = cursor.fetchone()[0]
+            
+            # Get total photos processed
+            cursor.execute('SELECT SUM(photo_count) FROM users')
+            total_photos = cursor.fetchone()[0] or 0
+            
+            # Get today's statistics
+            today = datetime.now().date()
+            cursor.execute('''
+                SELECT * FROM statistics WHERE date = ?
+            ''', (today,))
+            today_stats = cursor.fetchone()
+            
+            # Get template usage
+            cursor.execute('SELECT SUM(template1_used), SUM(template2_used), SUM(template3_used), SUM(removebg_used) FROM statistics')
+            template_usage = cursor.fetchone()
+            
+            return {
+                'total_users': total_users,
+                'active_users': active_users,
+                'total_photos': total_photos,
+                'today_stats': today_stats,
+                'template1_used': template_usage[0] or 0,
+                'template2_used': template_usage[1] or 0,
+                'template3_used': template_usage[2] or 0 if len(template_usage) > 2 else 0,
+                'removebg_used': template_usage[3] or 0 if len(template_usage) > 3 else 0
+            }
     
     def save_broadcast(self, admin_id, message):
         """Save broadcast message"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO broadcasts (admin_id, message, timestamp)
-            VALUES (?, ?, ?)
-        ''', (admin_id, message, datetime.now()))
-        self.conn.commit()
-        return cursor.lastrowid
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                INSERT INTO broadcasts (admin_id, message, timestamp)
+                VALUES (?, ?, ?)
+            ''', (admin_id, message, datetime.now()))
+            self.conn.commit()
+            return cursor.lastrowid
     
     def update_broadcast_count(self, broadcast_id, count):
         """Update broadcast sent count"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE broadcasts SET sent_count = ? WHERE id = ?
-        ''', (count, broadcast_id))
-        self.conn.commit()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE broadcasts SET sent_count = ? WHERE id = ?
+            ''', (count, broadcast_id))
+            self.conn.commit()
     
     def get_all_users(self):
         """Get all user IDs for broadcasting"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id FROM users')
-        return [row[0] for row in cursor.fetchall()]
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT user_id FROM users')
+            return [row[0] for row in cursor.fetchall()]
     
     def close(self):
         """Close database connection"""
@@ -417,6 +663,889 @@ class Database:
 # Initialize database
 db = Database()
 
+# ============================================================================
+# REMOVE.BG CREDIT SCHEDULER
+# ============================================================================
+
+# Credits held back for admins, and for users who already finished a photo
+CREDIT_ADMIN_RESERVE = int(os.getenv('CREDIT_ADMIN_RESERVE', '5'))
+CREDIT_RETURNING_RESERVE = int(os.getenv('CREDIT_RETURNING_RESERVE', '10'))
+
+class CreditScheduler:
+    """Decide per render whether to spend a Remove.bg credit or remove locally
+
+    The credits left at the start of each day are spread evenly over the days
+    left in the month. Admins may use every credit, returning users everything
+    above the admin reserve and new users only what is above both reserves.
+    Renders over their tier's share of today go to the local fallback
+    instead of being rejected, so the bot keeps serving all month.
+    """
+    def __init__(self, tracker, admin_reserve, returning_reserve):
+        self.tracker = tracker
+        self.reserves = {
+            'admin': 0,
+            'returning': admin_reserve,
+            'new': admin_reserve + returning_reserve,
+        }
+    
+    def tier(self, user_id):
+        """Priority tier of a user"""
+        if user_id in ADMIN_IDS:
+            return 'admin'
+        return 'returning' if db.get_photo_count(user_id) > 0 else 'new'
+    
+    @staticmethod
+    def days_left():
+        """Days left in this month, including today"""
+        today = datetime.now().date()
+        next_month = (today.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return (next_month - today).days
+    
+    def daily_allowance(self, tier):
+        """Credits this tier may see used today (all tiers count towards it)"""
+        if tier == 'admin':
+            return self.tracker.total_limit()
+        
+        used_at_day_start = self.tracker.used_this_month() - self.tracker.used_today()
+        pool = self.tracker.total_limit() - used_at_day_start - self.reserves[tier]
+        if pool <= 0:
+            return 0
+        return max(1, -(-pool // self.days_left()))
+    
+    def route(self, user_id):
+        """Pick the background removal backend for a render: ('removebg' or 'fallback', tier)"""
+        tier = self.tier(user_id)
+        usage_info = self.tracker.get_usage_info()
+        
+        paid_backend = any(candidate.cost for candidate in background_router.backends)
+        if not paid_backend or not REMOVE_BG_API_KEYS or usage_info['remaining'] <= self.reserves[tier]:
+            backend = 'fallback'
+        elif self.tracker.used_today() >= self.daily_allowance(tier):
+            backend = 'fallback'
+        else:
+            backend = 'removebg'
+        
+        return backend, tier
+
+# Global credit scheduler
+credit_scheduler = CreditScheduler(usage_tracker, CREDIT_ADMIN_RESERVE, CREDIT_RETURNING_RESERVE)
+
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
+
+# action=burst/refills per minute, for each kind of update a user can send
+RATE_LIMITS = os.getenv('RATE_LIMITS', 'upload=5/3,preview=12/6,render=3/1,command=20/10')
+# Seconds between snapshots of the limiter to SQLite (0 keeps it in memory only)
+RATE_LIMIT_SNAPSHOT_INTERVAL = int(os.getenv('RATE_LIMIT_SNAPSHOT_INTERVAL', '60'))
+
+# What the cooldown message says the user is waiting for
+RATE_LIMIT_ACTIONS = {
+    'upload': "send another photo",
+    'preview': "preview another template",
+    'render': "create another image",
+    'command': "use the bot",
+}
+
+def parse_rate_limits(spec):
+    """Parse 'upload=5/3,render=3/1' into {action: (burst, per_minute)}"""
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        try:
+            action, _, rate = item.partition('=')
+            burst, _, per_minute = rate.partition('/')
+            limits[action.strip()] = (max(1, int(burst)), max(0.01, float(per_minute)))
+        except ValueError:
+            logger.error(f"Invalid rate limit '{item}' - ignored")
+    return limits
+
+class RateLimiter:
+    """Token buckets per user and action, so one user can't flood the bot
+
+    Each action has a burst of tokens that refills at a steady rate; every
+    update takes one. Checks only touch memory. Buckets that aren't full are
+    snapshot to SQLite now and then and at shutdown, and loaded at startup,
+    so a restart doesn't hand a spammer a fresh burst. Admins are exempt.
+    """
+    def __init__(self, limits, exempt_ids=(), db_file=None):
+        self.limits = limits
+        self.exempt_ids = set(exempt_ids)
+        self.db_file = db_file
+        self.buckets = {}  # (user_id, action) -> (tokens, time of last update)
+        self.notified_until = {}  # (user_id, action) -> end of the cooldown the user was told about
+        self.lock = threading.Lock()
+        self.snapshot_thread = None
+        if db_file:
+            self.load()
+
+    def acquire(self, user_id, action):
+        """Take a token: 0 if the action may go ahead, otherwise seconds until it may"""
+        if user_id in self.exempt_ids or action not in self.limits:
+            return 0
+        burst, per_minute = self.limits[action]
+        rate = per_minute / 60
+        now = time.time()
+        key = (user_id, action)
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def should_notify(self, user_id, action, wait):
+        """Whether to send the cooldown message (once per cooldown, not for every blocked tap)"""
+        now = time.time()
+        key = (user_id, action)
+        with self.lock:
+            if self.notified_until.get(key, 0) > now:
+                return False
+            self.notified_until[key] = now + wait
+            return True
+
+    def prune(self):
+        """Forget buckets that have refilled and cooldowns that are over"""
+        now = time.time()
+        with self.lock:
+            for (user_id, action), (tokens, updated) in list(self.buckets.items()):
+                burst, per_minute = self.limits.get(action, (0, 1))
+                if tokens + (now - updated) * per_minute / 60 >= burst:
+                    del self.buckets[user_id, action]
+            for key, until in list(self.notified_until.items()):
+                if until <= now:
+                    del self.notified_until[key]
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                user_id INTEGER,
+                action TEXT,
+                tokens REAL,
+                updated REAL,
+                PRIMARY KEY (user_id, action)
+            )
+        ''')
+        return conn
+
+    def load(self):
+        """Restore the buckets of the last snapshot"""
+        try:
+            conn = self.connect()
+            try:
+                rows = conn.execute('SELECT user_id, action, tokens, updated FROM rate_limit_buckets').fetchall()
+            finally:
+                conn.close()
+            with self.lock:
+                for user_id, action, tokens, updated in rows:
+                    self.buckets[user_id, action] = (tokens, updated)
+            self.prune()
+        except Exception as e:
+            logger.error(f"Error loading rate limits: {e}")
+
+    def snapshot(self):
+        """Replace the stored buckets with the ones in memory"""
+        if not self.db_file:
+            return
+        self.prune()
+        with self.lock:
+            rows = [(user_id, action, tokens, updated) for (user_id, action), (tokens, updated) in self.buckets.items()]
+        try:
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM rate_limit_buckets')
+                    conn.executemany('INSERT INTO rate_limit_buckets VALUES (?, ?, ?, ?)', rows)
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Error saving rate limits: {e}")
+
+    def start_snapshots(self, interval):
+        """Snapshot in a background thread every interval seconds (once per process)"""
+        if not self.db_file or interval <= 0 or self.snapshot_thread:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.snapshot()
+
+        self.snapshot_thread = threading.Thread(target=run, name='rate-limit-snapshots', daemon=True)
+        self.snapshot_thread.start()
+
+def callback_action(update):
+    """Rate limited action of a button tap"""
+    data = update.callback_query.data or ''
+    if data.startswith('render_'):
+        return 'render'
+    if data.startswith('select_'):
+        return 'preview'
+    return 'command'
+
+def rate_limited(action):
+    """Handler decorator: drop the update with a friendly message while the user is cooling down
+
+    action is an action name or a function of the update returning one.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            name = action(update) if callable(action) else action
+            wait = rate_limiter.acquire(user.id, name) if user else 0
+            if not wait:
+                return await handler(update, context)
+
+            metrics.inc('selamsnap_rate_limited_total', action=name)
+            notify = rate_limiter.should_notify(user.id, name, wait)
+            if wait < 90:
+                seconds = max(1, round(wait))
+                when = f"{seconds} second{'s' if seconds != 1 else ''}"
+            else:
+                when = f"{round(wait / 60)} minutes"
+            text = f"⏳ Easy there! You can {RATE_LIMIT_ACTIONS.get(name, 'do that')} again in {when}. 🙏"
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer(text if notify else None, show_alert=notify)
+                elif notify and update.effective_message:
+                    await update.effective_message.reply_text(text)
+            except Exception as e:
+                logger.error(f"Error sending cooldown message: {e}")
+        return wrapper
+    return decorator
+
+# Global rate limiter
+rate_limiter = RateLimiter(
+    parse_rate_limits(RATE_LIMITS),
+    ADMIN_IDS,
+    DATABASE_FILE if RATE_LIMIT_SNAPSHOT_INTERVAL > 0 else None
+)
+
+# ============================================================================
+# DUPLICATE TAP DE-DUPLICATION
+# ============================================================================
+
+# Taps on a preview or render that is already running start nothing (see inflight.py)
+in_flight = inflight.InFlightJobs(
+    user_data,
+    on_duplicate=lambda kind: metrics.inc('selamsnap_duplicate_taps_total', kind=kind)
+)
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+# Port of the Prometheus-style /metrics endpoint (disabled when unset)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0') or 0)
+
+class Metrics:
+    """In-memory counters, gauges and latency histograms"""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value or callable
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge to a value, or to a callable evaluated at scrape time"""
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+    
+    def add_gauge(self, name, value, **labels):
+        """Add to a numeric gauge"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        """Record a duration in a histogram"""
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+    
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time a pipeline stage and count its outcome"""
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.observe('selamsnap_stage_duration_seconds', time.perf_counter() - start, stage=stage, **labels)
+            self.inc('selamsnap_stage_total', stage=stage, status=status, **labels)
+    
+    @contextmanager
+    def in_progress(self, name, **labels):
+        """Count work in progress in a gauge"""
+        self.add_gauge(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add_gauge(name, -1, **labels)
+    
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+    
+    def render(self):
+        """Render all metrics in the Prometheus text format"""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        
+        lines = []
+        typed = set()
+        
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in sorted(counters.items()):
+            type_line(name, 'counter')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        
+        for (name, labels), value in sorted(gauges.items(), key=lambda item: item[0]):
+            try:
+                value = value() if callable(value) else value
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {e}")
+                continue
+            type_line(name, 'gauge')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            type_line(name, 'histogram')
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        
+        return '\n'.join(lines) + '\n'
+
+def start_metrics_server(port):
+    """Serve /metrics from a background thread"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Initialize metrics
+metrics = Metrics()
+metrics.set_gauge('selamsnap_removebg_credits_remaining', lambda: usage_tracker.get_usage_info()['remaining'])
+metrics.set_gauge('selamsnap_removebg_credits_used', lambda: usage_tracker.get_usage_info()['used'])
+metrics.set_gauge('selamsnap_removebg_credits_used_today', lambda: usage_tracker.used_today())
+for key_id, label in removebg_keys.labels.items():
+    metrics.set_gauge('selamsnap_removebg_key_credits_used',
+                      lambda key_id=key_id: usage_tracker.key_usage()[key_id], key=label)
+metrics.set_gauge('selamsnap_removebg_daily_allowance', lambda: credit_scheduler.daily_allowance('new'))
+metrics.set_gauge('selamsnap_users_selecting_template',
+                  lambda: sum(1 for info in list(user_data.values()) if info.get('photo_path')))
+for status in ('pending', 'running'):
+    metrics.set_gauge('selamsnap_render_jobs', lambda status=status: render_jobs.count(status), status=status)
+
+# ============================================================================
+# SLOW RENDER PROFILING
+# ============================================================================
+
+# Renders slower than this many seconds keep a cProfile profile (0 disables)
+RENDER_PROFILE_THRESHOLD = float(os.getenv('RENDER_PROFILE_THRESHOLD', '0') or 0)
+RENDER_PROFILE_DIR = os.getenv('RENDER_PROFILE_DIR', 'profiles')
+RENDER_PROFILE_KEEP = int(os.getenv('RENDER_PROFILE_KEEP', '20'))
+# Python 3.12+ allows one active profiler per process, so worker threads take turns
+render_profile_lock = threading.Lock()
+
+class RenderJobProfile:
+    """cProfile data of one render, collected only inside its CPU sections"""
+    def __init__(self, template_key, enabled):
+        self.template_key = template_key
+        self.profile = cProfile.Profile() if enabled else None
+        self.image_size = None
+        self.start = time.perf_counter()
+    
+    @contextmanager
+    def section(self):
+        """Profile a synchronous part of the render"""
+        if self.profile is None:
+            yield
+            return
+        
+        # Another render is being profiled right now - skip this one rather than wait
+        if not render_profile_lock.acquire(blocking=False):
+            self.profile = None
+            yield
+            return
+        
+        try:
+            self.profile.enable()
+        except Exception as e:
+            # Another profiling tool is active (a debugger, coverage) - never fail the render
+            render_profile_lock.release()
+            logger.warning(f"Render profiling skipped: {e}")
+            self.profile = None
+            yield
+            return
+        
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            render_profile_lock.release()
+    
+    async def run(self, func, *args):
+        """Run a CPU-bound part of the render in a worker thread, profiled there
+
+        The event loop keeps serving other users meanwhile, and concurrent
+        local background removals can be batched (see bg_backends.py).
+        """
+        def profiled():
+            with self.section():
+                return func(*args)
+        return await asyncio.to_thread(profiled)
+
+class RenderProfiler:
+    """Keep a bounded ring of profiles of renders slower than a threshold"""
+    def __init__(self, threshold, directory, keep):
+        self.threshold = threshold
+        self.directory = directory
+        self.keep = keep
+    
+    def start(self, template_key):
+        """Start profiling a render job"""
+        return RenderJobProfile(template_key, enabled=self.threshold > 0)
+    
+    def finish(self, job):
+        """Save the job's profile if it was slower than the threshold"""
+        if job.profile is None:
+            return
+        
+        elapsed = time.perf_counter() - job.start
+        if elapsed < self.threshold:
+            return
+        
+        try:
+            self.save(job, elapsed)
+        except Exception as e:
+            logger.error(f"Error saving render profile: {e}")
+    
+    def save(self, job, elapsed):
+        """Write the .prof file and a text summary, then trim the ring"""
+        os.makedirs(self.directory, exist_ok=True)
+        
+        size = f"{job.image_size[0]}x{job.image_size[1]}" if job.image_size else "unknown"
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{job.template_key}_{size}_{int(elapsed * 1000)}ms"
+        path = os.path.join(self.directory, name)
+        
+        job.profile.dump_stats(path + '.prof')
+        
+        summary = StringIO()
+        summary.write(f"template: {job.template_key}\nimage: {size}\nelapsed: {elapsed:.3f}s\n\n")
+        pstats.Stats(job.profile, stream=summary).sort_stats('cumulative').print_stats(25)
+        with open(path + '.txt', 'w') as f:
+            f.write(summary.getvalue())
+        
+        logger.warning(f"Slow render ({elapsed:.2f}s, {job.template_key}, {size}) - profile saved to {path}.prof")
+        
+        # Keep only the newest profiles
+        profiles = sorted(
+            (entry for entry in os.listdir(self.directory) if entry.endswith('.prof')),
+            reverse=True
+        )
+        for old in profiles[self.keep:]:
+            for extension in ('.prof', '.txt'):
+                old_path = os.path.join(self.directory, old[:-len('.prof')] + extension)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+# Initialize render profiler
+render_profiler = RenderProfiler(RENDER_PROFILE_THRESHOLD, RENDER_PROFILE_DIR, RENDER_PROFILE_KEEP)
+
+# ============================================================================
+# IMAGE INGEST
+# ============================================================================
+
+# Image documents larger than this are refused before downloading
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+# Most pixels an upload is ever decoded at - larger JPEGs are decoded reduced,
+# larger images in other formats are refused
+IMAGE_PIXEL_BUDGET = int(os.getenv('IMAGE_PIXEL_BUDGET', str(16_000_000)))
+# Peak memory a job may add to the process before it's logged as over budget
+# (default: ~24 bytes per budget pixel - the RGBA decode plus the working copies
+# of background removal and compositing)
+JOB_MEMORY_BUDGET_MB = int(os.getenv('JOB_MEMORY_BUDGET_MB', '0') or 0) or IMAGE_PIXEL_BUDGET * 24 // (1024 * 1024)
+
+INGEST_FORMATS = {'JPEG', 'MPO', 'PNG', 'WEBP', 'BMP', 'GIF', 'TIFF'}
+# Formats Pillow can decode at a reduced scale (draft mode)
+DRAFT_FORMATS = {'JPEG', 'MPO'}
+
+class ImageRejected(Exception):
+    """An upload refused by the ingest guard, with a message for the user"""
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+def image_source(source):
+    """Something Image.open reads: an upload's path on disk, or its bytes"""
+    return source if isinstance(source, str) else BytesIO(source)
+
+def read_image_header(source):
+    """Open an image without decoding it and check it against the ingest limits"""
+    try:
+        img = Image.open(image_source(source))
+    except Image.DecompressionBombError:
+        raise ImageRejected("❌ This image is far too large. Please send a smaller photo.", 'too_large')
+    except Exception:
+        raise ImageRejected("❌ I can't read this file as an image. Please send a JPEG or PNG photo.", 'unreadable')
+    
+    try:
+        if img.format not in INGEST_FORMATS:
+            raise ImageRejected(f"❌ {img.format} images aren't supported. Please send a JPEG or PNG photo.", 'format')
+        
+        width, height = img.size
+        if width * height > IMAGE_PIXEL_BUDGET and img.format not in DRAFT_FORMATS:
+            raise ImageRejected(
+                f"❌ This image is too large ({width}x{height}).\n\n"
+                f"Please send it as a photo instead of a file, or resize it below "
+                f"{IMAGE_PIXEL_BUDGET // 1_000_000} megapixels.",
+                'too_large'
+            )
+    except ImageRejected:
+        # Don't leave the rejected upload's file handle open
+        img.close()
+        raise
+    
+    return img
+
+def open_image(source):
+    """Decode an upload within IMAGE_PIXEL_BUDGET, reducing large JPEGs while decoding"""
+    img = read_image_header(source)
+    
+    width, height = img.size
+    if width * height > IMAGE_PIXEL_BUDGET:
+        # draft() picks the largest 1/2, 1/4, 1/8 reduction that is still at least
+        # the requested size, so asking for half the budget scale stays within it
+        scale = (IMAGE_PIXEL_BUDGET / (width * height)) ** 0.5 / 2
+        img.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+    
+    img.load()
+    return img
+
+def image_pixels(source):
+    """Pixel count from the image header (0 if it can't be read)"""
+    try:
+        with Image.open(image_source(source)) as img:
+            return img.width * img.height
+    except Exception:
+        return 0
+
+def image_dimensions(source):
+    """Width and height from the image header"""
+    with Image.open(image_source(source)) as img:
+        return img.size
+
+@contextmanager
+def open_upload(source):
+    """An upload to send in a request - opened as a file when it is on disk"""
+    if not isinstance(source, str):
+        yield source
+        return
+    
+    with open(source, 'rb') as f:
+        yield f
+
+def prune_uploads(max_age=uploads.UPLOAD_MAX_AGE):
+    """Delete abandoned uploads, except queued renders' photos"""
+    uploads.prune_uploads(max_age, keep=render_jobs.photo_paths())
+
+def set_user_photo(user_id, info):
+    """Replace a user's pending photo state, deleting the upload it replaces"""
+    uploads.set_user_photo(user_data, user_id, info, keep=render_jobs.photo_paths())
+
+def current_rss_bytes():
+    """Resident memory of this process"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return 0
+
+class JobMemory:
+    """Peak resident memory seen while one job ran"""
+    def __init__(self, name):
+        self.name = name
+        self.start_rss = current_rss_bytes()
+        self.peak_rss = self.start_rss
+    
+    @property
+    def peak_increase(self):
+        return self.peak_rss - self.start_rss
+
+class JobMemoryWatch:
+    """Sample process RSS in the background while jobs run
+
+    Samples are process-wide, so a job's peak includes jobs running next to
+    it; it is still the number that decides whether the container survives.
+    """
+    def __init__(self, budget_bytes, interval=0.02):
+        self.budget_bytes = budget_bytes
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = set()
+        self.thread = None
+    
+    def start(self, name):
+        """Start watching a job"""
+        job = JobMemory(name)
+        with self.lock:
+            self.jobs.add(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='memory-watch', daemon=True)
+                self.thread.start()
+        return job
+    
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.thread = None
+                    return
+                jobs = list(self.jobs)
+            
+            rss = current_rss_bytes()
+            for job in jobs:
+                job.peak_rss = max(job.peak_rss, rss)
+            time.sleep(self.interval)
+    
+    def finish(self, job):
+        """Stop watching a job and record its peak against the budget"""
+        with self.lock:
+            self.jobs.discard(job)
+        job.peak_rss = max(job.peak_rss, current_rss_bytes())
+        
+        metrics.set_gauge('selamsnap_job_peak_memory_bytes', job.peak_increase, job=job.name)
+        if job.peak_increase > self.budget_bytes:
+            metrics.inc('selamsnap_jobs_over_memory_budget_total', job=job.name)
+            logger.warning(
+                f"{job.name} job used {job.peak_increase / (1024 * 1024):.0f}MB, "
+                f"over the {self.budget_bytes // (1024 * 1024)}MB budget"
+            )
+
+# Initialize job memory watch
+job_memory = JobMemoryWatch(JOB_MEMORY_BUDGET_MB * 1024 * 1024)
+
+# ============================================================================
+# RENDER JOB QUEUE
+# ============================================================================
+
+# Attempts a render gets, counting runs cut short by a crash or restart
+RENDER_JOB_MAX_ATTEMPTS = int(os.getenv('RENDER_JOB_MAX_ATTEMPTS', '3'))
+# Seconds before a failed attempt is retried, times the attempts so far
+RENDER_JOB_RETRY_DELAY = float(os.getenv('RENDER_JOB_RETRY_DELAY', '5'))
+# Unfinished jobs older than this are given up at startup, finished ones forgotten
+RENDER_JOB_MAX_AGE = uploads.UPLOAD_MAX_AGE
+
+# Errors that another attempt won't fix
+RENDER_JOB_PERMANENT_ERRORS = (ImageRejected, FileNotFoundError, KeyError)
+
+class RenderJobQueue:
+    """Full quality renders in SQLite, so a crash or restart doesn't lose them
+
+    A job is 'pending' until a worker claims it ('running'), then 'done' once
+    the photo is sent, or back to 'pending' for a retry, or 'failed' when the
+    attempts are used up. Jobs are keyed by the preview they confirm, so the
+    same confirmation never queues two renders, and completing a job twice
+    is a no-op: statistics are only counted by the call that completes it.
+    The job row holds everything a render needs (chat, photo on disk,
+    template, backend), so it doesn't depend on user_data surviving.
+    """
+    COLUMNS = ('id', 'job_key', 'user_id', 'chat_id', 'template_key', 'photo_path', 'backend',
+               'message_id', 'status', 'attempts', 'error', 'created', 'updated', 'cutout_path')
+    
+    def __init__(self, db_file, max_attempts=RENDER_JOB_MAX_ATTEMPTS, max_age=RENDER_JOB_MAX_AGE):
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.setup_tables()
+        self.interrupted = []  # jobs recover() gave up, for resume_render_jobs to report
+    
+    def setup_tables(self):
+        """Create the job table"""
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS render_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_key TEXT UNIQUE,
+                    user_id INTEGER,
+                    chat_id INTEGER,
+                    template_key TEXT,
+                    photo_path TEXT,
+                    backend TEXT,
+                    message_id INTEGER,
+                    status TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    created REAL,
+                    updated REAL
+                )
+            ''')
+            # Paid cut-out kept for retries (tables from before it get the column)
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(render_jobs)')]
+            if 'cutout_path' not in columns:
+                self.conn.execute('ALTER TABLE render_jobs ADD COLUMN cutout_path TEXT')
+    
+    def execute(self, sql, params=()):
+        """Run one statement (autocommitted); returns (rows, rowcount)"""
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+    
+    def select(self, where, params=()):
+        rows, _ = self.execute(f"SELECT {', '.join(self.COLUMNS)} FROM render_jobs WHERE {where}", params)
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+    
+    def get(self, job_id):
+        jobs = self.select('id = ?', (job_id,))
+        return jobs[0] if jobs else None
+    
+    def enqueue(self, job_key, user_id, chat_id, template_key, photo_path, backend):
+        """Queue a render; returns (job, False) if a job with this key already exists"""
+        now = time.time()
+        _, created = self.execute('''
+            INSERT OR IGNORE INTO render_jobs
+            (job_key, user_id, chat_id, template_key, photo_path, backend, status, created, updated)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+        ''', (job_key, user_id, chat_id, template_key, photo_path, backend, now, now))
+        return self.select('job_key = ?', (job_key,))[0], created == 1
+    
+    def set_message(self, job_id, message_id):
+        """Remember the progress message, so a resumed job edits it"""
+        self.execute('UPDATE render_jobs SET message_id = ? WHERE id = ?', (message_id, job_id))
+    
+    def set_cutout(self, job_id, cutout_path):
+        """Remember a paid cut-out, so retries and resumes don't pay for it again"""
+        self.execute('UPDATE render_jobs SET cutout_path = ? WHERE id = ?', (cutout_path, job_id))
+    
+    def claim(self, job_id):
+        """Start an attempt at a pending job; None if it isn't pending (done, failed or already claimed)"""
+        _, claimed = self.execute('''
+            UPDATE render_jobs SET status = 'running', attempts = attempts + 1, updated = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (time.time(), job_id))
+        return self.get(job_id) if claimed else None
+    
+    def complete(self, job_id):
+        """Mark a running job done; True only for the call that did"""
+        _, completed = self.execute('''
+            UPDATE render_jobs SET status = 'done', error = NULL, updated = ?
+            WHERE id = ? AND status = 'running'
+        ''', (time.time(), job_id))
+        return completed == 1
+    
+    def fail(self, job_id, error, retry=True):
+        """Record a failed attempt; returns the job's new state ('pending' to retry, or 'failed')"""
+        job = self.get(job_id)
+        status = 'pending' if retry and job and job['attempts'] < self.max_attempts else 'failed'
+        self.execute('''
+            UPDATE render_jobs SET status = ?, error = ?, updated = ?
+            WHERE id = ? AND status = 'running'
+        ''', (status, error, time.time(), job_id))
+        return status
+    
+    def recover(self):
+        """When polling starts: requeue renders cut short by the last run and give up stale or exhausted ones
+
+        Only the bot's post_init may call this, once the previous application
+        (if any) has stopped - it takes over every running job, so calling it
+        next to a live bot would render that bot's jobs twice.
+        The jobs given up are kept in self.interrupted, so their users can be told.
+        """
+        try:
+            now = time.time()
+            self.execute('''
+                UPDATE render_jobs SET status = 'pending', updated = ?
+                WHERE status = 'running' AND attempts < ?
+            ''', (now, self.max_attempts))
+            given_up = self.select(
+                "(status = 'running') OR (status = 'pending' AND created < ?)", (now - self.max_age,)
+            )
+            for job in given_up:
+                job['error'] = "Interrupted too many times" if job['status'] == 'running' else "Waited too long"
+                job['status'] = 'failed'
+                self.execute('''
+                    UPDATE render_jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?
+                ''', (job['error'], now, job['id']))
+            self.execute("DELETE FROM render_jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                         (now - self.max_age,))
+            self.interrupted = given_up
+        except Exception as e:
+            logger.error(f"Error recovering render jobs: {e}")
+    
+    def pending(self):
+        """Jobs waiting for a worker, oldest first"""
+        return self.select("status = 'pending' ORDER BY id")
+    
+    def photo_paths(self):
+        """Uploads (and saved cut-outs) that pending and running jobs still need"""
+        paths = set()
+        for job in self.select("status IN ('pending', 'running')"):
+            paths.update(path for path in (job['photo_path'], job['cutout_path']) if path)
+        return paths
+    
+    def count(self, status):
+        rows, _ = self.execute('SELECT COUNT(*) FROM render_jobs WHERE status = ?', (status,))
+        return rows[0][0]
+
+# Initialize render job queue
+render_jobs = RenderJobQueue(DATABASE_FILE)
+
 # ============================================================================
 # IMAGE PROCESSING FUNCTIONS WITH REMOVE.BG API
 # ============================================================================
@@ -427,144 +1556,158 @@ def ensure_directories():
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
-def extract_human_using_removebg(image_bytes, max_file_size=8*1024*1024):
-    """Remove background using Remove.bg API"""
-    
-    # Check if we have API key
-    if not REMOVE_BG_API_KEY:
-        logger.error("No Remove.bg API key configured")
-        raise Exception("Remove.bg API key not configured")
-    
-    # Check monthly limit
-    if not usage_tracker.can_process():
-        raise Exception(f"Remove.bg monthly limit reached ({usage_tracker.monthly_limit} images). Please try again next month.")
-    
-    # Check file size (Remove.bg has limits)
-    if len(image_bytes) > max_file_size:
-        # Resize image if too large
-        img = Image.open(BytesIO(image_bytes))
-        img.thumbnail((1500, 1500))  # Resize to max 1500px
-        img_byte_arr = BytesIO()
-        img.save(img_byte_arr, format='PNG', optimize=True, quality=85)
-        image_bytes = img_byte_arr.getvalue()
+def post_to_removebg(api_key, image_source):
+    """Send one image to the Remove.bg API"""
+    headers = {
+        'X-Api-Key': api_key,
+    }
     
-    try:
-        # Prepare API request
-        headers = {
-            'X-Api-Key': REMOVE_BG_API_KEY,
-        }
-        
+    with open_upload(image_source) as image_file:
         files = {
-            'image_file': ('image.png', image_bytes, 'image/png'),
+            'image_file': ('image.png', image_file, 'image/png'),
             'size': (None, 'auto'),
             'type': (None, 'auto'),
         }
         
-        # Make API request
-        response = requests.post(
+        return requests.post(
             REMOVE_BG_API_URL,
             headers=headers,
             files=files,
             timeout=30
         )
+
+def extract_human_using_removebg(image_source, max_file_size=8*1024*1024):
+    """Remove background using Remove.bg API (image_source is an upload's path or bytes)"""
+    
+    # Check if we have API key
+    if not REMOVE_BG_API_KEYS:
+        logger.error("No Remove.bg API key configured")
+        raise Exception("Remove.bg API key not configured")
+    
+    # Check file size (Remove.bg has limits) and pixel count
+    file_size = os.path.getsize(image_source) if isinstance(image_source, str) else len(image_source)
+    if file_size > max_file_size or image_pixels(image_source) > IMAGE_PIXEL_BUDGET:
+        # Resize image if too large
+        img = open_image(image_source)
+        img.thumbnail((1500, 1500))  # Resize to max 1500px
+        img_byte_arr = BytesIO()
+        img.save(img_byte_arr, format='PNG', optimize=True, quality=85)
+        image_source = img_byte_arr.getvalue()
+    
+    # A key that is rate limited, out of credits or can't get an answer hands the image to the next one
+    tried = set()
+    transient_error = None
+    for _ in range(len(REMOVE_BG_API_KEYS)):
+        # Reserve the credit before the call so concurrent renders in any process can't overspend
+        api_key, reservation = removebg_keys.acquire(exclude=tried)
+        if not api_key:
+            break
+        tried.add(reservation[2])
+        charged = False
         
-        if response.status_code == 200:
-            # Success - increment usage counter
-            usage_tracker.increment_usage()
-            db.increment_removebg_count()
-            
-            # Convert response to image
-            result_image = Image.open(BytesIO(response.content)).convert("RGBA")
+        try:
+            response = post_to_removebg(api_key, image_source)
             
-            # Check if the image has transparency (alpha channel)
-            if result_image.mode == 'RGBA':
-                # Process to clean up edges
-                result_array = np.array(result_image)
+            if response.status_code == 200:
+                # Success - the reserved credit is spent
+                charged = True
+                removebg_keys.record_result(reservation, True)
+                db.increment_removebg_count()
+                
+                # Convert response to image
+                result_image = open_image(response.content).convert("RGBA")
                 
-                # Create a mask from alpha channel
-                alpha = result_array[:, :, 3]
+                # Crop to the bounding box of non-transparent pixels
+                # (getbbox scans the alpha band without index arrays the size of the image)
+                bbox = result_image.getchannel('A').getbbox()
+                if bbox:
+                    result_image = result_image.crop(bbox)
                 
-                # Find bounding box of non-transparent pixels
-                non_zero = np.where(alpha > 0)
-                if len(non_zero[0]) > 0 and len(non_zero[1]) > 0:
-                    min_y, max_y = np.min(non_zero[0]), np.max(non_zero[0])
-                    min_x, max_x = np.min(non_zero[1]), np.max(non_zero[1])
-                    
-                    # Crop to content
-                    result_image = result_image.crop((min_x, min_y, max_x, max_y))
+                logger.info(f"Remove.bg API success - Remaining: {usage_tracker.get_usage_info()['remaining']}")
+                return result_image
+                
+            elif response.status_code == 402:
+                # Payment required - this key's credits are used up
+                charged = True
+                usage_tracker.exhaust(reservation)
+                logger.warning(f"Remove.bg {removebg_keys.labels[reservation[2]]} has no credits left")
             
-            logger.info(f"Remove.bg API success - Remaining: {usage_tracker.get_usage_info()['remaining']}")
-            return result_image
+            elif response.status_code == 429:
+                # Rate limited - rest this key and try the next
+                retry_after = response.headers.get('Retry-After', '')
+                removebg_keys.cool_down(
+                    reservation, int(retry_after) if retry_after.isdigit() else REMOVE_BG_RATE_LIMIT_COOLDOWN
+                )
             
-        elif response.status_code == 402:
-            # Payment required - monthly limit reached
-            usage_info = usage_tracker.get_usage_info()
-            raise Exception(f"Remove.bg monthly limit reached ({usage_info['used']}/{usage_info['limit']} images). Please try again next month.")
-        
-        elif response.status_code == 429:
-            # Rate limited
-            raise Exception("Remove.bg API rate limit exceeded. Please try again in a few seconds.")
-        
-        else:
-            # Other API error
-            error_text = response.text[:200] if response.text else "Unknown error"
-            logger.error(f"Remove.bg API error {response.status_code}: {error_text}")
-            raise Exception(f"Remove.bg API error: {response.status_code}")
+            elif response.status_code >= 500:
+                # Server error - the next key may get through
+                removebg_keys.record_result(reservation, False)
+                logger.error(f"Remove.bg API error {response.status_code} with {removebg_keys.labels[reservation[2]]}")
+                transient_error = f"Remove.bg API error: {response.status_code}"
             
-    except requests.exceptions.Timeout:
-        logger.error("Remove.bg API timeout")
-        raise Exception("Remove.bg API timeout. Please try again.")
-    except requests.exceptions.ConnectionError:
-        logger.error("Remove.bg API connection error")
-        raise Exception("Cannot connect to Remove.bg service. Please check your internet connection.")
-    except Exception as e:
-        logger.error(f"Remove.bg processing error: {e}")
-        raise e
+            else:
+                # Other API error - the image itself was refused, the next key won't help
+                error_text = response.text[:200] if response.text else "Unknown error"
+                logger.error(f"Remove.bg API error {response.status_code}: {error_text}")
+                raise Exception(f"Remove.bg API error: {response.status_code}")
+                
+        except requests.exceptions.Timeout:
+            removebg_keys.record_result(reservation, False)
+            logger.error(f"Remove.bg API timeout with {removebg_keys.labels[reservation[2]]}")
+            transient_error = "Remove.bg API timeout. Please try again."
+        except requests.exceptions.ConnectionError:
+            removebg_keys.record_result(reservation, False)
+            logger.error(f"Remove.bg API connection error with {removebg_keys.labels[reservation[2]]}")
+            transient_error = "Cannot connect to Remove.bg service. Please check your internet connection."
+        except Exception as e:
+            if not charged:
+                # The call failed before a credit was spent - count it against the key
+                removebg_keys.record_result(reservation, False)
+            logger.error(f"Remove.bg processing error: {e}")
+            raise e
+        finally:
+            if not charged:
+                usage_tracker.refund(reservation)
+    
+    if transient_error:
+        raise Exception(transient_error)
+    if removebg_keys.cooling_down():
+        raise Exception("Remove.bg API rate limit exceeded. Please try again in a few seconds.")
+    usage_info = usage_tracker.get_usage_info()
+    raise Exception(f"Remove.bg monthly limit reached ({usage_info['used']}/{usage_info['limit']} images). Please try again next month.")
+
+# Remove.bg is a paid backend: one credit per image
+bg_backends.register_backend('removebg', lambda option, opener: bg_backends.FunctionBackend(
+    'removebg', extract_human_using_removebg, cost=1, expected_latency=3.0,
+    available=lambda: bool(REMOVE_BG_API_KEYS) and removebg_keys.ready() and usage_tracker.can_process()
+))
+
+def observe_background_removal(backend_name, seconds, ok):
+    """Record every backend attempt like the other pipeline stages"""
+    metrics.observe('selamsnap_stage_duration_seconds', seconds, stage='background_removal', backend=backend_name)
+    metrics.inc('selamsnap_stage_total', stage='background_removal', status='ok' if ok else 'error', backend=backend_name)
 
-def extract_human_from_image(image_bytes):
-    """Main function to extract human from image - uses Remove.bg API"""
+# Backends come from BG_BACKENDS / BG_ROUTING (see bg_backends.py)
+background_router = bg_backends.router_from_env('removebg,threshold', open_image, observe_background_removal)
+
+def extract_human_from_image(image_source, allow_paid=True):
+    """Main function to extract human from image - uses the configured backends"""
     try:
-        return extract_human_using_removebg(image_bytes)
+        human_image, _ = background_router.remove(image_source, allow_paid)
+        return human_image
     except Exception as e:
-        logger.error(f"Remove.bg failed: {e}")
-        
-        # If Remove.bg fails, try to use a simple fallback (basic background removal)
-        try:
-            return simple_background_removal(image_bytes)
-        except Exception as fallback_error:
-            logger.error(f"Fallback also failed: {fallback_error}")
-            # Return original image with transparent background
-            img = Image.open(BytesIO(image_bytes)).convert("RGBA")
-            return img
-
-def simple_background_removal(image_bytes):
+        logger.error(f"Background removal failed: {e}")
+        # Return original image with transparent background
+        img = open_image(image_source).convert("RGBA")
+        return img
+
+def simple_background_removal(image_source):
     """Simple background removal as fallback when Remove.bg fails"""
-    img = Image.open(BytesIO(image_bytes)).convert("RGBA")
-    
-    # Convert to numpy array
-    img_array = np.array(img)
-    
-    # Simple background removal based on color detection
-    # This is a very basic implementation
-    h, w = img_array.shape[:2]
-    
-    # Create mask (simple threshold on alpha or color)
-    # This is a placeholder - you might need to adjust based on your images
-    if img_array.shape[2] == 4:
-        alpha = img_array[:, :, 3]
-        mask = alpha > 10
-    else:
-        # Convert to grayscale and threshold
-        from PIL import ImageOps
-        gray = ImageOps.grayscale(img)
-        gray_array = np.array(gray)
-        mask = gray_array > 50
-    
-    # Apply mask
-    result_array = np.zeros((h, w, 4), dtype=np.uint8)
-    result_array[mask] = img_array[mask]
-    
-    return Image.fromarray(result_array)
+    return simple_background_removal_from_image(open_image(image_source))
+
+def simple_background_removal_from_image(img):
+    """Simple background removal on an already opened image"""
+    return bg_backends.threshold_cutout(img)
 
 def resize_image_proportionally(image, scale_factor=0.75):
     """Resize image proportionally by scale factor"""
@@ -582,6 +1725,14 @@ def resize_to_height(image, target_height):
     
     return image.resize((target_width, target_height), Image.Resampling.LANCZOS)
 
+def scale_canvas(template, output_width=None):
+    """Scale a template canvas down to output_width (used for quick previews)"""
+    if not output_width or template.width <= output_width:
+        return template
+    
+    output_height = int(template.height * output_width / template.width)
+    return template.resize((output_width, output_height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
 def create_simple_background():
     """Create a simple background for template 1"""
     size = (1080, 1920)
@@ -673,174 +1824,413 @@ def create_template2_overlay(width, height):
     
     draw.text((text_x, text_y), text, font=font, fill=(255, 255, 255, 255))
     
-    return overlay
+    return overlay
+
+# ============================================================================
+# WARM BUNDLE
+# ============================================================================
+
+# Directory written by build_warm_bundle.py
+WARM_BUNDLE_DIR = os.getenv('WARM_BUNDLE_DIR', 'warm_bundle')
+WARM_BUNDLE_MANIFEST = 'manifest.json'
+
+def layer_bundle_key(layer, canvas_size):
+    """Key of the image a template layer resolves to (its file contents or its fallback)"""
+    source = layer.get('source')
+    if source and os.path.exists(source):
+        with open(source, 'rb') as f:
+            return f"file:{source}:{hashlib.md5(f.read()).hexdigest()}"
+    
+    fallback = layer.get('fallback')
+    if fallback:
+        size = f"{canvas_size[0]}x{canvas_size[1]}" if canvas_size else 'native'
+        return f"fallback:{fallback}:{size}"
+    
+    return None
+
+class WarmBundle:
+    """Template layers decoded at build time and memory-mapped at runtime
+
+    Layers are raw RGBA .npy files keyed by layer_bundle_key(), so an asset
+    that changed after the build is simply not found and loaded as before.
+    The pages are mapped read-only, so every bot process shares them.
+    """
+    def __init__(self, directory=WARM_BUNDLE_DIR):
+        self.directory = directory
+        self.manifest = {'layers': {}, 'models': {}}
+        self.loaded = False
+        self.load()
+    
+    def load(self):
+        """Load the bundle manifest if the bundle was built"""
+        path = os.path.join(self.directory, WARM_BUNDLE_MANIFEST)
+        try:
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    self.manifest = json.load(f)
+                self.loaded = True
+        except Exception as e:
+            logger.error(f"Error loading warm bundle: {e}")
+    
+    def layer_image(self, key):
+        """Memory-map a bundled layer as a read-only RGBA image (None if not bundled)"""
+        entry = self.manifest['layers'].get(key) if key else None
+        if entry is None:
+            return None
+        
+        try:
+            pixels = np.load(os.path.join(self.directory, entry['file']), mmap_mode='r')
+            return Image.fromarray(pixels, 'RGBA')
+        except Exception as e:
+            logger.error(f"Error loading bundled layer {key}: {e}")
+            return None
+
+# Initialize warm bundle
+warm_bundle = WarmBundle()
+
+# ============================================================================
+# TEMPLATE ENGINE
+# ============================================================================
+
+# Procedural stand-ins for template assets that are missing or unreadable
+LAYER_GENERATORS = {
+    'simple_background': lambda canvas_size: create_simple_background(),
+    'template2_background': lambda canvas_size: create_template2_background(),
+    'template3_background': lambda canvas_size: create_template3_background(),
+    'template2_overlay': lambda canvas_size: create_template2_overlay(*canvas_size),
+}
+
+def resize_to_width(image, target_width):
+    """Resize image to target width while maintaining aspect ratio"""
+    original_width, original_height = image.size
+    target_height = int(original_height * (target_width / original_width))
+    
+    return image.resize((target_width, target_height), Image.Resampling.LANCZOS)
+
+def composite_layer(canvas, layer_image, position):
+    """Alpha-composite layer_image onto canvas, clipping it to the canvas"""
+    x, y = position
+    left, top = max(0, -x), max(0, -y)
+    right = min(layer_image.width, canvas.width - x)
+    bottom = min(layer_image.height, canvas.height - y)
+    
+    if right <= left or bottom <= top:
+        return
+    
+    canvas.alpha_composite(layer_image, dest=(x + left, y + top), source=(left, top, right, bottom))
 
-def apply_template1(human_image, template_info):
-    """Apply template 1 - Cloud on top"""
-    try:
-        # Load template background
-        template_path = template_info['template_image']
-        if os.path.exists(template_path):
-            template = Image.open(template_path).convert('RGBA')
-        else:
-            template = create_simple_background()
-        
-        template_width, template_height = template.size
-        
-        # Resize human image
-        human_scale = template_info['elements'].get('human_size', 0.75)
-        target_human_height = int(template_height * human_scale)
-        human_resized = resize_to_height(human_image, target_human_height)
-        
-        # Position human 30% from bottom
-        human_width, human_height = human_resized.size
-        human_position_y = template_info['elements'].get('human_position_y', 0.30)
-        human_y = int(template_height * (1 - human_position_y) - human_height)
-        human_x = (template_width - human_width) // 2
+OVERLAY_TILE_SIZE = 128
+
+class OverlayTile:
+    """Part of a flattened overlay, cropped to its visible pixels
+
+    Compositing is a single paste of the RGBA tile onto the RGB canvas, using
+    its own alpha as the mask (no mask at all when the tile is fully opaque).
+    """
+    def __init__(self, image, box, opaque=None):
+        self.box = box
+        self.image = image
+        if opaque is None:
+            opaque = image.getchannel('A').getextrema() == (255, 255)
+        self.opaque = opaque
+    
+    def composite_onto(self, canvas):
+        """Composite this tile onto an RGB canvas in place"""
+        canvas.paste(self.image, self.box[:2], None if self.opaque else self.image)
+
+def split_overlay_into_tiles(overlay, tile_size=OVERLAY_TILE_SIZE):
+    """Split an RGBA overlay into tiles bounded by their non-transparent pixels"""
+    alpha = overlay.getchannel('A')
+    tiles = []
+    
+    for top in range(0, overlay.height, tile_size):
+        for left in range(0, overlay.width, tile_size):
+            cell = (left, top, min(left + tile_size, overlay.width), min(top + tile_size, overlay.height))
+            bbox = alpha.crop(cell).getbbox()
+            if not bbox:
+                continue
+            
+            box = (left + bbox[0], top + bbox[1], left + bbox[2], top + bbox[3])
+            tiles.append(OverlayTile(overlay.crop(box), box))
+    
+    return tiles
+
+class TemplateFrame:
+    """Static layers of a template, pre-composited below and above the subject"""
+    def __init__(self, size, underlay, overlay_tiles, subject, canvas_scale, fingerprint):
+        self.size = size
+        self.underlay = underlay
+        self.overlay_tiles = overlay_tiles
+        self.subject = subject
+        self.canvas_scale = canvas_scale
+        self.fingerprint = fingerprint
+        self.underlay_buffer = None  # raw RGBX pixels when attached from a FrameStore
+    
+    def new_canvas(self):
+        """Private RGB copy of the underlay to composite a render onto"""
+        if self.underlay_buffer is not None:
+            # Unpacking RGBX straight into RGB is as fast as a copy (convert() is ~4x slower)
+            return Image.frombytes('RGB', self.size, self.underlay_buffer, 'raw', 'RGBX')
+        return self.underlay.copy()
+
+# Flattened frames are written here once as raw buffers and memory-mapped by
+# every render process ('' keeps frames in process memory only)
+FRAME_CACHE_DIR = os.getenv('FRAME_CACHE_DIR', os.path.join(WARM_BUNDLE_DIR, 'frames'))
+
+class FrameStore:
+    """Template frames as raw 4-byte-per-pixel files shared through mmap
+
+    The underlay is stored as RGBX and the overlay tiles as RGBA, the modes
+    Image.frombuffer maps without copying, so a frame attached by any number
+    of processes is one read-only copy in the page cache. Files are named by
+    template fingerprint and replaced atomically, so concurrent writers are
+    harmless and stale frames are never attached.
+    """
+    def __init__(self, directory=FRAME_CACHE_DIR):
+        self.directory = directory
+    
+    def path(self, template_key, output_width, fingerprint):
+        return os.path.join(self.directory, f"{template_key}-{output_width or 'full'}-{fingerprint}")
+    
+    def load(self, template_key, output_width, fingerprint):
+        """Attach a stored frame read-only (None if it isn't stored)"""
+        if not self.directory:
+            return None
         
-        # Load and position cloud
-        cloud_path = template_info['elements'].get('cloud')
-        cloud_on_top = template_info['elements'].get('cloud_on_top', True)
+        path = self.path(template_key, output_width, fingerprint)
+        if not os.path.exists(path + '.json'):
+            return None
         
-        if cloud_path and os.path.exists(cloud_path):
-            cloud = Image.open(cloud_path).convert('RGBA')
+        try:
+            with open(path + '.json', 'r') as f:
+                meta = json.load(f)
+            with open(path + '.raw', 'rb') as f:
+                buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
             
-            # Resize cloud
-            cloud_target_width = int(template_width * 0.8)
-            cloud_target_height = int(cloud.height * (cloud_target_width / cloud.width))
-            cloud = cloud.resize((cloud_target_width, cloud_target_height), Image.Resampling.LANCZOS)
+            size = tuple(meta['size'])
+            underlay_buffer = buffer[:size[0] * size[1] * 4]
+            underlay = Image.frombuffer('RGBX', size, underlay_buffer, 'raw', 'RGBX', 0, 1)
             
-            # Position cloud 35% from bottom
-            cloud_position_y = template_info['elements'].get('cloud_position_y', 0.35)
-            cloud_y = int(template_height * (1 - cloud_position_y) - cloud_target_height)
-            cloud_x = (template_width - cloud_target_width) // 2
-        else:
-            cloud = None
-        
-        # Create composite image
-        composite = template.copy()
+            tiles = []
+            for left, top, right, bottom, offset, opaque in meta['tiles']:
+                tile_size = (right - left, bottom - top)
+                pixels = buffer[offset:offset + tile_size[0] * tile_size[1] * 4]
+                image = Image.frombuffer('RGBA', tile_size, pixels, 'raw', 'RGBA', 0, 1)
+                tiles.append(OverlayTile(image, (left, top, right, bottom), opaque))
+            
+            frame = TemplateFrame(size, underlay, tiles, meta['subject'], meta['canvas_scale'], fingerprint)
+            frame.underlay_buffer = underlay_buffer
+            return frame
+        except Exception as e:
+            logger.error(f"Error attaching frame {path}: {e}")
+            return None
+    
+    def save(self, template_key, output_width, frame):
+        """Store a frame and return it attached from the store (or unchanged on failure)"""
+        if not self.directory:
+            return frame
         
-        if cloud_on_top:
-            # 1. First paste human
-            composite.paste(human_resized, (human_x, human_y), human_resized)
+        path = self.path(template_key, output_width, frame.fingerprint)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
             
-            # 2. Then paste cloud ON TOP
-            if cloud:
-                composite.paste(cloud, (cloud_x, cloud_y), cloud)
-        else:
-            # 1. First paste cloud
-            if cloud:
-                composite.paste(cloud, (cloud_x, cloud_y), cloud)
+            # Renders in other threads may store the same frame at the same time
+            tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            tiles = []
+            offset = frame.size[0] * frame.size[1] * 4
+            with open(path + '.raw' + tmp_suffix, 'wb') as f:
+                f.write(frame.underlay.tobytes('raw', 'RGBX'))
+                for tile in frame.overlay_tiles:
+                    pixels = tile.image.convert('RGBA').tobytes()
+                    f.write(pixels)
+                    tiles.append(list(tile.box) + [offset, tile.opaque])
+                    offset += len(pixels)
             
-            # 2. Then paste human ON TOP
-            composite.paste(human_resized, (human_x, human_y), human_resized)
-        
-        return composite
-        
-    except Exception as e:
-        logger.error(f"Error applying template 1: {e}")
-        return create_fallback_result(human_image, template_info)
-
-def apply_template2(human_image, template_info):
-    """Apply template 2 - Human at bottom with overlay on top"""
-    try:
-        # Load template background
-        template_path = template_info['template_image']
-        if os.path.exists(template_path):
-            template = Image.open(template_path).convert('RGBA')
+            meta = {'size': list(frame.size), 'canvas_scale': frame.canvas_scale,
+                    'subject': frame.subject, 'tiles': tiles}
+            with open(path + '.json' + tmp_suffix, 'w') as f:
+                json.dump(meta, f)
+            
+            # The metadata goes last - a frame is only attached once it exists
+            os.replace(path + '.raw' + tmp_suffix, path + '.raw')
+            os.replace(path + '.json' + tmp_suffix, path + '.json')
+            self.remove_stale(template_key, output_width, frame.fingerprint)
+        except Exception as e:
+            logger.error(f"Error storing frame {path}: {e}")
+            return frame
+        
+        return self.load(template_key, output_width, frame.fingerprint) or frame
+    
+    def remove_stale(self, template_key, output_width, fingerprint):
+        """Delete frames of this template and size built from older assets"""
+        prefix = f"{template_key}-{output_width or 'full'}-"
+        current = os.path.basename(self.path(template_key, output_width, fingerprint))
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and not name.startswith(current):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+class TemplateEngine:
+    """Render templates from the declarative layer lists in TEMPLATES
+
+    Every layer has a type (background, subject, cloud, overlay), a z-order,
+    a scale mode and an anchor:
+
+    * scale_mode 'fill' stretches the layer over the canvas, 'width' and
+      'height' size it relative to the canvas, and 'source' scales its own
+      pixel size (the background always defines the canvas)
+    * anchor 'bottom_center' puts the bottom edge position_y of the canvas
+      height above the bottom, 'top_center' puts the top edge position_y
+      below the top, 'center' centers the layer
+
+    All layers below the subject are flattened into an RGB underlay and all
+    layers above it into one overlay split into alpha-bounded tiles, once per
+    template and output size, so a render is one paste of the subject and one
+    overlay pass over the visible decoration only. Frames are shared with
+    other processes through the FrameStore.
+    """
+    def __init__(self, templates, store=None):
+        self.templates = templates
+        self.store = store or FrameStore()
+        self.frames = {}  # (template_key, output_width) -> TemplateFrame
+    
+    def get_frame(self, template_key, output_width=None):
+        """Get the pre-composited frame, rebuilding it when the assets change"""
+        fingerprint = template_fingerprint(template_key)
+        frame = self.frames.get((template_key, output_width))
+        
+        if frame is None or frame.fingerprint != fingerprint:
+            frame = self.store.load(template_key, output_width, fingerprint)
+            if frame is None:
+                frame = self.build_frame(template_key, output_width, fingerprint)
+                frame = self.store.save(template_key, output_width, frame)
+            self.frames[(template_key, output_width)] = frame
+        
+        return frame
+    
+    def load_layer_image(self, layer, canvas_size):
+        """Load a layer from the warm bundle, its source image, or its fallback"""
+        image = warm_bundle.layer_image(layer_bundle_key(layer, canvas_size))
+        if image is not None:
+            return image
+        
+        source = layer.get('source')
+        try:
+            if source and os.path.exists(source):
+                return Image.open(source).convert('RGBA')
+        except Exception as e:
+            logger.error(f"Error loading template layer {source}: {e}")
+        
+        fallback = layer.get('fallback')
+        if fallback:
+            return LAYER_GENERATORS[fallback](canvas_size).convert('RGBA')
+        
+        return None
+    
+    def place_layer(self, layer, image, canvas_size, source_factor=1.0):
+        """Resize a layer image and compute its position on the canvas"""
+        canvas_width, canvas_height = canvas_size
+        scale_mode = layer.get('scale_mode', 'source')
+        scale = layer.get('scale', 1.0)
+        
+        if scale_mode == 'fill':
+            resized = image.resize(canvas_size, Image.Resampling.LANCZOS)
+        elif scale_mode == 'width':
+            resized = resize_to_width(image, max(1, int(canvas_width * scale)))
+        elif scale_mode == 'height':
+            resized = resize_to_height(image, max(1, int(canvas_height * scale)))
         else:
-            template = create_template2_background()
-        
-        template_width, template_height = template.size
+            resized = resize_image_proportionally(image, scale * source_factor)
+        
+        width, height = resized.size
+        anchor = layer.get('anchor', 'bottom_center')
+        position_y = layer.get('position_y', 0.0)
+        
+        x = (canvas_width - width) // 2
+        if scale_mode == 'fill':
+            x, y = 0, 0
+        elif anchor == 'top_center':
+            y = int(canvas_height * position_y)
+        elif anchor == 'center':
+            y = (canvas_height - height) // 2
+        else:
+            y = int(canvas_height * (1 - position_y) - height)
         
-        # Step 1: Resize human to 75% of original size
-        human_scale = template_info['elements'].get('human_size', 0.75)
-        human_resized = resize_image_proportionally(human_image, human_scale)
+        return resized, (x, y)
+    
+    def build_frame(self, template_key, output_width, fingerprint):
+        """Flatten the static layers of a template around its subject"""
+        layers = sorted(self.templates[template_key]['layers'], key=lambda layer: layer.get('z', 0))
         
-        # Step 2: Position human at bottom (touching bottom)
-        human_width, human_height = human_resized.size
+        background = self.load_layer_image(layers[0], None)
+        full_width = background.width
+        background = scale_canvas(background, output_width)
+        canvas_size = background.size
+        canvas_scale = canvas_size[0] / full_width
         
-        # Human Y position: bottom of human touches bottom of template
-        human_y = template_height - human_height
+        underlay = background
+        overlay = None
+        subject = None
         
-        # Center horizontally
-        human_x = (template_width - human_width) // 2
+        for layer in layers[1:]:
+            if layer['type'] == 'subject':
+                subject = layer
+                continue
+            
+            image = self.load_layer_image(layer, canvas_size)
+            if image is None:
+                continue
+            
+            image, position = self.place_layer(layer, image, canvas_size, canvas_scale)
+            if subject is None:
+                composite_layer(underlay, image, position)
+            else:
+                if overlay is None:
+                    overlay = Image.new('RGBA', canvas_size, (0, 0, 0, 0))
+                composite_layer(overlay, image, position)
         
-        # Step 3: Load overlay
-        overlay_path = template_info['elements'].get('overlay')
-        overlay_on_top = template_info['elements'].get('overlay_on_top', True)
-        align_bottom = template_info['elements'].get('align_bottom', True)
+        underlay = underlay.convert('RGB')
+        overlay_tiles = split_overlay_into_tiles(overlay) if overlay is not None else []
         
-        if overlay_path and os.path.exists(overlay_path):
-            overlay = Image.open(overlay_path).convert('RGBA')
-            
-            # Resize overlay to match template dimensions
-            overlay = overlay.resize((template_width, template_height), Image.Resampling.LANCZOS)
-        else:
-            # Create a simple overlay if file doesn't exist
-            overlay = create_template2_overlay(template_width, template_height)
+        return TemplateFrame(canvas_size, underlay, overlay_tiles, subject, canvas_scale, fingerprint)
+    
+    def render(self, template_key, human_image, output_width=None, source_scale=1.0):
+        """Composite the human between the template's underlay and overlay"""
+        frame = self.get_frame(template_key, output_width)
         
-        # Step 4: Create composite
-        composite = template.copy()
+        human_resized, position = self.place_layer(
+            frame.subject, human_image, frame.size, frame.canvas_scale / source_scale
+        )
         
-        # Always paste human first (since overlay goes on top)
-        composite.paste(human_resized, (human_x, human_y), human_resized)
+        composite = frame.new_canvas()
+        composite.paste(human_resized, position, human_resized)
         
-        # Then paste overlay on top
-        if overlay_on_top:
-            # Paste overlay at position 0,0 (covers entire template)
-            # Since overlay is resized to template dimensions
-            composite.paste(overlay, (0, 0), overlay)
+        for tile in frame.overlay_tiles:
+            tile.composite_onto(composite)
         
         return composite
-        
-    except Exception as e:
-        logger.error(f"Error applying template 2: {e}")
-        return create_template2_fallback(human_image, template_info)
+    
+    def warm_up(self):
+        """Build the full size frame of every template"""
+        for template_key in self.templates:
+            self.get_frame(template_key)
 
-def apply_template3(human_image, template_info):
-    """Apply template 3 - Same as template 1 but with different background"""
-    # Template 3 uses the same logic as template 1
-    return apply_template1(human_image, template_info)
+# Initialize template engine
+template_engine = TemplateEngine(TEMPLATES)
 
-def create_fallback_result(human_image, template_info):
-    """Create fallback result for template 1"""
-    size = (1080, 1920)
-    bg = create_simple_background()
-    
-    human_resized = resize_to_height(human_image, int(size[1] * 0.75))
-    human_width, human_height = human_resized.size
-    
-    human_y = int(size[1] * 0.70) - human_height
-    human_x = (size[0] - human_width) // 2
-    
-    result = bg.copy()
-    result.paste(human_resized, (human_x, human_y), human_resized)
-    
-    return result
+def apply_template(template_key, human_image, output_width=None, source_scale=1.0):
+    """Apply the template matching template_key
 
-def create_template2_fallback(human_image, template_info):
-    """Create fallback result for template 2"""
-    size = (1080, 1920)
-    bg = create_template2_background()
-    
-    # Resize human to 75%
-    human_resized = resize_image_proportionally(human_image, 0.75)
-    human_width, human_height = human_resized.size
-    
-    # Position at bottom
-    human_y = size[1] - human_height
-    human_x = (size[0] - human_width) // 2
-    
-    # Create composite
-    result = bg.copy()
-    result.paste(human_resized, (human_x, human_y), human_resized)
-    
-    # Add simple overlay
-    overlay = create_template2_overlay(size[0], size[1])
-    result.paste(overlay, (0, 0), overlay)
+    output_width renders a smaller canvas with the same geometry and
+    source_scale is how much the human's source photo was downscaled.
+    """
+    if template_key not in TEMPLATES:
+        # Default to template 1
+        template_key = 'template1'
     
-    return result
+    return template_engine.render(template_key, human_image, output_width, source_scale)
 
 def create_sample_files():
     """Create sample template files if they don't exist"""
@@ -870,6 +2260,209 @@ def create_sample_files():
         bg.save(template3_bg_path)
         print("✅ Created template3_background.png")
 
+# ============================================================================
+# TEMPLATE PREVIEW GALLERY
+# ============================================================================
+
+PREVIEW_CACHE_FILE = 'template_previews.json'
+PREVIEW_THUMBNAIL_SIZE = (360, 640)
+
+def template_asset_paths(template_info):
+    """List the asset files a template is rendered from"""
+    return [layer['source'] for layer in template_info['layers'] if layer.get('source')]
+
+def template_fingerprint(template_key):
+    """Fingerprint a template's configuration and asset files"""
+    template_info = TEMPLATES[template_key]
+    digest = hashlib.md5(json.dumps(template_info, sort_keys=True).encode('utf-8'))
+
+    for path in template_asset_paths(template_info):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size}".encode('utf-8'))
+        else:
+            digest.update(f"{path}:missing".encode('utf-8'))
+
+    return digest.hexdigest()
+
+def create_placeholder_silhouette(width=400, height=700):
+    """Create a neutral human silhouette used to preview templates"""
+    silhouette = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(silhouette)
+    color = (235, 235, 240, 230)
+
+    # Head
+    head_width = int(width * 0.36)
+    head_height = int(height * 0.24)
+    head_x = (width - head_width) // 2
+    draw.ellipse([head_x, 0, head_x + head_width, head_height], fill=color)
+
+    # Neck
+    neck_width = int(width * 0.14)
+    neck_x = (width - neck_width) // 2
+    draw.rectangle([neck_x, int(head_height * 0.9), neck_x + neck_width, int(head_height * 1.15)], fill=color)
+
+    # Shoulders and body (rounded top, cut off at the bottom edge)
+    body_top = int(head_height * 1.1)
+    draw.rounded_rectangle([0, body_top, width - 1, height + width // 3], radius=width // 3, fill=color)
+
+    return silhouette
+
+def render_template_preview(template_key):
+    """Render a JPEG thumbnail of a template with a placeholder silhouette"""
+    preview = apply_template(template_key, create_placeholder_silhouette())
+    preview = preview.convert('RGB')
+    preview.thumbnail(PREVIEW_THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+
+    img_byte_arr = BytesIO()
+    preview.save(img_byte_arr, format='JPEG', quality=85)
+    return img_byte_arr.getvalue()
+
+class TemplatePreviewGallery:
+    def __init__(self):
+        self.cache_file = PREVIEW_CACHE_FILE
+        self.thumbnails = {}  # template_key -> (fingerprint, jpeg bytes)
+        self.file_ids = {}  # template_key -> {'fingerprint': ..., 'file_id': ...}
+        # build() runs on the warm-up thread and in send()'s worker thread;
+        # self.lock only guards the dicts, so send() never waits for a render
+        self.build_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.load_cache()
+
+    def load_cache(self):
+        """Load cached Telegram file_ids from file"""
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r') as f:
+                    self.file_ids = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading preview cache: {e}")
+            self.file_ids = {}
+
+    def save_cache(self):
+        """Save Telegram file_ids to file"""
+        with self.lock:
+            file_ids = dict(self.file_ids)
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(file_ids, f)
+        except Exception as e:
+            logger.error(f"Error saving preview cache: {e}")
+
+    def build(self, wait=True):
+        """Render thumbnails for templates whose assets changed since the last build
+
+        With wait=False it returns at once if another build is running.
+        """
+        if not self.build_lock.acquire(blocking=wait):
+            return
+        try:
+            for template_key in TEMPLATES:
+                self.build_template(template_key)
+        finally:
+            self.build_lock.release()
+
+    def build_template(self, template_key):
+        """Render one template's thumbnail unless an up-to-date one is already there"""
+        fingerprint = template_fingerprint(template_key)
+
+        with self.lock:
+            cached = self.file_ids.get(template_key)
+            if cached and cached.get('fingerprint') != fingerprint:
+                # Assets changed - the uploaded preview is stale
+                self.file_ids.pop(template_key, None)
+
+            if template_key in self.thumbnails and self.thumbnails[template_key][0] == fingerprint:
+                return
+
+            if template_key in self.file_ids:
+                # Telegram already has an up-to-date preview, no need to render
+                return
+
+        try:
+            thumbnail = render_template_preview(template_key)
+            with self.lock:
+                self.thumbnails[template_key] = (fingerprint, thumbnail)
+            logger.info(f"Rendered preview for {template_key}")
+        except Exception as e:
+            logger.error(f"Error rendering preview for {template_key}: {e}")
+
+    async def send(self, bot, chat_id):
+        """Send all template previews as one album, reusing cached file_ids"""
+        # Rendering stays off the event loop; while the warm-up is still building,
+        # the album has only the previews that are ready
+        await asyncio.to_thread(self.build, wait=False)
+
+        keys = []
+        fingerprints = {}
+        media = []
+        with self.lock:
+            for i, (template_key, template_info) in enumerate(TEMPLATES.items(), 1):
+                cached = self.file_ids.get(template_key)
+                if cached:
+                    photo = cached['file_id']
+                elif template_key in self.thumbnails:
+                    fingerprints[template_key], photo = self.thumbnails[template_key]
+                else:
+                    continue
+
+                keys.append(template_key)
+                media.append(InputMediaPhoto(media=photo, caption=f"{i}. {template_info['name']}"))
+
+        if not media:
+            return
+
+        messages = await bot.send_media_group(chat_id=chat_id, media=media)
+
+        # Remember the file_ids so later albums are sent without re-uploading
+        updated = False
+        with self.lock:
+            for template_key, message in zip(keys, messages):
+                if template_key not in fingerprints or template_key in self.file_ids or not message.photo:
+                    continue
+                self.file_ids[template_key] = {
+                    'fingerprint': fingerprints[template_key],
+                    'file_id': message.photo[-1].file_id
+                }
+                self.thumbnails.pop(template_key, None)
+                updated = True
+
+        if updated:
+            self.save_cache()
+
+# Initialize preview gallery
+preview_gallery = TemplatePreviewGallery()
+
+# ============================================================================
+# QUICK PREVIEW RENDERING
+# ============================================================================
+
+PREVIEW_RENDER_WIDTH = 360
+
+def render_quick_preview(photo_path, template_key):
+    """Render a low-resolution preview with local background removal
+
+    No Remove.bg credit is spent; the geometry is the same as the full render.
+    """
+    photo = read_image_header(photo_path)
+    original_width = photo.width
+    
+    # Let the JPEG decoder skip most of the pixels
+    photo.draft('RGB', (PREVIEW_RENDER_WIDTH * 2, PREVIEW_RENDER_WIDTH * 2))
+    photo = photo.convert('RGBA')
+    photo.thumbnail((PREVIEW_RENDER_WIDTH * 2, PREVIEW_RENDER_WIDTH * 2), Image.Resampling.BILINEAR)
+    source_scale = photo.width / original_width
+    
+    human_image = simple_background_removal_from_image(photo)
+    preview = apply_template(template_key, human_image, PREVIEW_RENDER_WIDTH, source_scale)
+    preview = preview.convert('RGB')
+    preview.thumbnail((PREVIEW_RENDER_WIDTH, PREVIEW_RENDER_WIDTH * 2), Image.Resampling.BILINEAR)
+    
+    img_byte_arr = BytesIO()
+    preview.save(img_byte_arr, format='JPEG', quality=80)
+    img_byte_arr.seek(0)
+    return img_byte_arr
+
 # ============================================================================
 # TELEGRAM BOT HANDLERS
 # ============================================================================
@@ -945,6 +2538,10 @@ async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.update_user_activity(user.id)
     
     usage_info = usage_tracker.get_usage_info()
+    tier = credit_scheduler.tier(user.id)
+    today_used = usage_tracker.used_today()
+    today_allowance = credit_scheduler.daily_allowance(tier)
+    key_lines = '\n'.join(removebg_keys.usage_lines()) or "• No API key configured"
     
     usage_text = f"""
 📊 Remove.bg API Usage
@@ -955,6 +2552,13 @@ async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Total: {usage_info['limit']} images per month
 • Usage: {usage_info['percentage']:.1f}%
 
+📆 Today:
+• Used: {today_used} of {today_allowance} Remove.bg images for your account type
+• After that, photos use local background removal
+
+🔑 API keys:
+{key_lines}
+
 ⚠️ Important:
 • Free account: 50 images per month
 • Counter resets on 1st of each month
@@ -987,17 +2591,6 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     db.update_user_activity(user.id)
     
-    # Check usage first
-    if not usage_tracker.can_process():
-        usage_info = usage_tracker.get_usage_info()
-        await update.message.reply_text(
-            f"⚠️ Remove.bg Monthly Limit Reached!\n\n"
-            f"You have used {usage_info['used']}/{usage_info['limit']} images this month.\n"
-            f"Please try again next month or contact the developer for upgrade options.\n\n"
-            f"Basic editing (without background removal) is still available.",
-            parse_mode='HTML'
-        )
-        return
     
     keyboard = [
         [InlineKeyboardButton("📷 Upload Photo", callback_data='upload_photo')],
@@ -1310,18 +2903,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.update_user_activity(user_id)
     
     if query.data == 'upload_photo':
-        # Check usage first
-        if not usage_tracker.can_process():
-            usage_info = usage_tracker.get_usage_info()
-            await query.edit_message_text(
-                f"⚠️ Remove.bg Monthly Limit Reached!\n\n"
-                f"You have used {usage_info['used']}/{usage_info['limit']} images this month.\n"
-                f"Please try again next month or contact the developer for upgrade options.\n\n"
-                f"Basic editing (without background removal) is still available.",
-                parse_mode='HTML'
-            )
-            return
-        
         usage_info = usage_tracker.get_usage_info()
         await query.edit_message_text(
             f"📤 Send me your photo!\n\n"
@@ -1333,10 +2914,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Send your photo now:",
             parse_mode='HTML'
         )
-        user_data[user_id] = {'state': 'awaiting_photo'}
+        set_user_photo(user_id, {'state': 'awaiting_photo'})
     
     elif query.data == 'check_usage':
         usage_info = usage_tracker.get_usage_info()
+        today_allowance = credit_scheduler.daily_allowance(credit_scheduler.tier(user_id))
+        key_lines = '\n'.join(removebg_keys.usage_lines()) or "• No API key configured"
         await query.edit_message_text(
             f"📊 Remove.bg API Usage\n\n"
             f"📅 This month's usage:\n"
@@ -1344,6 +2927,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• Remaining: {usage_info['remaining']} images\n"
             f"• Total: {usage_info['limit']} images per month\n"
             f"• Usage: {usage_info['percentage']:.1f}%\n\n"
+            f"📆 Today: {usage_tracker.used_today()} of {today_allowance} Remove.bg images used,\n"
+            f"then photos use local background removal\n\n"
+            f"🔑 API keys:\n{key_lines}\n\n"
             f"💡 Tips for best results:\n"
             f"1. Use clear, well-lit photos\n"
             f"2. Single person works best\n"
@@ -1525,7 +3111,21 @@ Reset: Counter resets on 1st of each month
             await query.answer("⛔ Admin only command", show_alert=True)
     
     elif query.data in ['select_template1', 'select_template2', 'select_template3']:
-        await handle_template_selection(update, context)
+        with metrics.in_progress('selamsnap_previews_in_progress'):
+            await handle_template_selection(update, context)
+    
+    elif query.data in ['render_template1', 'render_template2', 'render_template3']:
+        with metrics.in_progress('selamsnap_renders_in_progress'):
+            with metrics.span('render', template=query.data.replace('render_', '')):
+                await handle_render_confirmation(update, context)
+    
+    elif query.data == 'discard_preview':
+        set_user_photo(user_id, {})
+        await query.edit_message_caption(
+            caption="🗑 Preview discarded. No Remove.bg images were used.\n\n"
+                    "Send /upload to try another photo!",
+            parse_mode='HTML'
+        )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages"""
@@ -1605,35 +3205,52 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     db.update_user_activity(user_id)
     
-    # Check usage first
-    if not usage_tracker.can_process():
-        usage_info = usage_tracker.get_usage_info()
-        await update.message.reply_text(
-            f"⚠️ Remove.bg Monthly Limit Reached!\n\n"
-            f"You have used {usage_info['used']}/{usage_info['limit']} images this month.\n"
-            f"Please try again next month or contact the developer for upgrade options.\n\n"
-            f"You can still use basic features without background removal.",
-            parse_mode='HTML'
-        )
-        return
     
     photo_file = None
     
     if update.message.photo:
         photo_file = await update.message.photo[-1].get_file()
     elif update.message.document:
-        mime_type = update.message.document.mime_type
+        document = update.message.document
+        mime_type = document.mime_type
+        if document.file_size and document.file_size > MAX_UPLOAD_BYTES:
+            metrics.inc('selamsnap_uploads_rejected_total', reason='file_size')
+            await update.message.reply_text(
+                f"❌ This file is too large ({document.file_size / (1024 * 1024):.1f}MB).\n\n"
+                f"Please send a photo smaller than {MAX_UPLOAD_BYTES // (1024 * 1024)}MB."
+            )
+            return
         if mime_type and 'image' in mime_type:
-            photo_file = await update.message.document.get_file()
+            photo_file = await document.get_file()
     
     if photo_file:
         try:
-            photo_bytes = await photo_file.download_as_bytearray()
+            prune_uploads()
+            with metrics.span('download'):
+                photo_path = await uploads.download_upload(photo_file, user_id)
             
-            user_data[user_id] = {
-                'photo_bytes': bytes(photo_bytes),
+            # Check the header before anything decodes the image
+            try:
+                read_image_header(photo_path).close()
+            except ImageRejected as e:
+                uploads.remove_upload(photo_path)
+                metrics.inc('selamsnap_uploads_rejected_total', reason=e.reason)
+                await update.message.reply_text(str(e))
+                return
+            
+            metrics.inc('selamsnap_photos_received_total')
+            
+            set_user_photo(user_id, {
+                'photo_path': photo_path,
+                'photo_hash': await asyncio.to_thread(uploads.file_digest, photo_path),
                 'state': 'selecting_template'
-            }
+            })
+            
+            # Show what each template looks like before a credit is spent
+            try:
+                await preview_gallery.send(context.bot, update.effective_chat.id)
+            except Exception as e:
+                logger.error(f"Error sending template previews: {e}")
             
             # Show all THREE templates
             keyboard = [
@@ -1647,11 +3264,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             await update.message.reply_text(
                 f"✅ Photo received!\n\n"
-                f"Choose a template:\n\n"
+                f"Choose a template for a free quick preview:\n\n"
                 f"1. እገኛለሁ \n"
                 f"2. አብረን እናምልክ\n"
                 f"3. ፲፭ ዓመት በ ሉቃስ ፲፭\n\n"
-                f"📊 Remaining images this month: {usage_info['remaining']-1}/{usage_info['limit']}",
+                f"📊 Remaining images this month: {usage_info['remaining']}/{usage_info['limit']}",
                 reply_markup=reply_markup,
                 parse_mode='HTML'
             )
@@ -1667,7 +3284,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def handle_template_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle template selection"""
+    """Handle template selection - send a quick low-resolution preview"""
     query = update.callback_query
     await query.answer()
     
@@ -1676,7 +3293,7 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
     
     user_info = user_data.get(user_id, {})
     
-    if not user_info or 'photo_bytes' not in user_info:
+    if not user_info or not os.path.exists(user_info.get('photo_path') or ''):
         await query.edit_message_text(
             "❌ No photo found. Please start again with /upload"
         )
@@ -1689,69 +3306,240 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text("❌ Template not available.")
         return
     
-    # Show processing message
-    template_name = template_info['name']
-    processing_msg = await query.edit_message_text(
-        f"🔄 Processing: {template_name}\n\n"
-        "Step 1: Removing background with Remove.bg API...",
+    memory = job_memory.start('preview')
+    try:
+        with metrics.span('preview', template=template_key):
+            preview = await asyncio.to_thread(render_quick_preview, user_info['photo_path'], template_key)
+    except Exception as e:
+        logger.error(f"Error rendering preview for {template_key}: {e}")
+        await query.message.reply_text(
+            "❌ Could not create a preview. Please try another photo with /upload"
+        )
+        return
+    finally:
+        job_memory.finish(memory)
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ Create Full Quality", callback_data=f'render_{template_key}')],
+        [InlineKeyboardButton("🗑 Discard", callback_data='discard_preview')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    usage_info = usage_tracker.get_usage_info()
+    backend, _ = credit_scheduler.route(user_id)
+    if backend == 'removebg':
+        cost_text = "Create the full quality version? It uses 1 Remove.bg image.\n\n"
+    else:
+        cost_text = ("Create the full quality version? Today's Remove.bg images are used up,\n"
+                     "so it will use local background removal (free).\n\n")
+    
+    await context.bot.send_photo(
+        chat_id=query.message.chat_id,
+        photo=preview,
+        caption=(
+            f"👀 Quick Preview: {template_info['name']}\n\n"
+            "This low-resolution preview was made without Remove.bg.\n"
+            f"{cost_text}"
+            f"📊 Remaining images this month: {usage_info['remaining']}/{usage_info['limit']}\n\n"
+            "You can also pick another template above."
+        ),
+        reply_markup=reply_markup,
         parse_mode='HTML'
     )
+
+def encode_png(image):
+    """Encode a finished render for sending"""
+    img_byte_arr = BytesIO()
+    image.save(img_byte_arr, format='PNG', optimize=True, quality=95)
+    img_byte_arr.seek(0)
+    return img_byte_arr
+
+async def handle_render_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle preview confirmation - queue the full quality render and run it"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    db.update_user_activity(user_id)
+    
+    user_info = user_data.get(user_id, {})
+    
+    if not user_info or not os.path.exists(user_info.get('photo_path') or ''):
+        await query.message.reply_text(
+            "❌ No photo found. Please start again with /upload"
+        )
+        return
+    
+    template_key = query.data.replace('render_', '')
+    template_info = TEMPLATES.get(template_key)
     
+    if not template_info:
+        await query.message.reply_text("❌ Template not available.")
+        return
+    
+    # Remove the buttons so the preview can't be confirmed twice
     try:
-        photo_bytes = user_info['photo_bytes']
+        await query.edit_message_reply_markup(reply_markup=None)
+    except Exception as e:
+        logger.error(f"Error removing preview buttons: {e}")
+    
+    # Spend a Remove.bg credit only if this user's tier has some left today
+    backend, tier = credit_scheduler.route(user_id)
+    metrics.inc('selamsnap_credit_routing_total', tier=tier, backend=backend)
+    
+    # One job per confirmed preview, kept in SQLite until the photo is delivered
+    job, created = render_jobs.enqueue(
+        f"{query.message.chat_id}:{query.message.message_id}:{template_key}",
+        user_id, query.message.chat_id, template_key, user_info['photo_path'], backend
+    )
+    if not created:
+        logger.info(f"Render job {job['id']} is already {job['status']}")
+        return
+    
+    await process_render_job(context.bot, job['id'])
+
+async def process_render_job(bot, job_id, resumed=False):
+    """Run a queued render, retrying failed attempts, until it is done or has failed"""
+    while True:
+        job = render_jobs.claim(job_id)
+        if job is None:
+            return
         
-        await processing_msg.edit_text(
-            f"🔄 Processing: {template_name}\n\n"
-            "Step 1: Removing background with Remove.bg API... ⏳\n"
-            "This may take a few seconds...",
+        try:
+            await run_render_job(bot, job, resumed)
+            break
+        except Exception as e:
+            logger.error(f"Error processing template {job['template_key']} (job {job_id}, "
+                         f"attempt {job['attempts']}): {e}")
+            error_msg = str(e)[:200]
+            status = render_jobs.fail(job_id, error_msg, retry=not isinstance(e, RENDER_JOB_PERMANENT_ERRORS))
+            if status == 'failed':
+                await report_render_failure(bot, job, error_msg)
+                break
+            metrics.inc('selamsnap_render_job_retries_total', template=job['template_key'])
+            await asyncio.sleep(RENDER_JOB_RETRY_DELAY * job['attempts'])
+    
+    release_job_photo(job)
+
+def release_job_photo(job):
+    """Delete a finished job's cut-out, and its upload unless the user or another job still needs it"""
+    uploads.remove_upload(job['cutout_path'])
+    info = user_data.get(job['user_id']) or {}
+    if info.get('photo_path') != job['photo_path'] and job['photo_path'] not in render_jobs.photo_paths():
+        uploads.remove_upload(job['photo_path'])
+
+async def report_render_failure(bot, job, error_msg):
+    """Tell the user a render failed for good"""
+    template_info = TEMPLATES.get(job['template_key'], {'name': job['template_key']})
+    text = (
+        f"❌ Error processing with {template_info['name']} template.\n\n"
+        f"Error: {error_msg}\n\n"
+        "Please try again with /upload"
+    )
+    try:
+        if job['message_id']:
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
+        else:
+            await bot.send_message(chat_id=job['chat_id'], text=text)
+    except Exception as e:
+        logger.error(f"Error reporting failed render job {job['id']}: {e}")
+
+def save_cutout(image, path):
+    """Keep a paid cut-out on disk (fast PNG - it's only read back by this process)"""
+    image.save(path, format='PNG', compress_level=1)
+
+def load_cutout(path):
+    with Image.open(path) as img:
+        return img.convert('RGBA')
+
+async def run_render_job(bot, job, resumed=False):
+    """One attempt at a queued render: remove the background, apply the template and send the photo"""
+    template_key = job['template_key']
+    template_info = TEMPLATES[template_key]
+    template_name = template_info['name']
+    user_id = job['user_id']
+    
+    step_text = ("Step 1: Removing background with Remove.bg API..." if job['backend'] == 'removebg'
+                 else "Step 1: Removing background locally...")
+    intro = "Picking up where we left off after a restart...\n" if resumed else ""
+    
+    # Show processing message (a resumed or retried job keeps editing the one it has)
+    message_id = job['message_id']
+    if not message_id:
+        processing_msg = await bot.send_message(
+            chat_id=job['chat_id'],
+            text=f"🔄 Processing: {template_name}\n\n{intro}{step_text}",
             parse_mode='HTML'
         )
-        
-        # Extract human using Remove.bg
+        message_id = processing_msg.message_id
+        render_jobs.set_message(job['id'], message_id)
+    
+    async def progress(text, reply_markup=None):
+        # The photo matters more than the progress message (it may have been deleted)
         try:
-            human_image = extract_human_using_removebg(photo_bytes)
-            bg_status = "✅"
-        except Exception as bg_error:
-            logger.error(f"Remove.bg failed: {bg_error}")
-            # Try fallback
-            await processing_msg.edit_text(
-                f"🔄 Processing: {template_name}\n\n"
-                "Step 1: Remove.bg failed, using fallback...",
-                parse_mode='HTML'
-            )
-            human_image = simple_background_removal(photo_bytes)
-            bg_status = "⚠️ (Fallback)"
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=message_id,
+                                        reply_markup=reply_markup, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"Error updating render progress: {e}")
+    
+    profile = render_profiler.start(template_key)
+    memory = job_memory.start('render')
+    
+    try:
+        photo_path = job['photo_path']
+        profile.image_size = image_dimensions(photo_path)
         
-        await processing_msg.edit_text(
+        await progress(
+            f"🔄 Processing: {template_name}\n\n"
+            f"{intro}"
+            f"{step_text} ⏳\n"
+            "This may take a few seconds..."
+        )
+        
+        # Extract human with the configured backends; paid ones only if the scheduler allowed it
+        allow_paid = job['backend'] == 'removebg'
+        if job['cutout_path'] and os.path.exists(job['cutout_path']):
+            # An earlier attempt already paid for this cut-out
+            human_image = await profile.run(load_cutout, job['cutout_path'])
+            bg_status = "✅"
+        else:
+            preferred = [candidate.name for candidate in background_router.candidates(allow_paid)][:1]
+            human_image, used_backend = await profile.run(background_router.remove, photo_path, allow_paid)
+            if used_backend not in preferred:
+                bg_status = "⚠️ (Fallback)"
+            else:
+                bg_status = "✅" if allow_paid else "✅ (Local)"
+            
+            if any(candidate.cost for candidate in background_router.backends if candidate.name == used_backend):
+                cutout_path = f"{photo_path}.{job['id']}.cutout.png"
+                try:
+                    await asyncio.to_thread(save_cutout, human_image, cutout_path)
+                    render_jobs.set_cutout(job['id'], cutout_path)
+                    job['cutout_path'] = cutout_path
+                except Exception as e:
+                    logger.error(f"Error saving cut-out of render job {job['id']}: {e}")
+                    uploads.remove_upload(cutout_path)
+        
+        await progress(
             f"🔄 Processing: {template_name}\n\n"
             f"Step 1: Background removal... {bg_status}\n"
-            "Step 2: Applying template...",
-            parse_mode='HTML'
+            "Step 2: Applying template..."
         )
         
         # Apply appropriate template
-        if template_key == 'template1':
-            result_image = apply_template1(human_image, template_info)
-        elif template_key == 'template2':
-            result_image = apply_template2(human_image, template_info)
-        elif template_key == 'template3':
-            result_image = apply_template3(human_image, template_info)
-        else:
-            # Default to template 1
-            result_image = apply_template1(human_image, template_info)
+        with metrics.span('compose', template=template_key):
+            result_image = await profile.run(apply_template, template_key, human_image)
         
-        await processing_msg.edit_text(
+        await progress(
             f"🔄 Processing: {template_name}\n\n"
             f"Step 1: Background removal... {bg_status}\n"
             "Step 2: Applying template... ✅\n"
-            "Step 3: Finalizing...",
-            parse_mode='HTML'
+            "Step 3: Finalizing..."
         )
         
         # Convert to bytes
-        img_byte_arr = BytesIO()
-        result_image.save(img_byte_arr, format='PNG', optimize=True, quality=95)
-        img_byte_arr.seek(0)
+        with metrics.span('encode', template=template_key):
+            img_byte_arr = await profile.run(encode_png, result_image)
         
         # Send result with template-specific caption
         usage_info = usage_tracker.get_usage_info()
@@ -1775,43 +3563,56 @@ async def handle_template_selection(update: Update, context: ContextTypes.DEFAUL
                 "Send /upload for another photo!"
             )
         
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=img_byte_arr,
-            caption=caption,
-            parse_mode='HTML'
-        )
-        
-        # Update database statistics
-        db.increment_photo_count(user_id, template_key)
-        
-        # Clear user data
-        if user_id in user_data:
-            user_data[user_id] = {}
-        
-        # Show options for next step
-        keyboard = [
-            [InlineKeyboardButton("📸 Another Photo", callback_data='upload_photo')],
-            [InlineKeyboardButton("📊 Check Usage", callback_data='check_usage')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await processing_msg.edit_text(
-            f"✅ {template_name} Complete!\n\n"
-            f"📊 Remaining images this month: {usage_info['remaining']}/{usage_info['limit']}\n\n"
-            "Would you like to process another photo?",
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        
-    except Exception as e:
-        logger.error(f"Error processing template {template_key}: {e}")
-        error_msg = str(e)[:200]
-        await query.edit_message_text(
-            f"❌ Error processing with {template_info['name']} template.\n\n"
-            f"Error: {error_msg}\n\n"
-            "Please try again with /upload"
-        )
+        with metrics.span('send_photo', template=template_key):
+            await bot.send_photo(
+                chat_id=job['chat_id'],
+                photo=img_byte_arr,
+                caption=caption,
+                parse_mode='HTML'
+            )
+    
+    finally:
+        render_profiler.finish(profile)
+        job_memory.finish(memory)
+    
+    # Delivered - count it once, however often the job was attempted
+    if not render_jobs.complete(job['id']):
+        return
+    
+    metrics.inc('selamsnap_renders_total', template=template_key)
+    
+    # Update database statistics
+    db.increment_photo_count(user_id, template_key)
+    
+    # Clear user data
+    if (user_data.get(user_id) or {}).get('photo_path') == photo_path:
+        set_user_photo(user_id, {})
+    
+    # Show options for next step
+    keyboard = [
+        [InlineKeyboardButton("📸 Another Photo", callback_data='upload_photo')],
+        [InlineKeyboardButton("📊 Check Usage", callback_data='check_usage')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await progress(
+        f"✅ {template_name} Complete!\n\n"
+        f"📊 Remaining images this month: {usage_info['remaining']}/{usage_info['limit']}\n\n"
+        "Would you like to process another photo?",
+        reply_markup=reply_markup
+    )
+
+async def resume_render_jobs(bot):
+    """Tell users about renders given up at startup and run the ones still queued"""
+    for job in render_jobs.interrupted:
+        await report_render_failure(bot, job, job['error'])
+        release_job_photo(job)
+    render_jobs.interrupted = []
+    
+    jobs = render_jobs.pending()
+    if jobs:
+        logger.info(f"🔁 Resuming {len(jobs)} queued render(s)")
+    await asyncio.gather(*(process_render_job(bot, job['id'], resumed=True) for job in jobs))
 
 async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, message):
     """Send broadcast message to all users"""
@@ -1898,6 +3699,91 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # MAIN FUNCTION
 # ============================================================================
 
+def register_handlers(application):
+    """Register the error handler and all update handlers"""
+    application.add_error_handler(error_handler)
+    
+    # Add handlers, each behind the user's rate limit for that kind of update
+    command = rate_limited('command')
+    application.add_handler(CommandHandler("start", command(start)))
+    application.add_handler(CommandHandler("upload", command(upload_command)))
+    application.add_handler(CommandHandler("usage", command(usage_command)))
+    application.add_handler(CommandHandler("developer", command(developer_command)))
+    application.add_handler(CommandHandler("comment", command(comment_command)))
+    application.add_handler(CommandHandler("stats", command(stats_command)))
+    application.add_handler(CommandHandler("broadcast", command(broadcast_command)))
+    application.add_handler(CommandHandler("showcomments", command(show_comments_command)))
+    application.add_handler(CommandHandler("help", command(help_command)))
+    
+    # Duplicate taps are dropped before they take a rate limit token
+    application.add_handler(CallbackQueryHandler(in_flight.deduplicate(rate_limited(callback_action)(button_handler))))
+    
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, rate_limited('upload')(handle_photo)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, command(handle_message)))
+
+def warm_up():
+    """Import the imaging modules and prepare templates and previews"""
+    start_time = time.perf_counter()
+    try:
+        for module in (np, Image, ImageDraw, ImageFont, requests):
+            module.resolve()
+        
+        # Missing sample files resolve to the same generated layers the bundle holds
+        if not warm_bundle.loaded:
+            create_sample_files()
+        
+        # Flatten template layers and render previews once (re-built only when assets change)
+        template_engine.warm_up()
+        preview_gallery.build()
+        
+        # Load the models of local backends (rembg), if any are configured
+        background_router.warm_up()
+        
+        elapsed = time.perf_counter() - start_time
+        metrics.set_gauge('selamsnap_warm_up_seconds', elapsed)
+        logger.info(f"✅ Warm-up finished in {elapsed:.1f}s")
+    except Exception as e:
+        logger.error(f"Error during warm-up: {e}")
+
+warm_up_thread = None
+
+def start_warm_up():
+    """Run the warm-up in a background thread (once per process)"""
+    global warm_up_thread
+    if warm_up_thread is None:
+        warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+        warm_up_thread.start()
+
+def log_resume_result(task):
+    """Done-callback of the render resume task: log what would otherwise be lost"""
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error resuming render jobs: {task.exception()}")
+
+async def post_init(application):
+    """Start warming up once the bot is initialized, without delaying polling, and resume queued renders"""
+    start_warm_up()
+    rate_limiter.start_snapshots(RATE_LIMIT_SNAPSHOT_INTERVAL)
+    
+    # Every start of the polling loop, including in-process restarts after a crash: the
+    # previous application has stopped, so renders still marked running were cut short
+    render_jobs.recover()
+    task = asyncio.create_task(resume_render_jobs(application.bot))
+    task.add_done_callback(log_resume_result)
+    application.bot_data['render_resume_task'] = task
+
+async def post_shutdown(application):
+    """Keep the rate limits across the restart and stop resuming renders"""
+    rate_limiter.snapshot()
+    
+    # Cancelled renders stay in the queue and are resumed by the next post_init
+    task = application.bot_data.pop('render_resume_task', None)
+    if task and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
 def main():
     """Main entry point"""
     print("=" * 60)
@@ -1907,20 +3793,23 @@ def main():
     print("=" * 60)
     
     # Check Remove.bg API key
-    if not REMOVE_BG_API_KEY:
+    if not REMOVE_BG_API_KEYS:
         print("⚠️ WARNING: REMOVE_BG_API_KEY environment variable not set!")
         print("⚠️ The bot will use fallback background removal (lower quality)")
         print("⚠️ Get your free API key from: https://www.remove.bg/api")
     else:
-        print("✅ Remove.bg API key found")
+        print(f"✅ Remove.bg API keys found: {len(REMOVE_BG_API_KEYS)}")
     
     # Print usage info
     usage_info = usage_tracker.get_usage_info()
     print(f"📊 Remove.bg Usage: {usage_info['used']}/{usage_info['limit']} images this month")
     
-    # Ensure directories and create sample files
+    # Sample files, templates and previews are prepared by the background warm-up
     ensure_directories()
-    create_sample_files()
+    
+    # Pending selections don't survive a restart, so neither do their uploads (queued
+    # renders keep theirs). Done before polling, so no new upload can be caught by it
+    prune_uploads(max_age=0)
     
     # Check required files
     print("\n🔍 Checking required files...")
@@ -1937,23 +3826,33 @@ def main():
         if os.path.exists(file):
             print(f"✅ {file}")
         else:
-            print(f"⚠️  {file} - Sample created")
+            print(f"⚠️  {file} - Sample will be created")
     
     print("\n📋 Template 3 Files:")
     for file in ['templates/template3_background.png']:
         if os.path.exists(file):
             print(f"✅ {file}")
         else:
-            print(f"⚠️  {file} - Sample created")
+            print(f"⚠️  {file} - Sample will be created")
     
     print("\n🤖 Bot Configuration:")
     print(f"   Admin IDs: {ADMIN_IDS}")
-    print(f"   Remove.bg API: {'✅ Configured' if REMOVE_BG_API_KEY else '❌ Not Configured'}")
-    print("   Database: bot_database.db")
-    print("   Usage Tracker: removebg_usage.json")
+    print(f"   Remove.bg API: {f'✅ {len(REMOVE_BG_API_KEYS)} key(s)' if REMOVE_BG_API_KEYS else '❌ Not Configured'}")
+    print(f"   Background backends: {', '.join(background_router.describe())} ({background_router.policy})")
+    print(f"   Database: {DATABASE_FILE}")
+    print(f"   Usage Tracker: removebg_usage table in {DATABASE_FILE}")
     print(f"   Developer: {DEVELOPER_INFO['name']}")
     print(f"   YouTube: {DEVELOPER_INFO['youtube']}")
     print("   Mode: Polling (No Flask Server)")
+    print("   Warm-up: templates and previews load in the background")
+    print(f"   Image budget: {IMAGE_PIXEL_BUDGET // 1_000_000}MP per upload, {JOB_MEMORY_BUDGET_MB}MB per job")
+    print(f"   Rate limits: {RATE_LIMITS} (admins exempt)")
+    print(f"   Render queue: render_jobs table in {DATABASE_FILE}, "
+          f"{render_jobs.count('pending')} pending, {RENDER_JOB_MAX_ATTEMPTS} attempts per job")
+    
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        print(f"   Metrics: http://0.0.0.0:{METRICS_PORT}/metrics")
     
     # Run bot with retry logic
     while True:
@@ -1963,25 +3862,15 @@ def main():
             print("=" * 60)
             
             # Create application
-            application = Application.builder().token(BOT_TOKEN).build()
-            
-            application.add_error_handler(error_handler)
-    
-            # Add handlers
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("upload", upload_command))
-            application.add_handler(CommandHandler("usage", usage_command))
-            application.add_handler(CommandHandler("developer", developer_command))
-            application.add_handler(CommandHandler("comment", comment_command))
-            application.add_handler(CommandHandler("stats", stats_command))
-            application.add_handler(CommandHandler("broadcast", broadcast_command))
-            application.add_handler(CommandHandler("showcomments", show_comments_command))
-            application.add_handler(CommandHandler("help", help_command))
-            
-            application.add_handler(CallbackQueryHandler(button_handler))
-            
-            application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+            application = (
+                Application.builder()
+                .token(BOT_TOKEN)
+                .post_init(post_init)
+                .post_shutdown(post_shutdown)
+                .concurrent_updates(CONCURRENT_UPDATES)
+                .build()
+            )
+            register_handlers(application)
             
             # Run bot
             print("✅ Bot is running and ready to receive messages...")
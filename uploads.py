@@ -0,0 +1,90 @@
+"""Photo uploads shared by the SelamSnap bots.
+
+Uploads are streamed from Telegram into UPLOAD_DIR in chunks instead of
+being held in memory as bytes, and the rest of the pipeline is handed the
+file's path. A file is deleted once it is used, replaced by the user's next
+photo, or abandoned for longer than UPLOAD_MAX_AGE.
+
+    photo_path = await uploads.download_upload(photo_file, user_id)
+    photo_hash = await asyncio.to_thread(uploads.file_digest, photo_path)
+"""
+import os
+import time
+import uuid
+import hashlib
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = 'temp'
+UPLOAD_MAX_AGE = 24 * 60 * 60  # seconds
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+async def download_upload(telegram_file, user_id):
+    """Stream a Telegram file into UPLOAD_DIR in chunks and return its path"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"upload_{user_id}_{uuid.uuid4().hex}")
+
+    try:
+        if os.path.isabs(telegram_file.file_path):
+            # Local Bot API server - the file is already on this machine
+            await telegram_file.download_to_drive(path)
+            return path
+
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+            async with client.stream('GET', telegram_file.file_path) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        return path
+    except Exception:
+        remove_upload(path)
+        raise
+
+
+def file_digest(path):
+    """SHA-256 of an upload, to recognize the same photo"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_upload(path):
+    """Delete an upload from disk if it is still there"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error removing upload {path}: {e}")
+
+
+def prune_uploads(max_age=UPLOAD_MAX_AGE, keep=()):
+    """Delete uploads older than max_age seconds (abandoned selections), except the paths in keep"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+
+    cutoff = time.time() - max_age
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        try:
+            if name.startswith('upload_') and path not in keep and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def set_user_photo(user_data, user_id, info, keep=()):
+    """Replace a user's state, deleting the upload it no longer refers to unless it is in keep"""
+    previous_path = (user_data.get(user_id) or {}).get('photo_path')
+    if previous_path != info.get('photo_path') and previous_path not in keep:
+        remove_upload(previous_path)
+    user_data[user_id] = info